@@ -0,0 +1,180 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Message queues for client sessions, with limits.
+
+The messages waiting to be sent to a client, because it is disconnected or its receive
+maximum has been reached, are counted against limits on the number of messages and bytes
+for each session, and for all the sessions of the brokers sharing one QueueLimits.  When
+a new message would take a queue over a limit, the policy decides what happens:
+
+  drop_oldest: the session's oldest queued messages are dropped to make room
+  drop_newest: the new message is dropped
+  drop_qos0:   the session's queued QoS 0 messages are dropped, oldest first, then the new one
+  disconnect:  the new message is dropped, and a connected client is disconnected
+
+If there is nothing left in the session's queue to drop, the new message is dropped.
+"""
+
+import threading, collections
+
+policies = ["drop_oldest", "drop_newest", "drop_qos0", "disconnect"]
+
+
+def messageSize(pub):
+  "the bytes a queued message is counted as: its topic name and payload"
+  return len(pub.data) + (len(pub.topicName) if pub.topicName else 0)
+
+
+class QueueLimits:
+  "the limits on queued messages, the policy for when one is reached, and the counts for all the queues"
+
+  def __init__(self, options={}):
+    self.sessionMessages = options.get("maxQueuedMessages")
+    self.sessionBytes = options.get("maxQueuedBytes")
+    self.totalMessages = options.get("maxTotalQueuedMessages")
+    self.totalBytes = options.get("maxTotalQueuedBytes")
+    self.policy = options.get("queueOverflowPolicy", "drop_oldest")
+    if self.policy not in policies:
+      raise ValueError("Queue overflow policy %s is not one of %s" % (self.policy, policies))
+    self.lock = threading.Lock() # for the counts, which all the queues update
+    self.messages = 0 # queued now
+    self.bytes = 0
+    self.maxMessages = 0 # the most there have been queued at once
+    self.maxBytes = 0
+    self.dropped = 0 # messages dropped because of the limits
+    self.disconnects = 0 # clients disconnected because of the limits
+
+  def stats(self):
+    with self.lock:
+      return {"policy": self.policy,
+              "limits": {"session_messages": self.sessionMessages, "session_bytes": self.sessionBytes,
+                         "total_messages": self.totalMessages, "total_bytes": self.totalBytes},
+              "messages": self.messages, "bytes": self.bytes,
+              "max_messages": self.maxMessages, "max_bytes": self.maxBytes,
+              "dropped": self.dropped, "disconnects": self.disconnects}
+
+
+class MessageQueues:
+  "the messages queued for one session, oldest first"
+
+  def __init__(self, limits):
+    self.limits = limits
+    self.messages = collections.OrderedDict() # ids to messages, so that any one can be removed at once
+    self.bytes = 0
+    self.qos0 = 0 # the number of QoS 0 messages queued
+
+  def __len__(self):
+    return len(self.messages)
+
+  def __iter__(self):
+    return iter(self.messages.values())
+
+  def full(self, size):
+    "would a message of size bytes take this queue, or all of them, over a limit?"
+    limits = self.limits
+    return ((limits.sessionMessages != None and len(self.messages) >= limits.sessionMessages) or
+            (limits.sessionBytes != None and self.bytes + size > limits.sessionBytes) or
+            (limits.totalMessages != None and limits.messages >= limits.totalMessages) or
+            (limits.totalBytes != None and limits.bytes + size > limits.totalBytes))
+
+  def added(self, pub, size):
+    self.bytes += size
+    self.limits.messages += 1
+    self.limits.bytes += size
+    if pub.fh.QoS == 0:
+      self.qos0 += 1
+
+  def removed(self, pub):
+    size = messageSize(pub)
+    self.bytes -= size
+    self.limits.messages -= 1
+    self.limits.bytes -= size
+    if pub.fh.QoS == 0:
+      self.qos0 -= 1
+
+  def append(self, pub, dropped=None):
+    """queue a message, applying the policy if it would take a queue over a limit.
+
+    dropped, if given, is called with each message the policy drops, whether queued already
+    or the new one, after the counts are unlocked.
+    Returns False if the policy is to disconnect the client, because the message was dropped.
+    """
+    limits = self.limits
+    size = messageSize(pub)
+    drops = []
+    result = True
+    with limits.lock:
+      while self.full(size):
+        if limits.policy == "drop_oldest" and len(self.messages) > 0:
+          drops.append(self.messages.popitem(last=False)[1])
+          self.removed(drops[-1])
+          limits.dropped += 1
+        elif limits.policy == "drop_qos0" and self.qos0 > 0:
+          for key, queued in self.messages.items():
+            if queued.fh.QoS == 0:
+              del self.messages[key]
+              drops.append(queued)
+              self.removed(queued)
+              limits.dropped += 1
+              break
+        else:
+          drops.append(pub)
+          limits.dropped += 1
+          result = limits.policy != "disconnect"
+          break
+      else:
+        self.messages[id(pub)] = pub
+        self.added(pub, size)
+        if limits.messages > limits.maxMessages:
+          limits.maxMessages = limits.messages
+        if limits.bytes > limits.maxBytes:
+          limits.maxBytes = limits.bytes
+    if dropped != None:
+      for queued in drops:
+        dropped(queued)
+    return result
+
+  def disconnected(self):
+    "count a client disconnected by the policy"
+    with self.limits.lock:
+      self.limits.disconnects += 1
+
+  def popleft(self):
+    pub = self.messages.popitem(last=False)[1]
+    with self.limits.lock:
+      self.removed(pub)
+    return pub
+
+  def remove(self, pub):
+    "remove a message, such as one which has expired.  Returns whether it was queued"
+    with self.limits.lock:
+      if self.messages.pop(id(pub), None) is pub:
+        self.removed(pub)
+        return True
+    return False
+
+  def clear(self, limit=None):
+    "discard the queued messages, or the oldest limit of them, when the session ends.  Returns those discarded"
+    discarded = []
+    with self.limits.lock:
+      while len(self.messages) > 0 and (limit == None or len(discarded) < limit):
+        discarded.append(self.messages.popitem(last=False)[1])
+        self.removed(discarded[-1])
+    return discarded
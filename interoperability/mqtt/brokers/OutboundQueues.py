@@ -0,0 +1,75 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Outbound queues, used when the brokers run with "concurrency fine".
+
+The brokers then hold a lock for the sessions, one for the subscriptions, one for the
+retained messages and one for each client, rather than one lock for everything.
+Packets for a client are encoded while those locks are held, but are only written to
+its socket once they have been released, so that a slow socket holds up just the
+thread writing to it, and not every other publisher.
+"""
+
+import threading, collections
+
+pending = threading.local() # the queues each thread has added to but not yet flushed
+
+
+class OutboundQueues:
+  "the packets waiting to be written to one socket"
+
+  def __init__(self):
+    self.items = collections.deque() # functions which write one packet each
+    self.sending = threading.Lock()  # held by the thread writing to the socket
+
+  def put(self, send):
+    "add a packet, to be written when this thread calls flush()"
+    self.items.append(send)
+    if not hasattr(pending, "queues"):
+      pending.queues = set()
+    pending.queues.add(self)
+
+  def flush(self, wait=False):
+    """write the queued packets, in order.
+
+    If another thread is already writing to the socket, it will write these too,
+    so don't wait for it unless asked to.
+    """
+    while self.items and self.sending.acquire(blocking=wait):
+      try:
+        while self.items:
+          self.items.popleft()()
+      finally:
+        self.sending.release()
+
+
+def attach(sock):
+  "give a socket an outbound queue, unless it is a plain socket which can't have one"
+  if getattr(sock, "outbound", None) == None:
+    try:
+      sock.outbound = OutboundQueues()
+    except AttributeError:
+      pass # packets are written to the socket directly
+
+
+def flush():
+  "write the packets this thread has queued, to be called once it holds no broker locks"
+  queues = getattr(pending, "queues", None)
+  while queues: # writing may queue more packets, for the visual option
+    queues.pop().flush()
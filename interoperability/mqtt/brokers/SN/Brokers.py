@@ -25,9 +25,9 @@ logger = logging.getLogger('MQTT-SN broker')
  
 class Brokers:
 
-  def __init__(self, overlapping_single=True, sharedData={}):
+  def __init__(self, overlapping_single=True, sharedData={}, locks=None):
     self.sharedData = sharedData
-    self.se = SubscriptionEngines(self.sharedData)
+    self.se = SubscriptionEngines(self.sharedData, locks)
     self.__clients = {} # clientid -> client
     self.overlapping_single = overlapping_single
     self.__broker3 = None
@@ -135,14 +135,10 @@ class Brokers:
       qos = [qos]
     i = 0
     for t in topic: # t is a wildcard subscription topic
-      topicsUsed = []
-      for s in self.se.getRetainedTopics(t): # s is a non-wildcard retained topic
-        if s not in topicsUsed and Topics.topicMatches(t, s):
-          # topic has retained publication
-          topicsUsed.append(s)
-          (ret_msg, ret_qos) = self.se.getRetained(s)
-          thisqos = min(ret_qos, qos[i])
-          self.__clients[aClientid].publishArrived(s, ret_msg, thisqos, True)
+      for s in self.se.getRetainedTopics(t): # s is a non-wildcard retained topic matching t
+        (ret_msg, ret_qos) = self.se.getRetained(s)
+        thisqos = min(ret_qos, qos[i])
+        self.__clients[aClientid].publishArrived(s, ret_msg, thisqos, True)
       i += 1
 
   def subscribe(self, aClientid, topic, qos):
@@ -0,0 +1,136 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+A hierarchical timer wheel, which the brokers schedule their time based work on: keepalive
+timeouts, will delays, session expiry and message expiry.
+
+Time is divided into ticks of precision seconds.  Each wheel has slots ticks slots, the
+first wheel's slots holding the timers due in each of the next slots ticks, the second
+wheel's the timers due in each of the next slots blocks of slots ticks, and so on.  When
+the first wheel has gone round once, the timers in the next slot of the second wheel are
+moved down to the first, and so for the higher wheels.  Adding and cancelling a timer
+takes constant time, as does each tick, apart from firing the timers which are due, so
+the cost doesn't depend on how many timers there are.  A timer fires up to precision
+seconds late, never early.
+"""
+
+import threading, time, math, logging
+
+logger = logging.getLogger('MQTT broker')
+
+
+class Timers:
+  "one scheduled action"
+
+  __slots__ = ["tick", "action", "args", "slot"]
+
+  def __init__(self, tick, action, args):
+    self.tick = tick # when to fire
+    self.action = action
+    self.args = args
+    self.slot = None # the set holding this timer, if it is waiting to fire
+
+
+class TimerWheels(threading.Thread):
+  "a thread which fires timers on a hierarchical wheel"
+
+  def __init__(self, precision=1.0, slots=64, wheels=4):
+    threading.Thread.__init__(self, name="timers", daemon=True)
+    self.precision = precision
+    self.slots = slots
+    self.wheels = [[set() for slot in range(slots)] for wheel in range(wheels)]
+    self.lock = threading.Lock()
+    self.started = time.monotonic()
+    self.tick = 0 # the next tick to do
+    self.stopped = threading.Event()
+    self.start()
+
+  def ticks(self, when):
+    "the tick at which a time (from time.monotonic) is due"
+    return math.ceil((when - self.started) / self.precision)
+
+  def schedule(self, delay, action, *args):
+    "call action(*args) in delay seconds, returning the timer so that it can be cancelled"
+    return self.scheduleAt(time.monotonic() + delay, action, *args)
+
+  def scheduleAt(self, when, action, *args):
+    "call action(*args) at a time from time.monotonic, returning the timer so that it can be cancelled"
+    timer = Timers(self.ticks(when), action, args)
+    with self.lock:
+      self.add(timer)
+    return timer
+
+  def cancel(self, timer):
+    with self.lock:
+      if timer.slot != None:
+        timer.slot.discard(timer)
+        timer.slot = None
+
+  def add(self, timer):
+    "put a timer in the slot for its tick, on the lowest wheel which reaches that far"
+    tick = max(timer.tick, self.tick) # if it is due already, fire it on the next tick
+    wheel = 0
+    span = 1 # the ticks each slot of the wheel covers
+    while tick - self.tick >= span * self.slots and wheel < len(self.wheels) - 1:
+      wheel += 1
+      span *= self.slots
+    timer.slot = self.wheels[wheel][(tick // span) % self.slots]
+    timer.slot.add(timer)
+
+  def advance(self):
+    "do the next tick, returning the timers now due"
+    span = 1
+    for wheel in range(1, len(self.wheels)):
+      span *= self.slots
+      if self.tick % span != 0:
+        break
+      # the wheel below has come round: move the timers in this block down
+      index = (self.tick // span) % self.slots
+      slot = self.wheels[wheel][index]
+      self.wheels[wheel][index] = set()
+      for timer in slot:
+        self.add(timer)
+    slot = self.wheels[0][self.tick % self.slots]
+    due = [timer for timer in slot if timer.tick <= self.tick]
+    for timer in due:
+      slot.discard(timer)
+      timer.slot = None
+    self.tick += 1
+    return due
+
+  def fire(self, now):
+    "fire the timers due by now"
+    last = math.floor((now - self.started) / self.precision)
+    while True:
+      with self.lock:
+        if self.tick > last:
+          break
+        due = self.advance()
+      for timer in due:
+        try:
+          timer.action(*timer.args)
+        except:
+          logger.exception("TimerWheels")
+
+  def run(self):
+    while not self.stopped.wait(self.precision):
+      self.fire(time.monotonic())
+
+  def stop(self):
+    self.stopped.set()
@@ -0,0 +1,55 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Precompiled topic filters, which match topic names level by level.
+
+Topic filters are validated when they are subscribed to, so no validation or
+logging is done here, and matching does not need regular expressions.
+"""
+
+class TopicMatchers:
+
+  def __init__(self, aFilter, sharedPrefix=True):
+    if sharedPrefix and aFilter.startswith('$share'):
+      # strip shared prefix $share/sharename/
+      assert aFilter.count('/') >= 2
+      aFilter = aFilter.split('/', 2)[2]
+    self.filter = aFilter
+    self.wildcards = aFilter.find('+') != -1 or aFilter.find('#') != -1
+    levels = aFilter.split('/')
+    self.hashed = levels[-1] == '#' # '#' matches its parent level and any following levels
+    if self.hashed:
+      levels = levels[:-1]
+    self.levels = levels
+
+  def matches(self, aTopicName):
+    if not self.wildcards:
+      return self.filter == aTopicName
+    topicLevels = aTopicName.split('/')
+    if len(topicLevels) < len(self.levels) or \
+       (not self.hashed and len(topicLevels) != len(self.levels)):
+      return False
+    for level, topicLevel in zip(self.levels, topicLevels):
+      if level == '+':
+        if topicLevel == "": # + does not match an empty level
+          return False
+      elif level != topicLevel:
+        return False
+    return True
+
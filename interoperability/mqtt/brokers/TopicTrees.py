@@ -0,0 +1,201 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Topic level trees used to index subscriptions, so that the subscriptions matching
+a topic can be found by walking the levels of the topic name, rather than comparing
+the topic against every subscription.  TopicNameTrees do the reverse for retained
+messages, finding the topic names which match a subscription's topic filter.
+
+The matching rules are the same as those of Topics.topicMatches, including:
+
+  - '+' matches exactly one non-empty level
+  - '#' matches its parent level and any number of following levels
+  - the '$share/sharename/' prefix of a shared subscription is ignored, as in the
+    MQTT V5 version of topicMatches
+"""
+
+class TopicNodes:
+
+  def __init__(self):
+    self.children = {}  # topic level -> TopicNodes
+    self.items = {}     # items whose filter ends at this node -> insertion sequence number
+    self.hashItems = {} # items whose filter ends with '#' following this node
+
+
+class TopicTrees:
+  """
+  An index of topic filters.  Each filter is associated with any number of items,
+  typically subscription objects.
+  """
+
+  def __init__(self, sharedPrefix=True):
+    self.sharedPrefix = sharedPrefix
+    self.root = TopicNodes()
+    self.sequence = 0 # used to return matches in the order they were added
+    self.count = 0
+
+  def levels(self, aFilter):
+    "split a topic filter into levels, removing any shared subscription prefix"
+    if self.sharedPrefix and aFilter.startswith('$share/'):
+      aFilter = aFilter.split('/', 2)[2]
+    return aFilter.split('/')
+
+  def add(self, aFilter, item):
+    node = self.root
+    levels = self.levels(aFilter)
+    if levels[-1] == '#':
+      levels = levels[:-1]
+      hashed = True
+    else:
+      hashed = False
+    for level in levels:
+      if level not in node.children:
+        node.children[level] = TopicNodes()
+      node = node.children[level]
+    items = node.hashItems if hashed else node.items
+    if item not in items:
+      self.sequence += 1
+      items[item] = self.sequence
+      self.count += 1
+
+  def remove(self, aFilter, item):
+    "remove an item, pruning any branches left empty.  Returns whether the item was found"
+    levels = self.levels(aFilter)
+    if levels[-1] == '#':
+      levels = levels[:-1]
+      hashed = True
+    else:
+      hashed = False
+    path = [self.root]
+    for level in levels:
+      if level not in path[-1].children:
+        return False
+      path.append(path[-1].children[level])
+    items = path[-1].hashItems if hashed else path[-1].items
+    if item not in items:
+      return False
+    del items[item]
+    self.count -= 1
+    for i in range(len(levels), 0, -1):
+      node = path[i]
+      if node.children or node.items or node.hashItems:
+        break
+      del path[i-1].children[levels[i-1]]
+    return True
+
+  def match(self, aTopic):
+    "return the items whose filters match a (non-wildcard) topic name, in the order they were added"
+    levels = aTopic.split('/')
+    last = len(levels)
+    found = {}
+    nodes = [(self.root, 0)]
+    while nodes:
+      node, depth = nodes.pop()
+      if node.hashItems:
+        found.update(node.hashItems)
+      if depth == last:
+        found.update(node.items)
+        continue
+      level = levels[depth]
+      child = node.children.get(level)
+      if child:
+        nodes.append((child, depth + 1))
+      if level != "": # + does not match an empty level
+        child = node.children.get('+')
+        if child:
+          nodes.append((child, depth + 1))
+    return sorted(found, key=found.get)
+
+  def __len__(self):
+    return self.count
+
+
+class TopicNameNodes:
+
+  def __init__(self):
+    self.children = {} # topic level -> TopicNameNodes
+    self.name = None   # the topic name ending at this node, if any
+    self.order = 0     # when the name was added, so that matches are returned in that order
+
+
+class TopicNameTrees:
+  """
+  An index of (non-wildcard) topic names, typically those with retained messages.
+  """
+
+  def __init__(self):
+    self.root = TopicNameNodes()
+    self.count = 0
+    self.added = 0 # names added so far, which numbers them in order
+
+  def add(self, aTopicName):
+    node = self.root
+    for level in aTopicName.split('/'):
+      if level not in node.children:
+        node.children[level] = TopicNameNodes()
+      node = node.children[level]
+    if node.name == None:
+      node.name = aTopicName
+      self.count += 1
+      self.added += 1
+      node.order = self.added
+
+  def remove(self, aTopicName):
+    "remove a topic name, pruning any branches left empty.  Returns whether the name was found"
+    levels = aTopicName.split('/')
+    path = [self.root]
+    for level in levels:
+      if level not in path[-1].children:
+        return False
+      path.append(path[-1].children[level])
+    if path[-1].name == None:
+      return False
+    path[-1].name = None
+    self.count -= 1
+    for i in range(len(levels), 0, -1):
+      node = path[i]
+      if node.children or node.name != None:
+        break
+      del path[i-1].children[levels[i-1]]
+    return True
+
+  def match(self, aFilter):
+    "return the topic names which match a topic filter, in the order they were added"
+    nodes = [self.root]
+    for level in aFilter.split('/'):
+      if level == '#':
+        # matches the parent level and all the levels below it
+        below = nodes
+        nodes = []
+        while below:
+          nodes.extend(below)
+          below = [child for node in below for child in node.children.values()]
+        break
+      elif level == '+': # + does not match an empty level
+        nodes = [child for node in nodes for childLevel, child in node.children.items() if childLevel != ""]
+      else:
+        nodes = [node.children[level] for node in nodes if level in node.children]
+      if not nodes:
+        break
+    nodes = [node for node in nodes if node.name != None]
+    nodes.sort(key=lambda node: node.order)
+    return [node.name for node in nodes]
+
+  def __len__(self):
+    return self.count
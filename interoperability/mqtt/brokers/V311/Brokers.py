@@ -22,12 +22,13 @@ from . import Topics
 from .SubscriptionEngines import SubscriptionEngines
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
  
 class Brokers:
 
-  def __init__(self, overlapping_single=True, sharedData={}):
+  def __init__(self, overlapping_single=True, sharedData={}, locks=None):
     self.sharedData = sharedData
-    self.se = SubscriptionEngines(self.sharedData)
+    self.se = SubscriptionEngines(self.sharedData, locks)
     self.__clients = {} # clientid -> client
     self.overlapping_single = overlapping_single
     self.__broker5 = None
@@ -43,12 +44,12 @@ class Brokers:
     return list(self.__clients.keys())
 
   def getClient(self, clientid):
-    return self.__clients[clientid] if (clientid in self.__clients.keys()) else None
+    return self.__clients.get(clientid) # one lookup, as connect and disconnect may change the clients meanwhile
 
   def cleanSession(self, aClientid):
     "clear any outstanding subscriptions and publications"
     if len(self.se.getRetainedTopics("#")) > 0:
-      logger.info("[MQTT-3.1.2-7] retained messages not cleaned up as part of session state for client %s", aClientid)
+      statements.info("[MQTT-3.1.2-7] retained messages not cleaned up as part of session state for client %s", aClientid)
     self.se.clearSubscriptions(aClientid)
 
   def connect(self, aClient):
@@ -65,12 +66,12 @@ class Brokers:
     "Abrupt disconnect which also causes a will msg to be sent out"
     if aClientid in self.__clients.keys() and self.__clients[aClientid].connected:
       if self.__clients[aClientid].will != None:
-        logger.info("[MQTT-3.1.2-8] sending will message for client %s", aClientid)
+        statements.info("[MQTT-3.1.2-8] sending will message for client %s", aClientid)
         willtopic, willQoS, willmsg, willRetain = self.__clients[aClientid].will
         if willRetain:
-          logger.info("[MQTT-3.1.2-17] sending will message retained for client %s", aClientid)
+          statements.info("[MQTT-3.1.2-17] sending will message retained for client %s", aClientid)
         else:
-          logger.info("[MQTT-3.1.2-16] sending will message non-retained for client %s", aClientid)
+          statements.info("[MQTT-3.1.2-16] sending will message non-retained for client %s", aClientid)
         self.publish(aClientid, willtopic, willmsg, willQoS, willRetain, time.monotonic())
       self.disconnect(aClientid)
 
@@ -78,18 +79,18 @@ class Brokers:
     if aClientid in self.__clients.keys():
       self.__clients[aClientid].connected = False
       if self.__clients[aClientid].cleansession:
-        logger.info("[MQTT-3.1.2-6] broker must discard the session data for client %s", aClientid)
+        statements.info("[MQTT-3.1.2-6] broker must discard the session data for client %s", aClientid)
         self.cleanSession(aClientid)
         del self.__clients[aClientid]
       else:
-        logger.info("[MQTT-3.1.2-4] broker must store the session data for client %s", aClientid)
+        statements.info("[MQTT-3.1.2-4] broker must store the session data for client %s", aClientid)
         try:
           self.__clients[aClientid].timestamp = time.clock() # time.clock is deprecated
         except:
           self.__clients[aClientid].timestamp = time.process_time()
         self.__clients[aClientid].connected = False 
-        logger.info("[MQTT-3.1.2-10] will message is deleted after use or disconnect, for client %s", aClientid)
-        logger.info("[MQTT-3.14.4-3] on receipt of disconnect, will message is deleted")
+        statements.info("[MQTT-3.1.2-10] will message is deleted after use or disconnect, for client %s", aClientid)
+        statements.info("[MQTT-3.14.4-3] on receipt of disconnect, will message is deleted")
         self.__clients[aClientid].will = None
 
   def disconnectAll(self):
@@ -101,30 +102,40 @@ class Brokers:
        also to any disconnected non-cleansession clients with qos in [1,2]
     """
     if retained:
-      logger.info("[MQTT-2.1.2-6] store retained message and QoS")
+      statements.info("[MQTT-2.1.2-6] store retained message and QoS")
       self.se.setRetained(topic, message, qos, receivedTime)
     else:
-      logger.info("[MQTT-2.1.2-12] non-retained message - do not store")
+      statements.info("[MQTT-2.1.2-12] non-retained message - do not store")
 
     for subscriber in self.se.subscribers(topic):  # all subscribed clients
       # qos is lower of publication and subscription
       if len(self.se.getSubscriptions(topic, subscriber)) > 1:
-        logger.info("[MQTT-3.3.5-1] overlapping subscriptions")
+        statements.info("[MQTT-3.3.5-1] overlapping subscriptions")
       if retained:
-        logger.info("[MQTT-2.1.2-10] outgoing publish does not have retained flag set")
-      if self.overlapping_single:   
-        out_qos = min(self.se.qosOf(subscriber, topic), qos)
-        if subscriber in self.__clients.keys(): 
-          self.__clients[subscriber].publishArrived(topic, message, out_qos)
+        statements.info("[MQTT-2.1.2-10] outgoing publish does not have retained flag set")
+      # without the sessions lock, the subscriber may have gone since its subscription was found
+      client = self.__clients.get(subscriber)
+      client5 = None
+      if client == None and self.__broker5 != None:
+        client5 = self.__broker5.getClient(subscriber) # an MQTT V5 subscription
+      if client == None and client5 == None:
+        continue
+      if self.overlapping_single:
+        subscriptionQoS = self.se.qosOf(subscriber, topic)
+        if subscriptionQoS == None:
+          continue # unsubscribed meanwhile
+        out_qos = min(subscriptionQoS, qos)
+        if client != None:
+          client.publishArrived(topic, message, out_qos)
         else:
-          self.__broker5.getClient(subscriber).publishArrived(topic, message, out_qos, None, None)
+          client5.publishArrived(topic, message, out_qos, None, None)
       else:
         for subscription in self.se.getSubscriptions(topic, subscriber):
           out_qos = min(subscription.getQoS(), qos)
-          if subscriber in self.__clients.keys():         
-            self.__clients[subscriber].publishArrived(topic, message, out_qos)
+          if client != None:
+            client.publishArrived(topic, message, out_qos)
           else:
-            self.__broker5.getClient(subscriber).publishArrived(topic, message, out_qos, None, None)
+            client5.publishArrived(topic, message, out_qos, None, None)
 
   def __doRetained__(self, aClientid, topic, qos):
     # topic can be single, or a list
@@ -133,19 +144,15 @@ class Brokers:
       qos = [qos]
     i = 0
     for t in topic: # t is a wildcard subscription topic
-      topicsUsed = []
-      for s in self.se.getRetainedTopics(t): # s is a non-wildcard retained topic
-        if s not in topicsUsed and Topics.topicMatches(t, s):
-          # topic has retained publication
-          topicsUsed.append(s)
-          retained_msg = self.se.getRetained(s)
-          if len(retained_msg) == 4:
-            #maybe we should add the v5 properties to the v3 payload?
-            (ret_msg, ret_qos, receivedTime, v5props) = retained_msg
-          else:
-            (ret_msg, ret_qos, receivedTime) = retained_msg
-          thisqos = min(ret_qos, qos[i])
-          self.__clients[aClientid].publishArrived(s, ret_msg, thisqos, retained=True)
+      for s in self.se.getRetainedTopics(t): # s is a non-wildcard retained topic matching t
+        retained_msg = self.se.getRetained(s)
+        if len(retained_msg) == 4:
+          #maybe we should add the v5 properties to the v3 payload?
+          (ret_msg, ret_qos, receivedTime, v5props) = retained_msg
+        else:
+          (ret_msg, ret_qos, receivedTime) = retained_msg
+        thisqos = min(ret_qos, qos[i])
+        self.__clients[aClientid].publishArrived(s, ret_msg, thisqos, retained=True)
       i += 1
 
   def subscribe(self, aClientid, topic, qos):
@@ -22,21 +22,69 @@ import traceback, random, sys, string, copy, threading, logging, socket, time, u
 from mqtt.formats import MQTTV311 as MQTTV3
 
 from .Brokers import Brokers
+from .. import OutboundQueues, MessageQueues
+from ..TimerWheels import TimerWheels
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 def respond(sock, packet):
-  packet_string = str(packet)
-  if len(packet_string) > 256:
-    packet_string = packet_string[:255] + '...' + (' payload length:' + str(len(packet.data)) if hasattr(packet, "data") else "")
-  logger.debug("out: (%d) %s", sock.fileno(), packet_string)
+  if logger.isEnabledFor(logging.DEBUG):
+    packet_string = str(packet)
+    if len(packet_string) > 256:
+      packet_string = packet_string[:255] + '...' + (' payload length:' + str(len(packet.data)) if hasattr(packet, "data") else "")
+    logger.debug("out: (%d) %s", sock.fileno(), packet_string)
   if hasattr(sock, "handlePacket"):
     sock.handlePacket(packet)
   else:
     try:
-      sock.send(packet.pack()) # Could get socket error on send
+      data = packet.pack()
     except:
-      pass
+      return
+
+    def send():
+      try:
+        sock.send(data) # Could get socket error on send
+      except:
+        pass
+
+    outbound = getattr(sock, "outbound", None)
+    if outbound != None:
+      outbound.put(send) # written once the broker locks have been released
+    else:
+      send()
+
+def close(sock):
+  "shut a connection once what has been written to it is sent, leaving its handler to end it"
+  def shutdown():
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except:
+      pass # doesn't matter if the socket has been closed at the other end already
+
+  outbound = getattr(sock, "outbound", None)
+  if outbound != None:
+    outbound.put(shutdown)
+  else:
+    shutdown()
+
+def closeSocket(sock):
+  "close a socket once what has been written to it is sent, outside the broker locks if it has an outbound queue"
+  def shutdown():
+    try:
+      sock.shutdown(socket.SHUT_RDWR) # must call shutdown to close socket immediately
+    except:
+      pass # doesn't matter if the socket has been closed at the other end already
+    try:
+      sock.close()
+    except:
+      pass # doesn't matter if the socket has been closed at the other end already
+
+  outbound = getattr(sock, "outbound", None)
+  if outbound != None:
+    outbound.put(shutdown) # written by the next flush, which the broker does once it holds no locks
+  else:
+    shutdown()
 
 class MQTTClients:
 
@@ -44,118 +92,140 @@ class MQTTClients:
     self.id = anId # required
     self.cleansession = cleansession
     self.socket = socket
+    self.lock = threading.RLock() # for the outbound messages, which other clients' publishes add to
     self.msgid = 1
-    self.outbound = [] # message objects - for ordering
-    self.outmsgs = {} # msgids to message objects
+    self.queued = MessageQueues.MessageQueues(broker.queueLimits) # message objects waiting to be sent
+    self.outbound = {} # msgids to message objects sent but not yet completed, in the order sent
     self.broker = broker
     if broker.publish_on_pubrel:
       self.inbound = {} # stored inbound QoS 2 publications
     else:
-      self.inbound = []
+      self.inbound = set() # the packet ids of inbound QoS 2 publications
     self.connected = False
     self.will = None
     self.keepalive = keepalive
     self.lastPacket = None
+    self.keepaliveTimer = None
 
   def resend(self):
-    logger.debug("resending unfinished publications %s", str(self.outbound))
-    if len(self.outbound) > 0:
-      logger.info("[MQTT-4.4.0-1] resending inflight QoS 1 and 2 messages")
-    for pub in self.outbound:
-      logger.debug("resending "+str(pub))
-      logger.info("[MQTT-4.4.0-2] dup flag must be set on in re-publish")
-      if pub.fh.QoS == 0:
-        respond(self.socket, pub)
-      elif pub.fh.QoS == 1:
-        pub.fh.DUP = 1
-        logger.info("[MQTT-2.1.2-3] Dup when resending QoS 1 publish id %d", pub.messageIdentifier)
-        logger.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
-        logger.info("[MQTT-4.3.2-1] Resending QoS 1 with DUP flag")
-        respond(self.socket, pub)
-      elif pub.fh.QoS == 2:
-        if pub.qos2state == "PUBREC":
-          logger.info("[MQTT-2.1.2-3] Dup when resending QoS 2 publish id %d", pub.messageIdentifier)
+    with self.lock:
+      logger.debug("resending unfinished publications %s", str(self.outbound))
+      if len(self.outbound) > 0:
+        statements.info("[MQTT-4.4.0-1] resending inflight QoS 1 and 2 messages")
+      for pub in self.outbound.values():
+        logger.debug("resending "+str(pub))
+        statements.info("[MQTT-4.4.0-2] dup flag must be set on in re-publish")
+        if pub.fh.QoS == 0:
+          respond(self.socket, pub)
+        elif pub.fh.QoS == 1:
           pub.fh.DUP = 1
-          logger.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
-          logger.info("[MQTT-4.3.3-1] Resending QoS 2 with DUP flag")
+          statements.info("[MQTT-2.1.2-3] Dup when resending QoS 1 publish id %d", pub.messageIdentifier)
+          statements.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
+          statements.info("[MQTT-4.3.2-1] Resending QoS 1 with DUP flag")
           respond(self.socket, pub)
-        else:
-          resp = MQTTV3.Pubrels()
-          logger.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
-          resp.messageIdentifier = pub.messageIdentifier
-          respond(self.socket, resp)
-
-  def publishArrived(self, topic, msg, qos, retained=False):
-    pub = MQTTV3.Publishes()
-    logger.info("[MQTT-3.2.3-3] topic name must match the subscription's topic filter")
-    pub.topicName = topic
-    pub.data = msg
-    pub.fh.QoS = qos
-    pub.fh.RETAIN = retained
-    if retained:
-      logger.info("[MQTT-2.1.2-7] Last retained message on matching topics sent on subscribe")
-    if pub.fh.RETAIN:
-      logger.info("[MQTT-2.1.2-9] Set retained flag on retained messages")
-    if qos == 2:
-      pub.qos2state = "PUBREC"
-    if qos in [1, 2]:
+        elif pub.fh.QoS == 2:
+          if pub.qos2state == "PUBREC":
+            statements.info("[MQTT-2.1.2-3] Dup when resending QoS 2 publish id %d", pub.messageIdentifier)
+            pub.fh.DUP = 1
+            statements.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
+            statements.info("[MQTT-4.3.3-1] Resending QoS 2 with DUP flag")
+            respond(self.socket, pub)
+          else:
+            resp = MQTTV3.Pubrels()
+            statements.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
+            resp.messageIdentifier = pub.messageIdentifier
+            respond(self.socket, resp)
+      self.sendQueued()
+
+  def sendFirst(self, pub):
+    if pub.fh.QoS in [1, 2]:
       pub.messageIdentifier = self.msgid
       logger.debug("client id: %s msgid: %d", self.id, self.msgid)
       if self.msgid == 65535:
         self.msgid = 1
       else:
         self.msgid += 1
-      self.outbound.append(pub)
-      self.outmsgs[pub.messageIdentifier] = pub
-    logger.info("[MQTT-4.6.0-6] publish packets must be sent in order of receipt from any given client")
-    if self.connected:
-      respond(self.socket, pub)
-    else:
-      if qos == 0 and not self.broker.dropQoS0:
-        self.outbound.append(pub)
-      if qos in [1, 2]:
-        logger.info("[MQTT-3.1.2-5] storing of QoS 1 and 2 messages for disconnected client %s", self.id)
+      self.outbound[pub.messageIdentifier] = pub
+    statements.info("[MQTT-4.6.0-6] publish packets must be sent in order of receipt from any given client")
+    respond(self.socket, pub)
+
+  def sendQueued(self):
+    with self.lock:
+      while len(self.queued) > 0 and self.connected:
+        self.sendFirst(self.queued.popleft())
+
+  def publishArrived(self, topic, msg, qos, retained=False):
+    with self.lock:
+      pub = MQTTV3.Publishes()
+      statements.info("[MQTT-3.2.3-3] topic name must match the subscription's topic filter")
+      pub.topicName = topic
+      pub.data = msg
+      pub.fh.QoS = qos
+      pub.fh.RETAIN = retained
+      if retained:
+        statements.info("[MQTT-2.1.2-7] Last retained message on matching topics sent on subscribe")
+      if pub.fh.RETAIN:
+        statements.info("[MQTT-2.1.2-9] Set retained flag on retained messages")
+      if qos == 2:
+        pub.qos2state = "PUBREC"
+      if self.connected and len(self.queued) == 0:
+        self.sendFirst(pub)
+      else:
+        if qos in [1, 2] or not self.broker.dropQoS0:
+          if type(msg) == memoryview: # from an MQTT V5 client, and not otherwise kept
+            pub.data = bytes(msg)
+          if not self.queued.append(pub) and self.connected:
+            self.quotaExceeded()
+        if qos in [1, 2]:
+          statements.info("[MQTT-3.1.2-5] storing of QoS 1 and 2 messages for disconnected client %s", self.id)
+
+  def quotaExceeded(self):
+    "disconnect a client whose queue is full, for the disconnect overflow policy"
+    logger.info("Disconnecting client %s because its message queue is full", self.id)
+    self.queued.disconnected()
+    close(self.socket)
 
   def puback(self, msgid):
-    if msgid in self.outmsgs.keys():
-      pub = self.outmsgs[msgid]
-      if pub.fh.QoS == 1:
-        self.outbound.remove(pub)
-        del self.outmsgs[msgid]
+    with self.lock:
+      if msgid in self.outbound:
+        pub = self.outbound[msgid]
+        if pub.fh.QoS == 1:
+          del self.outbound[msgid]
+        else:
+          logger.error("%s: Puback received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
       else:
-        logger.error("%s: Puback received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
-    else:
-      logger.error("%s: Puback received for msgid %d, but no message found", self.id, msgid)
+        logger.error("%s: Puback received for msgid %d, but no message found", self.id, msgid)
 
   def pubrec(self, msgid):
-    rc = False
-    if msgid in self.outmsgs.keys():
-      pub = self.outmsgs[msgid]
-      if pub.fh.QoS == 2:
-        if pub.qos2state == "PUBREC":
-          pub.qos2state = "PUBCOMP"
-          rc = True
+    with self.lock:
+      rc = False
+      if msgid in self.outbound:
+        pub = self.outbound[msgid]
+        if pub.fh.QoS == 2:
+          if pub.qos2state == "PUBREC":
+            pub.qos2state = "PUBCOMP"
+            rc = True
+          else:
+            logger.error("%s: Pubrec received for msgid %d, but message in wrong state", self.id, msgid)
         else:
-          logger.error("%s: Pubrec received for msgid %d, but message in wrong state", self.id, msgid)
+          logger.error("%s: Pubrec received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
       else:
-        logger.error("%s: Pubrec received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
-    else:
-      logger.error("%s: Pubrec received for msgid %d, but no message found", self.id, msgid)
-    return rc
+        logger.error("%s: Pubrec received for msgid %d, but no message found", self.id, msgid)
+      return rc
 
   def pubcomp(self, msgid):
-    if msgid in self.outmsgs.keys():
-      pub = self.outmsgs[msgid]
-      if pub.fh.QoS == 2:
-        if pub.qos2state == "PUBCOMP":
-          self.outbound.remove(pub)
-          del self.outmsgs[msgid]
+    with self.lock:
+      if msgid in self.outbound:
+        pub = self.outbound[msgid]
+        if pub.fh.QoS == 2:
+          if pub.qos2state == "PUBCOMP":
+            del self.outbound[msgid]
+          else:
+            logger.error("Pubcomp received for msgid %d, but message in wrong state", msgid)
         else:
-          logger.error("Pubcomp received for msgid %d, but message in wrong state", msgid)
+          logger.error("Pubcomp received for msgid %d, but QoS is %d", msgid, pub.fh.QoS)
       else:
-        logger.error("Pubcomp received for msgid %d, but QoS is %d", msgid, pub.fh.QoS)
-    else:
-      logger.error("Pubcomp received for msgid %d, but no message found", msgid)
+        logger.error("Pubcomp received for msgid %d, but no message found", msgid)
 
   def pubrel(self, msgid):
     rc = None
@@ -175,12 +245,14 @@ class MQTTClients:
 
 class MQTTBrokers:
 
-  def __init__(self, options={}, lock=None, sharedData={}):
+  def __init__(self, options={}, lock=None, sharedData={}, locks=None, queueLimits=None, timers=None):
 
     defaults = {"publish_on_pubrel":True,
       "overlapping_single":True,
       "dropQoS0":True,
-      "zero_length_clientids":True}
+      "zero_length_clientids":True,
+      "concurrency":"single",
+      "timerPrecision":1.0}
 
     for key in defaults.keys():
       if key not in options.keys():
@@ -190,8 +262,13 @@ class MQTTBrokers:
     for key in options.keys():
       setattr(self, key, options[key])
 
-    self.broker = Brokers(self.overlapping_single, sharedData=sharedData)
+    self.broker = Brokers(self.overlapping_single, sharedData=sharedData, locks=locks)
+    # limits on the messages queued for clients, which may be shared with the MQTT V5 broker
+    self.queueLimits = queueLimits if queueLimits != None else MessageQueues.QueueLimits(options)
+    # the keepalive timers, which may be shared with the MQTT V5 broker
+    self.timers = timers if timers != None else TimerWheels(self.timerPrecision)
     self.clients = {}   # socket -> clients
+    self.sockets = {}   # clientid -> socket, for the connected clients
     if lock:
       logger.info("Using shared lock %d", id(lock))
       self.lock = lock
@@ -206,6 +283,7 @@ class MQTTBrokers:
 
   def shutdown(self):
     self.disconnectAll()
+    self.timers.stop()
 
   def setBroker5(self, broker5):
     self.broker.setBroker5(broker5.broker)
@@ -213,11 +291,14 @@ class MQTTBrokers:
   def reinitialize(self):
     logger.info("Reinitializing broker")
     self.clients = {}
+    self.sockets = {}
     self.broker.reinitialize()
 
   def handleRequest(self, sock):
     "this is going to be called from multiple threads, so synchronize"
-    self.lock.acquire()
+    single = self.concurrency == "single"
+    if single:
+      self.lock.acquire()
     terminate = False
     raw_packet = None
     try:
@@ -226,7 +307,7 @@ class MQTTBrokers:
       except:
         pass # handled by raw_packet == None
       if raw_packet == None:
-        logger.info("[MQTT-4.8.0-1] 'transient error' reading packet, closing connection")
+        statements.info("[MQTT-4.8.0-1] 'transient error' reading packet, closing connection")
         # will message
         self.disconnect(sock, None, terminate=True)
         terminate = True
@@ -237,104 +318,117 @@ class MQTTBrokers:
         else:
           raise MQTTV3.MQTTException("[MQTT-2.0.0-1] handleRequest: badly formed MQTT packet")
     finally:
-      self.lock.release()
+      if single:
+        self.lock.release()
+      OutboundQueues.flush()
     return terminate
 
   def handlePacket(self, packet, sock):
     terminate = False
-    packet_string = str(packet)
-    if len(packet_string) > 256:
-      packet_string = packet_string[:255] + '...' + (' payload length:' + str(len(packet.data)) if hasattr(packet, "data") else "")
-    logger.debug("in: (%d) %s", sock.fileno(), packet_string)
+    if logger.isEnabledFor(logging.DEBUG):
+      packet_string = str(packet)
+      if len(packet_string) > 256:
+        packet_string = packet_string[:255] + '...' + (' payload length:' + str(len(packet.data)) if hasattr(packet, "data") else "")
+      logger.debug("in: (%d) %s", sock.fileno(), packet_string)
     if sock not in self.clients.keys() and packet.fh.MessageType != MQTTV3.CONNECT:
       self.disconnect(sock, packet)
       raise MQTTV3.MQTTException("[MQTT-3.1.0-1] Connect was not first packet on socket")
     else:
       getattr(self, MQTTV3.packetNames[packet.fh.MessageType].lower())(sock, packet)
       if sock in self.clients.keys():
-        self.clients[sock].lastPacket = time.time()
+        self.clients[sock].lastPacket = time.monotonic()
     if packet.fh.MessageType == MQTTV3.DISCONNECT:
       terminate = True
     return terminate
 
   def connect(self, sock, packet):
-    if packet.ProtocolName != "MQTT":
-      self.disconnect(sock, None)
-      raise MQTTV3.MQTTException("[MQTT-3.1.2-1] Wrong protocol name %s" % packet.ProtocolName)
-    if packet.ProtocolVersion != 4:
-      logger.error("[MQTT-3.1.2-2] Wrong protocol version %d", packet.ProtocolVersion)
-      resp = MQTTV3.Connacks()
-      resp.returnCode = 1
-      respond(sock, resp)
-      logger.info("[MQTT-3.2.2-5] must close connection after non-zero connack")
-      self.disconnect(sock, None)
-      logger.info("[MQTT-3.1.4-5] When rejecting connect, no more data must be processed")
-      return
-    if sock in self.clients.keys():    # is socket is already connected?
-      self.disconnect(sock, None)
-      logger.info("[MQTT-3.1.4-5] When rejecting connect, no more data must be processed")
-      raise MQTTV3.MQTTException("[MQTT-3.1.0-2] Second connect packet")
-    if len(packet.ClientIdentifier) == 0:
-      if self.zero_length_clientids == False or packet.CleanSession == False:
-        if self.zero_length_clientids:
-          logger.info("[MQTT-3.1.3-8] Reject 0-length clientid with cleansession false")
-        logger.info("[MQTT-3.1.3-9] if clientid is rejected, must send connack 2 and close connection")
+    with self.lock:
+      if packet.ProtocolName != "MQTT":
+        self.disconnect(sock, None)
+        raise MQTTV3.MQTTException("[MQTT-3.1.2-1] Wrong protocol name %s" % packet.ProtocolName)
+      if packet.ProtocolVersion != 4:
+        logger.error("[MQTT-3.1.2-2] Wrong protocol version %d", packet.ProtocolVersion)
         resp = MQTTV3.Connacks()
-        resp.returnCode = 2
+        resp.returnCode = 1
         respond(sock, resp)
-        logger.info("[MQTT-3.2.2-5] must close connection after non-zero connack")
+        statements.info("[MQTT-3.2.2-5] must close connection after non-zero connack")
         self.disconnect(sock, None)
-        logger.info("[MQTT-3.1.4-5] When rejecting connect, no more data must be processed")
+        statements.info("[MQTT-3.1.4-5] When rejecting connect, no more data must be processed")
         return
+      if sock in self.clients.keys():    # is socket is already connected?
+        self.disconnect(sock, None)
+        statements.info("[MQTT-3.1.4-5] When rejecting connect, no more data must be processed")
+        raise MQTTV3.MQTTException("[MQTT-3.1.0-2] Second connect packet")
+      if len(packet.ClientIdentifier) == 0:
+        if self.zero_length_clientids == False or packet.CleanSession == False:
+          if self.zero_length_clientids:
+            statements.info("[MQTT-3.1.3-8] Reject 0-length clientid with cleansession false")
+          statements.info("[MQTT-3.1.3-9] if clientid is rejected, must send connack 2 and close connection")
+          resp = MQTTV3.Connacks()
+          resp.returnCode = 2
+          respond(sock, resp)
+          statements.info("[MQTT-3.2.2-5] must close connection after non-zero connack")
+          self.disconnect(sock, None)
+          statements.info("[MQTT-3.1.4-5] When rejecting connect, no more data must be processed")
+          return
+        else:
+          statements.info("[MQTT-3.1.3-7] 0-length clientid must have cleansession true")
+          packet.ClientIdentifier = uuid.uuid4() # give the client a unique clientid
+          statements.info("[MQTT-3.1.3-6] 0-length clientid must be assigned a unique id %s", packet.ClientIdentifier)
+      statements.info("[MQTT-3.1.3-5] Clientids of 1 to 23 chars and ascii alphanumeric must be allowed")
+      if packet.ClientIdentifier in self.sockets: # is this client already connected on a different socket?
+        statements.info("[MQTT-3.1.4-2] Disconnecting old client %s", packet.ClientIdentifier)
+        self.disconnect(self.sockets[packet.ClientIdentifier], None)
+      me = None
+      if not packet.CleanSession:
+        me = self.broker.getClient(packet.ClientIdentifier) # find existing state, if there is any
+        if me:
+          statements.info("[MQTT-3.1.3-2] clientid used to retrieve client state")
+      resp = MQTTV3.Connacks()
+      resp.flags = 0x01 if me else 0x00
+      if me == None:
+        old = self.broker.getClient(packet.ClientIdentifier)
+        if old != None:
+          old.queued.clear() # the session being replaced
+        me = MQTTClients(packet.ClientIdentifier, packet.CleanSession, packet.KeepAliveTimer, sock, self)
       else:
-        logger.info("[MQTT-3.1.3-7] 0-length clientid must have cleansession true")
-        packet.ClientIdentifier = uuid.uuid4() # give the client a unique clientid
-        logger.info("[MQTT-3.1.3-6] 0-length clientid must be assigned a unique id %s", packet.ClientIdentifier)
-    logger.info("[MQTT-3.1.3-5] Clientids of 1 to 23 chars and ascii alphanumeric must be allowed")
-    if packet.ClientIdentifier in [client.id for client in self.clients.values()]: # is this client already connected on a different socket?
-      for s in self.clients.keys():
-        if self.clients[s].id == packet.ClientIdentifier:
-          logger.info("[MQTT-3.1.4-2] Disconnecting old client %s", packet.ClientIdentifier)
-          self.disconnect(s, None)
-          break
-    me = None
-    if not packet.CleanSession:
-      me = self.broker.getClient(packet.ClientIdentifier) # find existing state, if there is any
-      if me:
-        logger.info("[MQTT-3.1.3-2] clientid used to retrieve client state")
-    resp = MQTTV3.Connacks()
-    resp.flags = 0x01 if me else 0x00
-    if me == None:
-      me = MQTTClients(packet.ClientIdentifier, packet.CleanSession, packet.KeepAliveTimer, sock, self)
-    else:
-      me.socket = sock # set existing client state to new socket
-      me.cleansession = packet.CleanSession
-      me.keepalive = packet.KeepAliveTimer
-    logger.info("[MQTT-4.1.0-1] server must store data for at least as long as the network connection lasts")
-    self.clients[sock] = me
-    me.will = (packet.WillTopic, packet.WillQoS, packet.WillMessage, packet.WillRETAIN) if packet.WillFlag else None
-    self.broker.connect(me)
-    logger.info("[MQTT-3.2.0-1] the first response to a client must be a connack")
-    resp.returnCode = 0
-    respond(sock, resp)
-    me.resend()
+        me.socket = sock # set existing client state to new socket
+        me.cleansession = packet.CleanSession
+        me.keepalive = packet.KeepAliveTimer
+      statements.info("[MQTT-4.1.0-1] server must store data for at least as long as the network connection lasts")
+      if self.concurrency == "fine":
+        OutboundQueues.attach(sock)
+      self.clients[sock] = me
+      self.sockets[me.id] = sock
+      me.will = (packet.WillTopic, packet.WillQoS, packet.WillMessage, packet.WillRETAIN) if packet.WillFlag else None
+      self.broker.connect(me)
+      if me.keepalive > 0:
+        me.lastPacket = time.monotonic()
+        due = me.lastPacket + me.keepalive * 1.5
+        me.keepaliveTimer = self.timers.scheduleAt(due, self.keepaliveTimeout, me, due)
+      statements.info("[MQTT-3.2.0-1] the first response to a client must be a connack")
+      resp.returnCode = 0
+      respond(sock, resp)
+      me.resend()
 
   def disconnect(self, sock, packet, terminate=False):
-    logger.info("[MQTT-3.14.4-2] Client must not send any more packets after disconnect")
-    if sock in self.clients.keys():
-      if terminate:
-        self.broker.terminate(self.clients[sock].id)
-      else:
-        self.broker.disconnect(self.clients[sock].id)
-      del self.clients[sock]
-    try:
-      sock.shutdown(socket.SHUT_RDWR) # must call shutdown to close socket immediately
-    except:
-      pass # doesn't matter if the socket has been closed at the other end already
-    try:
-      sock.close()
-    except:
-      pass # doesn't matter if the socket has been closed at the other end already
+    with self.lock:
+      statements.info("[MQTT-3.14.4-2] Client must not send any more packets after disconnect")
+      if sock in self.clients.keys():
+        if self.clients[sock].keepaliveTimer != None:
+          self.timers.cancel(self.clients[sock].keepaliveTimer)
+          self.clients[sock].keepaliveTimer = None
+        if terminate:
+          self.broker.terminate(self.clients[sock].id)
+        else:
+          self.broker.disconnect(self.clients[sock].id)
+        if self.clients[sock].cleansession:
+          self.clients[sock].queued.clear()
+        if self.sockets.get(self.clients[sock].id) is sock:
+          del self.sockets[self.clients[sock].id]
+        del self.clients[sock]
+    # a slow or full socket mustn't hold up the other clients' connects and disconnects
+    closeSocket(sock)
 
   def disconnectAll(self):
     while len(self.clients.keys()) > 0:
@@ -342,6 +436,7 @@ class MQTTBrokers:
       print("disconnecting", sock)
       self.disconnect(sock, None)
       print("disconnected", sock)
+    OutboundQueues.flush()
 
   def subscribe(self, sock, packet):
     topics = []
@@ -362,22 +457,22 @@ class MQTTBrokers:
     if len(topics) > 0:
       self.broker.subscribe(self.clients[sock].id, topics, qoss)
     resp = MQTTV3.Subacks()
-    logger.info("[MQTT-2.3.1-7][MQTT-3.8.4-2] Suback has same message id as subscribe")
-    logger.info("[MQTT-3.8.4-1] Must respond with suback")
+    statements.info("[MQTT-2.3.1-7][MQTT-3.8.4-2] Suback has same message id as subscribe")
+    statements.info("[MQTT-3.8.4-1] Must respond with suback")
     resp.messageIdentifier = packet.messageIdentifier
-    logger.info("[MQTT-3.8.4-5] return code must be returned for each topic in subscribe")
-    logger.info("[MQTT-3.9.3-1] the order of return codes must match order of topics in subscribe")
+    statements.info("[MQTT-3.8.4-5] return code must be returned for each topic in subscribe")
+    statements.info("[MQTT-3.9.3-1] the order of return codes must match order of topics in subscribe")
     resp.data = respqoss
     respond(sock, resp)
 
   def unsubscribe(self, sock, packet):
     self.broker.unsubscribe(self.clients[sock].id, packet.data)
     resp = MQTTV3.Unsubacks()
-    logger.info("[MQTT-2.3.1-7] Unsuback has same message id as unsubscribe")
-    logger.info("[MQTT-3.10.4-4] Unsuback must be sent - same message id as unsubscribe")
+    statements.info("[MQTT-2.3.1-7] Unsuback has same message id as unsubscribe")
+    statements.info("[MQTT-3.10.4-4] Unsuback must be sent - same message id as unsubscribe")
     me = self.clients[sock]
     if len(me.outbound) > 0:
-      logger.info("[MQTT-3.10.4-3] sending unsuback has no effect on outward inflight messages")
+      statements.info("[MQTT-3.10.4-3] sending unsuback has no effect on outward inflight messages")
     resp.messageIdentifier = packet.messageIdentifier
     respond(sock, resp)
 
@@ -390,12 +485,12 @@ class MQTTBrokers:
              packet.topicName, packet.data, packet.fh.QoS, packet.fh.RETAIN, packet.receivedTime)
     elif packet.fh.QoS == 1:
       if packet.fh.DUP:
-        logger.info("[MQTT-3.3.1-3] Incoming publish DUP 1 ==> outgoing publish with DUP 0")
-        logger.info("[MQTT-4.3.2-2] server must store message in accordance with QoS 1")
+        statements.info("[MQTT-3.3.1-3] Incoming publish DUP 1 ==> outgoing publish with DUP 0")
+        statements.info("[MQTT-4.3.2-2] server must store message in accordance with QoS 1")
       self.broker.publish(self.clients[sock].id,
              packet.topicName, packet.data, packet.fh.QoS, packet.fh.RETAIN, packet.receivedTime)
       resp = MQTTV3.Pubacks()
-      logger.info("[MQTT-2.3.1-6] puback messge id same as publish")
+      statements.info("[MQTT-2.3.1-6] puback messge id same as publish")
       resp.messageIdentifier = packet.messageIdentifier
       respond(sock, resp)
     elif packet.fh.QoS == 2:
@@ -405,7 +500,7 @@ class MQTTBrokers:
           if packet.fh.DUP == 0:
             logger.error("[MQTT-3.3.1-2] duplicate QoS 2 message id %d found with DUP 0", packet.messageIdentifier)
           else:
-            logger.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
+            statements.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
         else:
           myclient.inbound[packet.messageIdentifier] = packet
       else:
@@ -413,14 +508,14 @@ class MQTTBrokers:
           if packet.fh.DUP == 0:
             logger.error("[MQTT-3.3.1-2] duplicate QoS 2 message id %d found with DUP 0", packet.messageIdentifier)
           else:
-            logger.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
+            statements.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
         else:
-          myclient.inbound.append(packet.messageIdentifier)
-          logger.info("[MQTT-4.3.3-2] server must store message in accordance with QoS 2")
+          myclient.inbound.add(packet.messageIdentifier)
+          statements.info("[MQTT-4.3.3-2] server must store message in accordance with QoS 2")
           self.broker.publish(myclient, packet.topicName, packet.data, packet.fh.QoS, packet.fh.RETAIN,
                       packet.receivedTime)
       resp = MQTTV3.Pubrecs()
-      logger.info("[MQTT-2.3.1-6] pubrec messge id same as publish")
+      statements.info("[MQTT-2.3.1-6] pubrec messge id same as publish")
       resp.messageIdentifier = packet.messageIdentifier
       respond(sock, resp)
 
@@ -434,13 +529,13 @@ class MQTTBrokers:
       else:
         myclient.inbound.remove(packet.messageIdentifier)
     resp = MQTTV3.Pubcomps()
-    logger.info("[MQTT-2.3.1-6] pubcomp messge id same as publish")
+    statements.info("[MQTT-2.3.1-6] pubcomp messge id same as publish")
     resp.messageIdentifier = packet.messageIdentifier
     respond(sock, resp)
 
   def pingreq(self, sock, packet):
     resp = MQTTV3.Pingresps()
-    logger.info("[MQTT-3.12.4-1] sending pingresp in response to pingreq")
+    statements.info("[MQTT-3.12.4-1] sending pingresp in response to pingreq")
     respond(sock, resp)
 
   def puback(self, sock, packet):
@@ -451,7 +546,7 @@ class MQTTBrokers:
     "confirmed reception of qos 2"
     myclient = self.clients[sock]
     if myclient.pubrec(packet.messageIdentifier):
-      logger.info("[MQTT-3.5.4-1] must reply with pubrel in response to pubrec")
+      statements.info("[MQTT-3.5.4-1] must reply with pubrel in response to pubrec")
       resp = MQTTV3.Pubrels()
       resp.messageIdentifier = packet.messageIdentifier
       respond(sock, resp)
@@ -460,10 +555,13 @@ class MQTTBrokers:
     "confirmed reception of qos 2"
     self.clients[sock].pubcomp(packet.messageIdentifier)
 
-  def keepalive(self, sock):
-    if sock in self.clients.keys():
-      client = self.clients[sock]
-      if client.keepalive > 0 and time.time() - client.lastPacket > client.keepalive * 1.5:
-        # keep alive timeout
-        logger.info("[MQTT-3.1.2-22] keepalive timeout for client %s", client.id)
-        self.disconnect(sock, None, terminate=True)
+  def keepaliveTimeout(self, client, due):
+    "a client's keepalive timer, due at due, has fired: close its connection if nothing has arrived since"
+    if client.connected and self.clients.get(client.socket) is client:
+      if client.lastPacket + client.keepalive * 1.5 > due:
+        due = client.lastPacket + client.keepalive * 1.5
+        client.keepaliveTimer = self.timers.scheduleAt(due, self.keepaliveTimeout, client, due)
+      else:
+        statements.info("[MQTT-3.1.2-22] keepalive timeout for client %s", client.id)
+        close(client.socket) # its handler then disconnects it, sending the will message
+        OutboundQueues.flush()
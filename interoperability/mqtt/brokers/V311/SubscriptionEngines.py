@@ -16,24 +16,39 @@
 *******************************************************************
 """
 
-import types, logging
+import types, logging, threading
 
 from . import Topics, Subscriptions
+from ..TopicTrees import TopicTrees, TopicNameTrees
 
 from .Subscriptions import *
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
  
 class SubscriptionEngines:
 
-   def __init__(self, sharedData={}):
+   def __init__(self, sharedData={}, locks=None):
      self.sharedData = sharedData
+     if locks == None:
+       locks = {"subscriptions": threading.RLock(), "retained": threading.RLock()}
+     # locks can't be persisted with the shared data, so engines sharing it are given the same locks
+     self.__locks = locks
+     self.__subscriptionsLock = locks["subscriptions"]
+     self.__retainedLock = locks["retained"]
      if "subscriptions" not in self.sharedData:
-       self.sharedData["subscriptions"] = []  # list of subscriptions
+       self.sharedData["subscriptions"] = {}  # map of clientids to maps of topic filters to subscriptions
      else:
        logger.info("Sharing subscription data")
      if "dollar_subscriptions" not in self.sharedData:
-       self.sharedData["dollar_subscriptions"] = []  # list of subscriptions
+       self.sharedData["dollar_subscriptions"] = {}  # map of clientids to maps of topic filters to subscriptions
+     for name in ["subscriptions", "dollar_subscriptions"]:
+       if type(self.sharedData[name]) == type([]):
+         # persisted as a list of subscriptions, so index it by clientid and topic filter
+         clients = {}
+         for s in self.sharedData[name]:
+           clients.setdefault(s.getClientid(), {})[s.getTopic()] = s
+         self.sharedData[name] = clients
      self.__subscriptions = self.sharedData["subscriptions"] 
      self.__dollar_subscriptions = self.sharedData["dollar_subscriptions"] 
      if "retained" not in self.sharedData:
@@ -41,135 +56,172 @@ class SubscriptionEngines:
      self.__retained = self.sharedData["retained"]
      if "dollar_retained" not in self.sharedData:
        self.sharedData["dollar_retained"] = {}  # map of topics to retained msg+qos
-     self.__dollar_retained = self.sharedData["dollar_retained"]  
+     self.__dollar_retained = self.sharedData["dollar_retained"]
+     if "subscription_trees" not in self.sharedData:
+       # index of topic filters, rebuilt from the subscriptions if they were persisted without it
+       self.sharedData["subscription_trees"] = {}
+       for name in ["subscriptions", "dollar_subscriptions"]:
+         # only MQTT V5 shared subscriptions, which are never $ topics, have a $share prefix
+         tree = TopicTrees(sharedPrefix=(name == "subscriptions"))
+         self.sharedData["subscription_trees"][name] = tree
+         for clientSubscriptions in self.sharedData[name].values():
+           for s in clientSubscriptions.values():
+             tree.add(s.getTopic(), s)
+     self.__tree = self.sharedData["subscription_trees"]["subscriptions"]
+     self.__dollar_tree = self.sharedData["subscription_trees"]["dollar_subscriptions"]
+     if "retained_trees" not in self.sharedData:
+       # index of retained topic names, rebuilt from the retained messages if they were persisted without it
+       self.sharedData["retained_trees"] = {}
+       for name in ["retained", "dollar_retained"]:
+         tree = TopicNameTrees()
+         self.sharedData["retained_trees"][name] = tree
+         for topicName in self.sharedData[name].keys():
+           tree.add(topicName)
+     self.__retained_tree = self.sharedData["retained_trees"]["retained"]
+     self.__dollar_retained_tree = self.sharedData["retained_trees"]["dollar_retained"]
 
    def reinitialize(self):
-     self.__init__()
+     self.__init__(locks=self.__locks)
 
    def subscribe(self, aClientid, topic, qos):
-     if type(topic) == type([]):
-       rc = []
-       count = 0
-       for aTopic in topic:
-         rc.append(self.__subscribe(aClientid, aTopic, qos[count]))
-         count += 1
-       if count > 1:
-         logger.info("[MQTT-3.8.4-4] Multiple topics in one subscribe")
-     else:
-       rc = self.__subscribe(aClientid, topic, qos)
-     return rc
+     with self.__subscriptionsLock:
+       if type(topic) == type([]):
+         rc = []
+         count = 0
+         for aTopic in topic:
+           rc.append(self.__subscribe(aClientid, aTopic, qos[count]))
+           count += 1
+         if count > 1:
+           statements.info("[MQTT-3.8.4-4] Multiple topics in one subscribe")
+       else:
+         rc = self.__subscribe(aClientid, topic, qos)
+       return rc
 
    def __subscribe(self, aClientid, aTopic, aQos):
      "subscribe to one topic"
      rc = None
      if Topics.isValidTopicName(aTopic):
        subscriptions = self.__subscriptions if aTopic[0] != "$" else self.__dollar_subscriptions
-       resubscribed = False
-       for s in subscriptions:
-         if s.getClientid() == aClientid and s.getTopic() == aTopic:
-           s.resubscribe(aQos)
-           return s
+       tree = self.__tree if aTopic[0] != "$" else self.__dollar_tree
+       clientSubscriptions = subscriptions.setdefault(aClientid, {})
+       if aTopic in clientSubscriptions:
+         s = clientSubscriptions[aTopic]
+         s.resubscribe(aQos)
+         return s
        rc = Subscriptions(aClientid, aTopic, aQos)
-       subscriptions.append(rc)
+       clientSubscriptions[aTopic] = rc
+       tree.add(aTopic, rc)
      return rc
 
    def unsubscribe(self, aClientid, aTopic):
-     matched = False
-     if type(aTopic) == type([]):
-       if len(aTopic) > 1:
-         logger.info("[MQTT-3.10.4-6] each topic must be processed in sequence")
-       for t in aTopic:
-         if not matched:
-           matched = self.__unsubscribe(aClientid, t)
-     else:
-       matched = self.__unsubscribe(aClientid, aTopic)
-     if not matched:
-       logger.info("[MQTT-3.10.4-5] Unsuback must be sent even if no topics are matched")
+     with self.__subscriptionsLock:
+       matched = False
+       if type(aTopic) == type([]):
+         if len(aTopic) > 1:
+           statements.info("[MQTT-3.10.4-6] each topic must be processed in sequence")
+         for t in aTopic:
+           if not matched:
+             matched = self.__unsubscribe(aClientid, t)
+       else:
+         matched = self.__unsubscribe(aClientid, aTopic)
+       if not matched:
+         statements.info("[MQTT-3.10.4-5] Unsuback must be sent even if no topics are matched")
 
    def __unsubscribe(self, aClientid, aTopic):
      "unsubscribe to one topic"
      matched = False
      if Topics.isValidTopicName(aTopic):
        subscriptions = self.__subscriptions if aTopic[0] != "$" else self.__dollar_subscriptions
-       for s in subscriptions:
-         if s.getClientid() == aClientid and s.getTopic() == aTopic:
-           logger.info("[MQTT-3.10.4-1] topic filters must be compared byte for byte")
-           logger.info("[MQTT-3.10.4-2] no more messages must be added after unsubscribe is complete")
-           subscriptions.remove(s)
-           matched = True
-           break # once we've hit one, that's us done
+       tree = self.__tree if aTopic[0] != "$" else self.__dollar_tree
+       clientSubscriptions = subscriptions.get(aClientid, {})
+       if aTopic in clientSubscriptions:
+         statements.info("[MQTT-3.10.4-1] topic filters must be compared byte for byte")
+         statements.info("[MQTT-3.10.4-2] no more messages must be added after unsubscribe is complete")
+         tree.remove(aTopic, clientSubscriptions.pop(aTopic))
+         if len(clientSubscriptions) == 0:
+           del subscriptions[aClientid]
+         matched = True
      return matched
 
    def clearSubscriptions(self, aClientid):
-     for subscriptions in [self.__subscriptions, self.__dollar_subscriptions]:
-       for s in subscriptions[:]:
-         if s.getClientid() == aClientid:
-           subscriptions.remove(s)
+     with self.__subscriptionsLock:
+       for subscriptions, tree in [(self.__subscriptions, self.__tree),
+                                   (self.__dollar_subscriptions, self.__dollar_tree)]:
+         for s in subscriptions.pop(aClientid, {}).values():
+           tree.remove(s.getTopic(), s)
 
    def getSubscriptions(self, aTopic, aClientid=None):
      "return a list of subscriptions for this client"
-     rc = None
-     if Topics.isValidTopicName(aTopic):
-       subscriptions = self.__subscriptions if aTopic[0] != "$" else self.__dollar_subscriptions
-       if aClientid == None:
-         rc = [sub for sub in subscriptions if Topics.topicMatches(sub.getTopic(), aTopic)]
-       else:
-         rc = [sub for sub in subscriptions if sub.getClientid() == aClientid and Topics.topicMatches(sub.getTopic(), aTopic)]
-     return rc
+     with self.__subscriptionsLock:
+       rc = None
+       if Topics.isValidTopicName(aTopic):
+         tree = self.__tree if aTopic[0] != "$" else self.__dollar_tree
+         if aClientid == None:
+           rc = tree.match(aTopic)
+         else:
+           rc = [sub for sub in tree.match(aTopic) if sub.getClientid() == aClientid]
+       return rc
 
    def qosOf(self, clientid, topic):
-     # if there are overlapping subscriptions, choose maximum QoS
-     chosen = None
-     for sub in self.getSubscriptions(topic, clientid):
-       if chosen == None:
-         chosen = sub.getQoS()
-       else:
-         logger.info("[MQTT-3.3.5-1] Overlapping subscriptions max QoS")
-         if sub.getQoS() > chosen:
+     with self.__subscriptionsLock:
+       # if there are overlapping subscriptions, choose maximum QoS
+       chosen = None
+       for sub in self.getSubscriptions(topic, clientid):
+         if chosen == None:
            chosen = sub.getQoS()
-       # Omit the following optimization because we want to check for condition [MQTT-3.3.5-1]
-       #if chosen == 2:
-       #  break
-     return chosen
+         else:
+           statements.info("[MQTT-3.3.5-1] Overlapping subscriptions max QoS")
+           if sub.getQoS() > chosen:
+             chosen = sub.getQoS()
+         # Omit the following optimization because we want to check for condition [MQTT-3.3.5-1]
+         #if chosen == 2:
+         #  break
+       return chosen
 
    def subscribers(self, aTopic):
      "list all clients subscribed to this (non-wildcard) topic"
-     result = []
-     if Topics.isValidTopicName(aTopic):
-       subscriptions = self.__subscriptions if aTopic[0] != "$" else self.__dollar_subscriptions
-       for s in subscriptions:
-         if Topics.topicMatches(s.getTopic(), aTopic):
+     with self.__subscriptionsLock:
+       result = []
+       if Topics.isValidTopicName(aTopic):
+         tree = self.__tree if aTopic[0] != "$" else self.__dollar_tree
+         for s in tree.match(aTopic):
            if s.getClientid() not in result: # don't add a client id twice
                result.append(s.getClientid())
-     return result
+       return result
 
    def setRetained(self, aTopic, aMessage, aQoS, receivedTime):
      "set a retained message on a non-wildcard topic"
-     if Topics.isValidTopicName(aTopic):
-       retained = self.__retained if aTopic[0] != "$" else self.__dollar_retained
-       if len(aMessage) == 0:
-         if aTopic in retained.keys():
-           logger.info("[MQTT-3.3.1-11] Deleting zero byte retained message")
-           del retained[aTopic]
-       else:
-         retained[aTopic] = (aMessage, aQoS, receivedTime)
+     with self.__retainedLock:
+       if Topics.isValidTopicName(aTopic):
+         retained = self.__retained if aTopic[0] != "$" else self.__dollar_retained
+         tree = self.__retained_tree if aTopic[0] != "$" else self.__dollar_retained_tree
+         if len(aMessage) == 0:
+           if aTopic in retained.keys():
+             statements.info("[MQTT-3.3.1-11] Deleting zero byte retained message")
+             del retained[aTopic]
+             tree.remove(aTopic)
+         else:
+           tree.add(aTopic)
+           retained[aTopic] = (aMessage, aQoS, receivedTime)
 
    def getRetained(self, aTopic):
      "returns (msg, QoS) for a topic"
-     result = None
-     if Topics.isValidTopicName(aTopic):
-       retained = self.__retained if aTopic[0] != "$" else self.__dollar_retained
-       if aTopic in retained.keys():
-         result = retained[aTopic]
-     return result
+     with self.__retainedLock:
+       result = None
+       if Topics.isValidTopicName(aTopic):
+         retained = self.__retained if aTopic[0] != "$" else self.__dollar_retained
+         if aTopic in retained.keys():
+           result = retained[aTopic]
+       return result
 
    def getRetainedTopics(self, aTopic):
-     "returns a list of topics for which retained publications exist"
-     if Topics.isValidTopicName(aTopic):
-       retained = self.__retained if aTopic[0] != "$" else self.__dollar_retained
-       return retained.keys()
-     else:
-       return None
+     "returns the topics matching a topic filter for which retained publications exist, in the order they were retained"
+     with self.__retainedLock:
+       if Topics.isValidTopicName(aTopic):
+         tree = self.__retained_tree if aTopic[0] != "$" else self.__dollar_retained_tree
+         return tree.match(aTopic)
+       else:
+         return None
 
 
 def unit_tests():
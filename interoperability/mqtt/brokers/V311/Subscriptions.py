@@ -19,6 +19,7 @@
 import time, logging
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
  
 class Subscriptions:
 
@@ -37,8 +38,8 @@ class Subscriptions:
     return self.__qos
 
   def resubscribe(self, qos):
-    logger.info("[MQTT-1.1.0-1] resubscription for client %s on topic %s", self.__clientid, self.__topic)
-    logger.info("[MQTT-3.8.4-3] resubscription for client %s on topic %s", self.__clientid, self.__topic)
+    statements.info("[MQTT-1.1.0-1] resubscription for client %s on topic %s", self.__clientid, self.__topic)
+    statements.info("[MQTT-3.8.4-3] resubscription for client %s on topic %s", self.__clientid, self.__topic)
     self.__qos = qos
 
   def __repr__(self):
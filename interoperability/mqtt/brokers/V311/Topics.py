@@ -17,30 +17,32 @@
 """
 
 
-import re, logging
+import logging
 from mqtt.formats import MQTTV311 as MQTTV3
+from ..TopicMatchers import TopicMatchers
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
  
 def isValidTopicName(aName):
-  logger.info("[MQTT-4.7.3-1] all topic names and filters must be at least 1 char")
+  statements.info("[MQTT-4.7.3-1] all topic names and filters must be at least 1 char")
   if len(aName) < 1:
     raise MQTTV3.MQTTException("MQTT-4.7.3-1] all topic names and filters must be at least 1 char")
     return False
-  logger.info("[MQTT-4.7.3-3] all topic names and filters must be <= 65535 bytes long")
+  statements.info("[MQTT-4.7.3-3] all topic names and filters must be <= 65535 bytes long")
   if len(aName) > 65535:
     raise MQTTV3.MQTTException("[MQTT-4.7.3-3] all topic names and filters must be <= 65535 bytes long")
     return False
   rc = True
 
   # '#' wildcard can be only at the end of a topic (used to be beginning as well)
-  logger.info("[MQTT-4.7.1-2] # must be last, and next to /")
+  statements.info("[MQTT-4.7.1-2] # must be last, and next to /")
   if aName[0:-1].find('#') != -1:
     raise MQTTV3.MQTTException("[MQTT-4.7.1-2] # must be last, and next to /")
     rc = False
 
-  logger.info("[MQTT-4.7.1-3] + can be used at any complete level")
+  statements.info("[MQTT-4.7.1-3] + can be used at any complete level")
   # '#' or '+' only next to a slash separator or end of name
   wilds = '#+'
   for c in wilds:
@@ -60,35 +62,10 @@ def isValidTopicName(aName):
  
 
 def topicMatches(wild, nonwild, wildCheck=True):
-
+  "whether a topic filter matches a topic name.  The brokers use the topic trees instead"
   if wildCheck:
     assert nonwild.find('+') == nonwild.find('#') == -1
-  assert isValidTopicName(wild) and isValidTopicName(nonwild)
-
-  rc = False
-  if wild.find('+') == wild.find('#') == -1:
-    # no wildcards, so check is simple
-    rc = (wild == nonwild)
-  else:
-    # we have wildcards. Escape metacharacters, except +
-    metachars = '\\.^$*?{[]|()' # make sure \\ is at beginning of this string
-    for s in metachars:
-      wild = wild.replace(s, '\\'+s)
-
-    # now replace wildcards with regular expressions and match
-    if wild == '#':
-      "# on its own matches everything"
-      wild = '.*'
-    elif wild == '/#':
-      "/# matches everything starting with a slash"
-      wild = '/.*'
-    else:
-      "all other instances subsume the preceding or following slash"
-      wild = wild.replace('#/', '(.*?/|^)').replace('/#', '(/.*?|$)')
-    wild = wild.replace('+', '[^/#]+?') # + does not match an empty level
-    if re.compile(wild+'$').match(nonwild) != None:
-      rc = True
-  return rc
+  return TopicMatchers(wild, sharedPrefix=False).matches(nonwild)
 
 
 """ 
@@ -16,19 +16,20 @@
 *******************************************************************
 """
 
-import types, time, logging, random
+import types, time, logging, random, copy
 
 from . import Topics
 from .SubscriptionEngines import SubscriptionEngines
-from mqtt.formats.MQTTV5 import ProtocolError
+from mqtt.formats.MQTTV5 import ProtocolError, PublishTemplates
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 class Brokers:
 
-  def __init__(self, overlapping_single=True, topicAliasMaximum=0, sharedData={}):
+  def __init__(self, overlapping_single=True, topicAliasMaximum=0, sharedData={}, locks=None):
     self.sharedData = sharedData
-    self.se = SubscriptionEngines(self.sharedData)
+    self.se = SubscriptionEngines(self.sharedData, locks)
     self.__clients = {} # clientid -> client
     self.overlapping_single = overlapping_single
     self.topicAliasMaximum = topicAliasMaximum
@@ -46,12 +47,12 @@ class Brokers:
     return self.__clients
   
   def getClient(self, clientid):
-    return self.__clients[clientid] if (clientid in self.__clients.keys()) else None
+    return self.__clients.get(clientid) # one lookup, as connect and disconnect may change the clients meanwhile
 
   def cleanSession(self, aClientid):
     "clear any outstanding subscriptions and publications"
     if len(self.se.getRetainedTopics("#")) > 0:
-      logger.info("[MQTT-3.1.2-7] retained messages not cleaned up as part of session state for client %s", aClientid)
+      statements.info("[MQTT-3.1.2-7] retained messages not cleaned up as part of session state for client %s", aClientid)
     self.se.clearSubscriptions(aClientid)
 
   def connect(self, aClient, clean=False):
@@ -69,15 +70,15 @@ class Brokers:
     self.__clients[aClientid].delayedWillTime = None
     if aClientid in self.willMessageClients:
       self.willMessageClients.remove(aClientid)
-    logger.info("[MQTT5-3.1.2-8] sending will message for client %s", aClientid)
+    statements.info("[MQTT5-3.1.2-8] sending will message for client %s", aClientid)
     willtopic, willQoS, willmsg, willRetain, willProperties = self.__clients[aClientid].will
     if willRetain:
-      logger.info("[MQTT5-3.1.2-15] sending will message retained for client %s", aClientid)
+      statements.info("[MQTT5-3.1.2-15] sending will message retained for client %s", aClientid)
     else:
-      logger.info("[MQTT5-3.1.2-14] sending will message non-retained for client %s", aClientid)
+      statements.info("[MQTT5-3.1.2-14] sending will message non-retained for client %s", aClientid)
     self.publish(aClientid, willtopic, willmsg, willQoS, willRetain, willProperties, time.monotonic())
-    logger.info("[MQTT5-3.1.2-10] will message is deleted after use or disconnect, for client %s", aClientid)
-    logger.info("[MQTT-3.14.4-3] on receipt of disconnect, will message is deleted")
+    statements.info("[MQTT5-3.1.2-10] will message is deleted after use or disconnect, for client %s", aClientid)
+    statements.info("[MQTT-3.14.4-3] on receipt of disconnect, will message is deleted")
     self.__clients[aClientid].will = None
 
   def setupWillMessage(self, aClientid):
@@ -100,7 +101,7 @@ class Brokers:
         self.cleanSession(aClientid)
         del self.__clients[aClientid]
       else:
-        logger.info("[MQTT5-3.1.2-23] broker must store the session data for client %s", aClientid)
+        statements.info("[MQTT5-3.1.2-23] broker must store the session data for client %s", aClientid)
         self.__clients[aClientid].sessionEndedTime = time.monotonic()
         self.__clients[aClientid].connected = False
 
@@ -121,7 +122,7 @@ class Brokers:
        also to any disconnected non-cleanstart clients with qos in [1,2]
     """
 
-    def publishAction(options, subsprops, subsids=None):
+    def publishAction(client, options, subsprops, subsids=None):
       if hasattr(properties, "SubscriptionIdentifier"):
         delattr(properties, "SubscriptionIdentifier")
       if subsids or hasattr(subsprops, "SubscriptionIdentifier"):
@@ -132,7 +133,7 @@ class Brokers:
           properties.SubscriptionIdentifier = subsprops.SubscriptionIdentifier[0]
       out_qos = min(options.QoS, qos)
       outretain = retained if options.retainAsPublished else False
-      self.__clients[subscriber].publishArrived(topic, message, out_qos, properties, receivedTime, outretain)
+      client.publishArrived(topic, message, out_qos, properties, receivedTime, outretain, template)
 
     # topic alias
     if hasattr(properties, "TopicAlias"):
@@ -147,12 +148,14 @@ class Brokers:
         else:
           raise ProtocolError("Topic alias invalid", self.__clients[aClientid].topicAliasMaximum)
     assert len(topic) > 0
+    # the topic, properties and payload are encoded once for all subscribers
+    template = PublishTemplates(topic, properties, message) if properties else None
 
     if retained:
-      logger.info("[MQTT-2.1.2-6] store retained message and QoS")
+      statements.info("[MQTT-2.1.2-6] store retained message and QoS")
       self.se.setRetained(topic, message, qos, receivedTime, properties)
     else:
-      logger.info("[MQTT-2.1.2-12] non-retained message - do not store")
+      statements.info("[MQTT-2.1.2-12] non-retained message - do not store")
 
     subscriptions = self.se.subscriptions(topic)
     # For shared subscriptions, there is only one recipient
@@ -176,13 +179,23 @@ class Brokers:
       overlapping = False
       subscriptions = self.se.getSubscriptions(topic, subscriber)
       if len(subscriptions) > 1:
-        logger.info("[MQTT-3.3.5-1] overlapping subscriptions")
+        statements.info("[MQTT-3.3.5-1] overlapping subscriptions")
         overlapping = True
       if retained:
-        logger.info("[MQTT-2.1.2-10] outgoing publish does not have retained flag set")
+        statements.info("[MQTT-2.1.2-10] outgoing publish does not have retained flag set")
+      # without the sessions lock, the subscriber may have gone since its subscription was found
+      client = self.__clients.get(subscriber)
+      client3 = None
+      if client == None and self.__broker3 != None:
+        client3 = self.__broker3.getClient(subscriber) # an MQTT V3 subscription
+      if client == None and client3 == None:
+        continue
       if self.overlapping_single:
-        if subscriber in self.__clients.keys():
-          options, subsprops = self.se.optionsOf(subscriber, topic)
+        if client != None:
+          chosen = self.se.optionsOf(subscriber, topic)
+          if chosen == None:
+            continue # unsubscribed meanwhile
+          options, subsprops = chosen
           # any other subscription ids?
           subsids = []
           nolocalfilter = []
@@ -197,21 +210,23 @@ class Brokers:
             if not options.noLocal or subscriber != aClientid: # noLocal
               nolocalfilter = subscriptions
           if len(nolocalfilter) > 0:
-            publishAction(options, subsprops, subsids=subsids)
+            publishAction(client, options, subsprops, subsids=subsids)
         else:
           # MQTT V3 subscription
-          out_qos = min(self.__broker3.se.qosOf(subscriber, topic), qos)
-          self.__broker3.getClient(subscriber).publishArrived(topic, message, out_qos)
+          subscriptionQoS = self.__broker3.se.qosOf(subscriber, topic)
+          if subscriptionQoS != None:
+            client3.publishArrived(topic, message, min(subscriptionQoS, qos))
       else:
         for subscription in subscriptions:
-          if subscriber in self.__clients.keys():
+          if client != None:
             options, subsprops = subscription.getOptions()
             if not options.noLocal or subscriber != aClientid: # noLocal
-              publishAction(options, subsprops)
+              publishAction(client, options, subsprops)
           else:
             # MQTT V3 subscription
-            out_qos = min(self.__broker3.se.qosOf(subscriber, topic), qos)
-            self.__broker3.getClient(subscriber).publishArrived(topic, message, out_qos)
+            subscriptionQoS = self.__broker3.se.qosOf(subscriber, topic)
+            if subscriptionQoS != None:
+              client3.publishArrived(topic, message, min(subscriptionQoS, qos))
     return subscribed_clients if len(subscribed_clients) > 0 else None
 
   def __doRetained__(self, aClientid, topic, subsoptions, resubscribeds):
@@ -225,19 +240,17 @@ class Brokers:
         (subsoptions[i].retainHandling == 1 and resubscribeds[i]):
         i += 1
         continue
-      topicsUsed = []
-      for s in self.se.getRetainedTopics(t): # s is a non-wildcard retained topic
-        if s not in topicsUsed and Topics.topicMatches(t, s):
-          # topic has retained publication
-          topicsUsed.append(s)
-          retained_message = self.se.getRetained(s)
-          if len(retained_message) == 3:
-            (ret_msg, ret_qos, receivedTime) = retained_message
-            properties = None
-          else:
-            (ret_msg, ret_qos, receivedTime, properties) = retained_message
-          thisqos = min(ret_qos, subsoptions[i].QoS)
-          self.__clients[aClientid].publishArrived(s, ret_msg, thisqos, properties, receivedTime, True)
+      for s in self.se.getRetainedTopics(t): # s is a non-wildcard retained topic matching t
+        retained_message = self.se.getRetained(s)
+        if len(retained_message) == 3:
+          (ret_msg, ret_qos, receivedTime) = retained_message
+          properties = None
+        else:
+          (ret_msg, ret_qos, receivedTime, properties) = retained_message
+          if properties:
+            properties = copy.copy(properties) # the stored properties may be being sent elsewhere
+        thisqos = min(ret_qos, subsoptions[i].QoS)
+        self.__clients[aClientid].publishArrived(s, ret_msg, thisqos, properties, receivedTime, True)
       i += 1
 
   def subscribe(self, aClientid, topic, optionsprops):
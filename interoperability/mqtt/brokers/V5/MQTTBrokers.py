@@ -22,33 +22,42 @@ import traceback, random, sys, string, copy, threading, logging, socket, time, u
 from mqtt.formats import MQTTV5
 
 from .Brokers import Brokers
+from .. import OutboundQueues, MessageQueues
+from ..TimerWheels import TimerWheels
+from .Reapers import Reapers
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 mybroker = None
 
+NEVER_EXPIRES = 2**32-1 # the session expiry interval for a session which never expires
+
 def respond(sock, packet, maximumPacketSize=500):
   # deal with expiry
   if packet.fh.PacketType == MQTTV5.PacketTypes.PUBLISH:
     if hasattr(packet.properties, "MessageExpiryInterval"):
       timespent = int(time.monotonic() - packet.receivedTime)
       if timespent >= packet.properties.MessageExpiryInterval:
-        logger.info("[MQTT-3.3.2-5] Delete expired message")
+        statements.info("[MQTT-3.3.2-5] Delete expired message")
         return
       else:
         try:
-          logger.info("[MQTT-3.3.2-6] Message Expiry Interval set to received value minus time waiting in the server")
+          statements.info("[MQTT-3.3.2-6] Message Expiry Interval set to received value minus time waiting in the server")
           packet.properties.MessageExpiryInterval -= timespent
         except:
           traceback.print_exc()
-  packed = packet.pack()
+  if packet.fh.PacketType == MQTTV5.PacketTypes.PUBLISH:
+    buffers = packet.packBuffers() # so that the payload is not copied
+  else:
+    buffers = [packet.pack()]
   # deal with packet size
-  packlen = len(packed)
+  packlen = sum(len(buffer) for buffer in buffers)
   if packlen > maximumPacketSize:
     logger.error("[MQTT5-3.1.2-24] Packet too big to send to client packet size %d max packet size %d" % (packlen, maximumPacketSize))
-    logger.info("[MQTT5-3.1.2-25] message must be discarded and behave as if it had been sent")
+    statements.info("[MQTT5-3.1.2-25] message must be discarded and behave as if it had been sent")
     return
-  if hasattr(sock, "fileno"):
+  if hasattr(sock, "fileno") and logger.isEnabledFor(logging.DEBUG):
     packet_string = str(packet)
     if len(packet_string) > 256:
       packet_string = packet_string[:255] + '...' + (' payload length:' + str(len(packet.data)) if hasattr(packet, "data") else "")
@@ -58,26 +67,89 @@ def respond(sock, packet, maximumPacketSize=500):
   if hasattr(sock, "handlePacket"):
     sock.handlePacket(packet)
   else:
+    databytes = None
     if mybroker.options["visual"]:
       try:
-        data = {"direction" : "StoC", "socket" : sock.fileno(), 
-            "clientid":  mybroker.clients[sock].id if sock in mybroker.clients.keys() else "", 
+        data = {"direction" : "StoC", "socket" : sock.fileno(),
+            "clientid":  mybroker.clients[sock].id if sock in mybroker.clients.keys() else "",
             "packet" : packet.json() }
         # for any byte arrays, use base64 in json
         databytes = bytes(json.dumps(data), 'utf-8')
-        mybroker.broker.publish('$internal', '$SYS/clients-packets', databytes, 
-                0, 0, None, time.monotonic())
+      except:
+        traceback.print_exc()
+    write(sock, buffers, packlen, databytes)
+
+def close(sock):
+  "shut a connection once what has been written to it is sent, leaving its handler to end it"
+  def shutdown():
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except:
+      pass # doesn't matter if the socket has been closed at the other end already
+
+  outbound = getattr(sock, "outbound", None)
+  if outbound != None:
+    outbound.put(shutdown)
+  else:
+    shutdown()
+
+def closeSocket(sock):
+  "close a socket once what has been written to it is sent, outside the broker locks if it has an outbound queue"
+  def shutdown():
+    try:
+      sock.shutdown(socket.SHUT_RDWR) # must call shutdown to close socket immediately
+    except:
+      pass # doesn't matter if the socket has been closed at the other end already
+    try:
+      sock.close()
+    except:
+      pass # doesn't matter if the socket has been closed at the other end already
+
+  outbound = getattr(sock, "outbound", None)
+  if outbound != None:
+    outbound.put(shutdown) # written by the next flush, which the broker does once it holds no locks
+  else:
+    shutdown()
+
+def respondPlain(sock, packetType, packetIdentifier=None):
+  "send a success ack with no properties, or a pingresp, without a packet object if none is needed"
+  if mybroker.tracing() or hasattr(sock, "handlePacket"):
+    packet = MQTTV5.classes[packetType - 1]()
+    if packetIdentifier != None:
+      packet.packetIdentifier = packetIdentifier
+    respond(sock, packet)
+  elif packetType == MQTTV5.PacketTypes.PINGRESP:
+    write(sock, [MQTTV5.pingresp], 2)
+  else:
+    write(sock, [MQTTV5.packAck(packetType, packetIdentifier)], 4)
+
+def write(sock, buffers, packlen, databytes=None):
+  "write the buffers of one packet, and publish its description for the visual option"
+  def send():
+    if databytes != None:
+      try:
+        mybroker.broker.publish('$internal', '$SYS/clients-packets', databytes,
+              0, 0, None, time.monotonic())
       except:
         traceback.print_exc()
     try:
-      bytes_sent = sock.send(packed) # Could get socket error on send
+      if len(buffers) > 1 and hasattr(sock, "sendmsg"):
+        bytes_sent = sock.sendmsg(buffers) # Could get socket error on send
+      else:
+        bytes_sent = sock.send(b"".join(buffers))
       if sock.websockets:
-        assert bytes_sent >= len(packed)
+        assert bytes_sent >= packlen
       else:
-        assert bytes_sent == len(packed)
+        assert bytes_sent == packlen
     except:
       traceback.print_exc()
 
+  outbound = getattr(sock, "outbound", None)
+  if outbound != None:
+    outbound.put(send) # written once the broker locks have been released
+  else:
+    send()
+
 class MQTTClients:
 
   def __init__(self, anId, cleanStart, sessionExpiryInterval, willDelayInterval, keepalive, socket, broker):
@@ -93,19 +165,22 @@ class MQTTClients:
     self.delayedWillTime = None
     self.socket = socket
     self.broker = broker
+    self.lock = threading.RLock() # for the outbound messages, which other clients' publishes add to
     # outbound messages
     self.msgid = 1 # outbound message ids
-    self.queued = [] # queued message objects
-    self.outbound = [] # message objects - for ordering
-    self.outmsgs = {} # msgids to message objects
+    self.queued = MessageQueues.MessageQueues(broker.queueLimits) # message objects waiting to be sent
+    self.expiryTimers = {} # ids of queued message objects to the timers which expire them
+    self.outbound = {} # msgids to message objects sent but not yet completed, in the order sent
     # inbound messages
     if broker.options["publish_on_pubrel"]:
       self.inbound = {} # stored inbound QoS 2 publications
     else:
-      self.inbound = []
+      self.inbound = set() # the packet ids of inbound QoS 2 publications
     # Keep alive
     self.keepalive = keepalive
     self.lastPacket = None # time of last packet
+    self.expired = False # set by the reaper while it frees the session
+    self.timers = {} # "keepalive", "will" and "expiry" to the timer for each
     # Topic aliases
     self.clearTopicAliases()
 
@@ -116,35 +191,34 @@ class MQTTClients:
 
   def resendPub(self, pub):
     logger.debug("resending %s", str(pub))
-    logger.info("[MQTT-4.4.0-2] dup flag must be set on in re-publish")
+    statements.info("[MQTT-4.4.0-2] dup flag must be set on in re-publish")
     if pub.fh.QoS == 0:
       respond(self.socket, pub, self.maximumPacketSize)
     elif pub.fh.QoS == 1:
-      logger.info("[MQTT-2.1.2-3] Dup when resending QoS 1 publish id %d", pub.packetIdentifier)
-      logger.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
-      logger.info("[MQTT-4.3.2-1] Resending QoS 1 with DUP flag")
+      statements.info("[MQTT-2.1.2-3] Dup when resending QoS 1 publish id %d", pub.packetIdentifier)
+      statements.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
+      statements.info("[MQTT-4.3.2-1] Resending QoS 1 with DUP flag")
       respond(self.socket, pub, self.maximumPacketSize)
       pub.fh.DUP = 1
     elif pub.fh.QoS == 2:
       if pub.qos2state == "PUBREC":
-        logger.info("[MQTT-2.1.2-3] Dup when resending QoS 2 publish id %d", pub.packetIdentifier)
-        logger.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
-        logger.info("[MQTT-4.3.3-1] Resending QoS 2 with DUP flag")
+        statements.info("[MQTT-2.1.2-3] Dup when resending QoS 2 publish id %d", pub.packetIdentifier)
+        statements.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
+        statements.info("[MQTT-4.3.3-1] Resending QoS 2 with DUP flag")
         respond(self.socket, pub, self.maximumPacketSize)
         pub.fh.DUP = 1
       else:
-        resp = MQTTV5.Pubrels()
-        logger.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
-        resp.packetIdentifier = pub.packetIdentifier
-        respond(self.socket, resp, self.maximumPacketSize)
+        statements.info("[MQTT-2.3.1-4] Message id same as original publish on resend")
+        respondPlain(self.socket, MQTTV5.PacketTypes.PUBREL, pub.packetIdentifier)
 
   def resend(self):
-    logger.debug("resending unfinished publications %s", str(self.outbound))
-    if len(self.outbound) > 0:
-      logger.info("[MQTT-4.4.0-1] resending inflight QoS 1 and 2 messages")
-    for pub in self.outbound:
-      self.resendPub(pub)
-    self.sendQueued()
+    with self.lock:
+      logger.debug("resending unfinished publications %s", str(self.outbound))
+      if len(self.outbound) > 0:
+        statements.info("[MQTT-4.4.0-1] resending inflight QoS 1 and 2 messages")
+      for pub in self.outbound.values():
+        self.resendPub(pub)
+      self.sendQueued()
 
   def sendFirst(self, pub):
     if pub.fh.QoS in [1, 2]:
@@ -154,96 +228,146 @@ class MQTTClients:
         self.msgid = 1
       else:
         self.msgid += 1
-      self.outbound.append(pub)
-      self.outmsgs[pub.packetIdentifier] = pub
-      logger.info("[MQTT-4.6.0-6] publish packets must be sent in order of receipt from any given client")
+      self.outbound[pub.packetIdentifier] = pub
+      statements.info("[MQTT-4.6.0-6] publish packets must be sent in order of receipt from any given client")
     respond(self.socket, pub, self.maximumPacketSize)
     if pub.fh.QoS > 0:
       pub.fh.DUP = 1
 
   def sendQueued(self):
-    while len(self.queued) > 0 and len(self.outbound) < self.receiveMaximum:
-      self.outbound.append(self.queued.pop(0))
-      self.sendFirst(self.outbound[-1])
-
-  def publishArrived(self, topic, msg, qos, properties, receivedTime, retained=False):
-    pub = MQTTV5.Publishes()
-    if properties:
-      if hasattr(properties, 'TopicAlias'):
-        del properties.TopicAlias
-      pub.properties = properties
-    logger.info("[MQTT-3.2.3-3] topic name must match the subscription's topic filter")
-    # Topic alias
-    if self.topicAliasMaximum == 0:
-      logger.info("[MQTT5-3.1.2-27] if topic alias is 0, no topic aliases must be sent") 
-    if len(self.outgoingTopicNamesToAliases) < self.topicAliasMaximum and not topic in self.outgoingTopicNamesToAliases:
-      logger.info("[MQTT5-3.1.2-26] Server must not send topic alias > max") 
-      self.outgoingTopicNamesToAliases.append(topic)       # add alias
-      pub.topicName = topic # include topic name as well as alias first time
-    if topic in self.outgoingTopicNamesToAliases:
-      pub.properties.TopicAlias = self.outgoingTopicNamesToAliases.index(topic) + 1 # Topic aliases start at 1
-    else:
-      pub.topicName = topic
-    pub.data = msg
-    pub.fh.QoS = qos
-    pub.fh.RETAIN = retained
-    pub.receivedTime = receivedTime
-    if retained:
-      logger.info("[MQTT-2.1.2-7] Last retained message on matching topics sent on subscribe")
-    if pub.fh.RETAIN:
-      logger.info("[MQTT-2.1.2-9] Set retained flag on retained messages")
-    if qos == 2:
-      pub.qos2state = "PUBREC"
-    if len(self.outbound) >= self.receiveMaximum or not self.connected:
-      if qos > 0 or not self.broker.options["dropQoS0"]:
-        self.queued.append(pub) # this should never be infinite in reality
-      if qos > 0 and not self.connected:
-        logger.info("[MQTT-3.1.2-5] storing of QoS 1 and 2 messages for disconnected client %s", self.id)
-    else:
-      self.sendFirst(pub)
+    with self.lock:
+      while len(self.queued) > 0 and len(self.outbound) < self.receiveMaximum:
+        pub = self.queued.popleft()
+        if len(self.expiryTimers) > 0 and id(pub) in self.expiryTimers:
+          self.broker.timers.cancel(self.expiryTimers.pop(id(pub)))
+        self.sendFirst(pub)
+
+  def removeExpired(self, pub):
+    "remove a queued message which has expired, returning whether it was still queued"
+    with self.lock:
+      if self.expiryTimers.pop(id(pub), None) != None and self.queued.remove(pub):
+        statements.info("[MQTT-3.3.2-5] Delete expired message")
+        return True
+    return False
+
+  def discardQueued(self, limit=None):
+    "discard the queued messages, or the oldest limit of them, when the session ends.  Returns how many"
+    with self.lock:
+      if limit == None:
+        for timer in self.expiryTimers.values():
+          self.broker.timers.cancel(timer)
+        self.expiryTimers = {}
+      discarded = self.queued.clear(limit)
+      if limit != None and len(self.expiryTimers) > 0:
+        for pub in discarded:
+          if id(pub) in self.expiryTimers:
+            self.broker.timers.cancel(self.expiryTimers.pop(id(pub)))
+      return len(discarded)
+
+  def publishArrived(self, topic, msg, qos, properties, receivedTime, retained=False, template=None):
+    with self.lock:
+      if self.expired:
+        return # the reaper is freeing this session
+      pub = MQTTV5.Publishes()
+      if properties:
+        if hasattr(properties, 'TopicAlias'):
+          del properties.TopicAlias
+        pub.properties = properties
+        pub.template = template
+      statements.info("[MQTT-3.2.3-3] topic name must match the subscription's topic filter")
+      # Topic alias
+      if self.topicAliasMaximum == 0:
+        statements.info("[MQTT5-3.1.2-27] if topic alias is 0, no topic aliases must be sent") 
+      if len(self.outgoingTopicNamesToAliases) < self.topicAliasMaximum and not topic in self.outgoingTopicNamesToAliases:
+        statements.info("[MQTT5-3.1.2-26] Server must not send topic alias > max") 
+        self.outgoingTopicNamesToAliases.append(topic)       # add alias
+        pub.topicName = topic # include topic name as well as alias first time
+      if topic in self.outgoingTopicNamesToAliases:
+        pub.properties.TopicAlias = self.outgoingTopicNamesToAliases.index(topic) + 1 # Topic aliases start at 1
+      else:
+        pub.topicName = topic
+      pub.data = msg
+      pub.fh.QoS = qos
+      pub.fh.RETAIN = retained
+      pub.receivedTime = receivedTime
+      if retained:
+        statements.info("[MQTT-2.1.2-7] Last retained message on matching topics sent on subscribe")
+      if pub.fh.RETAIN:
+        statements.info("[MQTT-2.1.2-9] Set retained flag on retained messages")
+      if qos == 2:
+        pub.qos2state = "PUBREC"
+      if len(self.outbound) >= self.receiveMaximum or not self.connected or len(self.queued) > 0:
+        if qos > 0 or not self.broker.options["dropQoS0"]:
+          if type(msg) == memoryview: # a QoS 0 message, which is not otherwise kept
+            pub.data = bytes(msg)
+          if properties:
+            # the properties are shared with the other subscribers, which may change them before this is sent
+            pub.properties = copy.copy(pub.properties)
+          if properties and hasattr(pub.properties, "MessageExpiryInterval"):
+            self.expiryTimers[id(pub)] = self.broker.timers.scheduleAt(
+                receivedTime + pub.properties.MessageExpiryInterval, self.broker.reaper.messageExpired, self, pub)
+          if not self.queued.append(pub, self.dropped) and self.connected:
+            self.quotaExceeded()
+        if qos > 0 and not self.connected:
+          statements.info("[MQTT-3.1.2-5] storing of QoS 1 and 2 messages for disconnected client %s", self.id)
+      else:
+        self.sendFirst(pub)
+
+  def dropped(self, pub):
+    "a message has been dropped by the overflow policy, so it won't expire"
+    if len(self.expiryTimers) > 0 and id(pub) in self.expiryTimers:
+      self.broker.timers.cancel(self.expiryTimers.pop(id(pub)))
+
+  def quotaExceeded(self):
+    "disconnect a client whose queue is full, for the disconnect overflow policy"
+    logger.info("Disconnecting client %s because its message queue is full", self.id)
+    self.queued.disconnected()
+    respond(self.socket, MQTTV5.Disconnects(reasonCode="Quota exceeded"))
+    close(self.socket)
 
   def puback(self, msgid):
-    if msgid in self.outmsgs.keys():
-      pub = self.outmsgs[msgid]
-      if pub.fh.QoS == 1:
-        self.outbound.remove(pub)
-        del self.outmsgs[msgid]
-        self.sendQueued()
+    with self.lock:
+      if msgid in self.outbound:
+        pub = self.outbound[msgid]
+        if pub.fh.QoS == 1:
+          del self.outbound[msgid]
+          self.sendQueued()
+        else:
+          logger.error("%s: Puback received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
       else:
-        logger.error("%s: Puback received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
-    else:
-      logger.error("%s: Puback received for msgid %d, but no message found", self.id, msgid)
+        logger.error("%s: Puback received for msgid %d, but no message found", self.id, msgid)
 
   def pubrec(self, msgid):
-    rc = False
-    if msgid in self.outmsgs.keys():
-      pub = self.outmsgs[msgid]
-      if pub.fh.QoS == 2:
-        if pub.qos2state == "PUBREC":
-          pub.qos2state = "PUBCOMP"
-          rc = True
+    with self.lock:
+      rc = False
+      if msgid in self.outbound:
+        pub = self.outbound[msgid]
+        if pub.fh.QoS == 2:
+          if pub.qos2state == "PUBREC":
+            pub.qos2state = "PUBCOMP"
+            rc = True
+          else:
+            logger.error("%s: Pubrec received for msgid %d, but message in wrong state", self.id, msgid)
         else:
-          logger.error("%s: Pubrec received for msgid %d, but message in wrong state", self.id, msgid)
+          logger.error("%s: Pubrec received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
       else:
-        logger.error("%s: Pubrec received for msgid %d, but QoS is %d", self.id, msgid, pub.fh.QoS)
-    else:
-      logger.error("%s: Pubrec received for msgid %d, but no message found", self.id, msgid)
-    return rc
+        logger.error("%s: Pubrec received for msgid %d, but no message found", self.id, msgid)
+      return rc
 
   def pubcomp(self, msgid):
-    if msgid in self.outmsgs.keys():
-      pub = self.outmsgs[msgid]
-      if pub.fh.QoS == 2:
-        if pub.qos2state == "PUBCOMP":
-          self.outbound.remove(pub)
-          del self.outmsgs[msgid]
-          self.sendQueued()
+    with self.lock:
+      if msgid in self.outbound:
+        pub = self.outbound[msgid]
+        if pub.fh.QoS == 2:
+          if pub.qos2state == "PUBCOMP":
+            del self.outbound[msgid]
+            self.sendQueued()
+          else:
+            logger.error("Pubcomp received for msgid %d, but message in wrong state", msgid)
         else:
-          logger.error("Pubcomp received for msgid %d, but message in wrong state", msgid)
+          logger.error("Pubcomp received for msgid %d, but QoS is %d", msgid, pub.fh.QoS)
       else:
-        logger.error("Pubcomp received for msgid %d, but QoS is %d", msgid, pub.fh.QoS)
-    else:
-      logger.error("Pubcomp received for msgid %d, but no message found", msgid)
+        logger.error("Pubcomp received for msgid %d, but no message found", msgid)
 
   def pubrel(self, msgid):
     rc = None
@@ -260,56 +384,29 @@ class MQTTClients:
       logger.error("Pubrec received for msgid %d, but no message found", msgid)
     return rc
 
-class cleanupThreads(threading.Thread):
-  """
-  Most of the actions of the broker can be taken when provoked by an external stimulus,
-  which is generally a client taking some action.  A few actions need to be assessed
-  asynchronously, such as the will delay.
-  """
-
-  def __init__(self, broker, lock=None):
-    threading.Thread.__init__(self)
-    self.broker = broker
-    self.lock = lock
-    self.running = False
-    self.start()
-
-  def run(self):
-    self.running = True
-    while self.running:
-      time.sleep(1)
-      # will delay
-      if self.lock:
-        self.lock.acquire()
-      for clientid in self.broker.willMessageClients.copy():
-        client = self.broker.getClient(clientid)
-        if client and time.monotonic() >= client.delayedWillTime:
-          self.broker.sendWillMessage(clientid)
-      if self.lock:
-        self.lock.release()
-
-  def stop(self):
-    self.running = False
-
-
 class MQTTBrokers:
 
-  def __init__(self, options={}, lock=None, sharedData={}):
+  def __init__(self, options={}, lock=None, sharedData={}, locks=None, queueLimits=None, timers=None):
 
     global mybroker
     mybroker = self
     self.options = options
-
-    self.broker = Brokers(self.options["overlapping_single"], self.options["topicAliasMaximum"], sharedData=sharedData)
+    # limits on the messages queued for clients, which may be shared with the MQTT 3.1.1 broker
+    self.queueLimits = queueLimits if queueLimits != None else MessageQueues.QueueLimits(options)
+    # keepalive, will delay, session expiry and message expiry timers, which may also be shared
+    self.timers = timers if timers != None else TimerWheels(options["timerPrecision"])
+    self.reaper = Reapers(self, options["reaperBatchSize"]) # frees expired sessions and messages
+
+    self.broker = Brokers(self.options["overlapping_single"], self.options["topicAliasMaximum"], sharedData=sharedData,
+        locks=locks)
     self.clients = {}   # socket -> clients
+    self.sockets = {}   # clientid -> socket, for the connected clients
     if lock:
       logger.info("Using shared lock %d", id(lock))
       self.lock = lock
     else:
       self.lock = threading.RLock()
 
-    self.cleanupThread = cleanupThreads(self.broker)
-
     logger.info("MQTT 5.0 Paho Test Broker")
     logger.info("Options %s", self.options)
 
@@ -320,19 +417,27 @@ class MQTTBrokers:
 
   def shutdown(self):
     self.disconnectAll()
-    self.cleanupThread.stop()
+    self.timers.stop()
+    self.reaper.stop()
 
   def setBroker3(self, broker3):
     self.broker.setBroker3(broker3.broker)
 
+  def tracing(self):
+    "whether each packet is logged or published, so needs a packet object"
+    return self.options["visual"] or self.mscfile != None or logger.isEnabledFor(logging.DEBUG)
+
   def reinitialize(self):
     logger.info("Reinitializing broker")
     self.clients = {}
+    self.sockets = {}
     self.broker.reinitialize()
 
   def handleRequest(self, sock):
     "this is going to be called from multiple threads, so synchronize"
-    self.lock.acquire()
+    single = self.options["concurrency"] == "single"
+    if single:
+      self.lock.acquire()
     raw_packet = None
     try:
       try:
@@ -340,31 +445,37 @@ class MQTTBrokers:
       except:
         pass # handled by raw_packet == None
       if raw_packet == None:
-        logger.info("[MQTT-4.8.0-1] 'transient error' reading packet, closing connection")
+        statements.info("[MQTT-4.8.0-1] 'transient error' reading packet, closing connection")
         # will message
         if sock in self.clients.keys():
           self.disconnect(sock, None, sendWillMessage=True)
         terminate = True
       else:
         try:
-          packet = MQTTV5.unpackPacket(raw_packet, self.options["maximumPacketSize"])
-          if self.options["visual"]:
-            clientid = self.clients[sock].id if sock in self.clients.keys() else ""
-            if clientid == "" and hasattr(packet, "ClientIdentifier"):
-              clientid = packet.ClientIdentifier
-            try:
-              data = {"direction" : "CtoS", "socket" : sock.fileno(), 
-                    "clientid":  clientid, "packet" : packet.json() }
-              databytes = bytes(json.dumps(data), 'utf-8')
-              self.broker.publish('$internal', '$SYS/clients-packets', databytes,
-                   0, 0, None, time.monotonic())
-            except:
-              traceback.print_exc()
-          if packet:
-            terminate = self.handlePacket(packet, sock)
+          ack = None
+          if sock in self.clients and not self.tracing():
+            ack = MQTTV5.unpackAck(raw_packet, self.options["maximumPacketSize"])
+          if ack != None:
+            terminate = self.handleAck(sock, *ack)
           else:
-            self.disconnect(sock, reasonCode="Malformed packet", sendWillMessage=True)
-            terminate = True
+            packet = MQTTV5.unpackPacket(memoryview(raw_packet), self.options["maximumPacketSize"])
+            if self.options["visual"]:
+              clientid = self.clients[sock].id if sock in self.clients.keys() else ""
+              if clientid == "" and hasattr(packet, "ClientIdentifier"):
+                clientid = packet.ClientIdentifier
+              try:
+                data = {"direction" : "CtoS", "socket" : sock.fileno(), 
+                      "clientid":  clientid, "packet" : packet.json() }
+                databytes = bytes(json.dumps(data), 'utf-8')
+                self.broker.publish('$internal', '$SYS/clients-packets', databytes,
+                     0, 0, None, time.monotonic())
+              except:
+                traceback.print_exc()
+            if packet:
+              terminate = self.handlePacket(packet, sock)
+            else:
+              self.disconnect(sock, reasonCode="Malformed packet", sendWillMessage=True)
+              terminate = True
         except MQTTV5.MalformedPacket as error:
           traceback.print_exc()
           disconnect_properties = MQTTV5.Properties(MQTTV5.PacketTypes.DISCONNECT)
@@ -378,12 +489,14 @@ class MQTTBrokers:
                           sendWillMessage=True)
           terminate = True
     finally:
-      self.lock.release()
+      if single:
+        self.lock.release()
+      OutboundQueues.flush()
     return terminate
 
   def handlePacket(self, packet, sock):
     terminate = False
-    if hasattr(sock, "fileno"):
+    if hasattr(sock, "fileno") and logger.isEnabledFor(logging.DEBUG):
       packet_string = str(packet)
       if len(packet_string) > 256:
         packet_string = packet_string[0:256] + '...' + (' payload length:' + str(len(packet.data)) if hasattr(packet, "data") else "")
@@ -395,7 +508,7 @@ class MQTTBrokers:
       raise MQTTV5.MQTTException("[MQTT5-3.1.0-1-error] Connect was not first packet on socket")
     else:
       if packet.fh.PacketType == MQTTV5.PacketTypes.CONNECT:
-        logger.info("[MQTT5-3.1.0-1] Connect must be first packet on socket")
+        statements.info("[MQTT5-3.1.0-1] Connect must be first packet on socket")
       getattr(self, MQTTV5.Packets.Names[packet.fh.PacketType].lower())(sock, packet)
       if sock in self.clients.keys():
         self.clients[sock].lastPacket = time.monotonic()
@@ -403,148 +516,208 @@ class MQTTBrokers:
       terminate = True
     return terminate
 
-  def connect(self, sock, packet):
-    resp = MQTTV5.Connacks()
-    if packet.ProtocolName != "MQTT":
-      self.disconnect(sock, None)
-      raise MQTTV5.MQTTException("[MQTT5-3.1.2-1-error] Wrong protocol name %s" % packet.ProtocolName)
-    logger.info("[MQTT5-3.1.2-1] Protocol name must be MQTT")
-    if packet.ProtocolVersion != 5:
-      logger.error("[MQTT5-3.1.2-2-error] Wrong protocol version %d", packet.ProtocolVersion)
-      resp.reasonCode.set("Unsupported protocol version")
-      respond(sock, resp)
-      logger.info("[MQTT5-3.2.2-6] must set session present to 0 with non-zero connack")
-      logger.info("[MQTT5-3.2.2-7] must close connection after connack reason >= 0x80")
-      self.disconnect(sock, None)
-      logger.info("[MQTT5-3.1.4-6] When rejecting connect, no more data must be processed")
-      return
-    logger.info("[MQTT5-3.1.2-2] Protocol version must be 5")
-    if sock in self.clients.keys():    # is socket is already connected?
-      self.disconnect(sock, None)
-      logger.info("[MQTT5-3.1.4-6] When rejecting connect, no more data must be processed")
-      raise MQTTV5.MQTTException("[MQTT5-3.1.0-2] Second connect packet")
-    if len(packet.ClientIdentifier) == 0:
-      packet.ClientIdentifier = str(uuid.uuid4()) # give the client a unique clientid
-      logger.info("[MQTT5-3.1.3-6] 0-length clientid must be assigned a unique id %s", packet.ClientIdentifier)
-      resp.properties.AssignedClientIdentifier = packet.ClientIdentifier # returns the assigned client id
-      logger.info("[MQTT5-3.1.3-7] must return the assigned client id")
-    else:
-      logger.info("[MQTT5-3.1.3-5] Clientids of 1 to 23 chars and ascii alphanumeric must be allowed")
-      if False: # reject clientid test
-        logger.info("[MQTT5-3.1.3-8] server rejects clientid - may return connack")
-    if packet.ClientIdentifier in [client.id for client in self.clients.values()]: # is this client already connected on a different socket?
-      for cursock in self.clients.keys():
-        if self.clients[cursock].id == packet.ClientIdentifier:
-          logger.info("[MQTT5-3.1.4-3] Disconnecting old client %s", packet.ClientIdentifier)
-          self.disconnect(cursock, reasonCode="Session taken over")
-          break
-    me = None
-    clean = False
-    if packet.CleanStart:
-      logger.info("[MQTT5-3.1.2-4] discard existing session when cleanstart set to 1")
-      logger.info("[MQTT5-3.1.4-4] server must perform clean start processing")
-      clean = True
-      logger.info("[MQTT5-3.2.2-2] session present must be set to 0 if cleanstart is 1")
+  def handleAck(self, sock, ackType, packetIdentifier):
+    "an ack from a connected client, with the success reason code and no properties"
+    if ackType == MQTTV5.PacketTypes.PUBACK:
+      self.clients[sock].puback(packetIdentifier)
+    elif ackType == MQTTV5.PacketTypes.PUBREC:
+      self.pubrecArrived(sock, packetIdentifier)
+    elif ackType == MQTTV5.PacketTypes.PUBREL:
+      self.pubrelArrived(sock, packetIdentifier, None)
     else:
-      me = self.broker.getClient(packet.ClientIdentifier) # find existing state, if there is any
-      if not me:
-        logger.info("[MQTT5-3.1.2-6] no existing session and cleanstart set to 0")
-      # has that state expired?
-      if me and me.sessionExpiryInterval >= 0 and time.monotonic() - me.sessionEndedTime > me.sessionExpiryInterval:
-        me = None
+      self.clients[sock].pubcomp(packetIdentifier)
+    if sock in self.clients.keys():
+      self.clients[sock].lastPacket = time.monotonic()
+    return False
+
+  def connect(self, sock, packet):
+    with self.lock:
+      resp = MQTTV5.Connacks()
+      if packet.ProtocolName != "MQTT":
+        self.disconnect(sock, None)
+        raise MQTTV5.MQTTException("[MQTT5-3.1.2-1-error] Wrong protocol name %s" % packet.ProtocolName)
+      statements.info("[MQTT5-3.1.2-1] Protocol name must be MQTT")
+      if packet.ProtocolVersion != 5:
+        logger.error("[MQTT5-3.1.2-2-error] Wrong protocol version %d", packet.ProtocolVersion)
+        resp.reasonCode.set("Unsupported protocol version")
+        respond(sock, resp)
+        statements.info("[MQTT5-3.2.2-6] must set session present to 0 with non-zero connack")
+        statements.info("[MQTT5-3.2.2-7] must close connection after connack reason >= 0x80")
+        self.disconnect(sock, None)
+        statements.info("[MQTT5-3.1.4-6] When rejecting connect, no more data must be processed")
+        return
+      statements.info("[MQTT5-3.1.2-2] Protocol version must be 5")
+      if sock in self.clients.keys():    # is socket is already connected?
+        self.disconnect(sock, None)
+        statements.info("[MQTT5-3.1.4-6] When rejecting connect, no more data must be processed")
+        raise MQTTV5.MQTTException("[MQTT5-3.1.0-2] Second connect packet")
+      if len(packet.ClientIdentifier) == 0:
+        packet.ClientIdentifier = str(uuid.uuid4()) # give the client a unique clientid
+        statements.info("[MQTT5-3.1.3-6] 0-length clientid must be assigned a unique id %s", packet.ClientIdentifier)
+        resp.properties.AssignedClientIdentifier = packet.ClientIdentifier # returns the assigned client id
+        statements.info("[MQTT5-3.1.3-7] must return the assigned client id")
+      else:
+        statements.info("[MQTT5-3.1.3-5] Clientids of 1 to 23 chars and ascii alphanumeric must be allowed")
+        if False: # reject clientid test
+          statements.info("[MQTT5-3.1.3-8] server rejects clientid - may return connack")
+      if packet.ClientIdentifier in self.sockets: # is this client already connected on a different socket?
+        statements.info("[MQTT5-3.1.4-3] Disconnecting old client %s", packet.ClientIdentifier)
+        self.disconnect(self.sockets[packet.ClientIdentifier], reasonCode="Session taken over")
+      me = None
+      clean = False
+      if packet.CleanStart:
+        statements.info("[MQTT5-3.1.2-4] discard existing session when cleanstart set to 1")
+        statements.info("[MQTT5-3.1.4-4] server must perform clean start processing")
         clean = True
+        statements.info("[MQTT5-3.2.2-2] session present must be set to 0 if cleanstart is 1")
       else:
-        logger.info("[MQTT5-3.1.2-5] resume an existing session when cleanstart set to 0")
-      if me:
-        logger.info("[MQTT5-3.1.3-2] clientid used to retrieve client state")
-        logger.info("[MQTT5-3.2.2-3] session present must be set to 1")
-    resp.sessionPresent = True if me else False
-    # Connack topic alias maximum for incoming client created topic aliases
-    if self.options["topicAliasMaximum"] > 0:
-      resp.properties.TopicAliasMaximum = self.options["topicAliasMaximum"]
-    if self.options["maximumPacketSize"] < MQTTV5.MAX_PACKET_SIZE:
-      resp.properties.MaximumPacketSize = self.options["maximumPacketSize"]
-    if self.options["receiveMaximum"] < MQTTV5.MAX_PACKETID:
-      resp.properties.ReceiveMaximum = self.options["receiveMaximum"]
-    keepalive = packet.KeepAliveTimer
-    if packet.KeepAliveTimer > 0 and self.options["serverKeepAlive"] < packet.KeepAliveTimer:
-      keepalive = self.options["serverKeepAlive"]
-      resp.properties.ServerKeepAlive = keepalive
-      logger.info("[MQTT5-3.1.2-21] client must use server keep alive if returned on connack")
-    # Session expiry
-    if hasattr(packet.properties, "SessionExpiryInterval"):
-      sessionExpiryInterval = packet.properties.SessionExpiryInterval
-    else:
-      sessionExpiryInterval = 0 # immediate expiry - change to spec
-    # will delay
-    willDelayInterval = 0
-    if hasattr(packet.WillProperties, "WillDelayInterval"):
-      willDelayInterval = packet.WillProperties.WillDelayInterval
-      delattr(packet.WillProperties, "WillDelayInterval") # must not be sent with will message
-    if willDelayInterval > sessionExpiryInterval:
-      willDelayInterval = sessionExpiryInterval
-    if me == None:
-      me = MQTTClients(packet.ClientIdentifier, packet.CleanStart, sessionExpiryInterval, willDelayInterval, keepalive, sock, self)
-    else:
-      me.socket = sock # set existing client state to new socket
-      me.cleanStart = packet.CleanStart
-      me.keepalive = keepalive
-      me.sessionExpiryInterval = sessionExpiryInterval
-      me.willDelayInterval = willDelayInterval
-    if me.delayedWillTime:
-      me.delayedWillTime = None
-      logger.info("[MQTT5-3.1.3-9] don't send delayed will if client connects in time")
-    if me.id in self.broker.willMessageClients:
-      self.broker.willMessageClients.remove(me.id)
-    # the topic alias maximum in the connect properties sets the maximum outgoing topic aliases for a client
-    me.topicAliasMaximum = packet.properties.TopicAliasMaximum if hasattr(packet.properties, "TopicAliasMaximum") else 0
-    me.maximumPacketSize = packet.properties.MaximumPacketSize if hasattr(packet.properties, "MaximumPacketSize") else MQTTV5.MAX_PACKET_SIZE
-    assert me.maximumPacketSize <= MQTTV5.MAX_PACKET_SIZE # is this the correct value?
-    me.receiveMaximum = packet.properties.ReceiveMaximum if hasattr(packet.properties, "ReceiveMaximum") else MQTTV5.MAX_PACKETID
-    assert me.receiveMaximum <= MQTTV5.MAX_PACKETID
-    logger.info("[MQTT-4.1.0-1] server must store data for at least as long as the network connection lasts")
-    self.clients[sock] = me
-    me.will = (packet.WillTopic, packet.WillQoS, packet.WillMessage, packet.WillRETAIN, packet.WillProperties) if packet.WillFlag else None
-    if me.will != None:
-      logger.info("[MQTT5-3.1.2-7] the will message must be stored if the WillFlag is set")
-    self.broker.connect(me, clean)
-    logger.info("[MQTT5-3.2.0-1] the first response to a client must be a connack")
-    logger.info("[MQTT5-3.1.4-5] the server must acknowledge the connect with a connack success")
-    resp.reasonCode.set("Success")
-    respond(sock, resp)
-    me.resend()
+        me = self.broker.getClient(packet.ClientIdentifier) # find existing state, if there is any
+        if not me:
+          statements.info("[MQTT5-3.1.2-6] no existing session and cleanstart set to 0")
+        # has that state expired?
+        if me and (me.expired or me.sessionExpiryInterval >= 0 and
+                   time.monotonic() - me.sessionEndedTime > me.sessionExpiryInterval):
+          me = None
+          clean = True
+        else:
+          statements.info("[MQTT5-3.1.2-5] resume an existing session when cleanstart set to 0")
+        if me:
+          statements.info("[MQTT5-3.1.3-2] clientid used to retrieve client state")
+          statements.info("[MQTT5-3.2.2-3] session present must be set to 1")
+      resp.sessionPresent = True if me else False
+      # Connack topic alias maximum for incoming client created topic aliases
+      if self.options["topicAliasMaximum"] > 0:
+        resp.properties.TopicAliasMaximum = self.options["topicAliasMaximum"]
+      if self.options["maximumPacketSize"] < MQTTV5.MAX_PACKET_SIZE:
+        resp.properties.MaximumPacketSize = self.options["maximumPacketSize"]
+      if self.options["receiveMaximum"] < MQTTV5.MAX_PACKETID:
+        resp.properties.ReceiveMaximum = self.options["receiveMaximum"]
+      keepalive = packet.KeepAliveTimer
+      if packet.KeepAliveTimer > 0 and self.options["serverKeepAlive"] < packet.KeepAliveTimer:
+        keepalive = self.options["serverKeepAlive"]
+        resp.properties.ServerKeepAlive = keepalive
+        statements.info("[MQTT5-3.1.2-21] client must use server keep alive if returned on connack")
+      # Session expiry
+      if hasattr(packet.properties, "SessionExpiryInterval"):
+        sessionExpiryInterval = packet.properties.SessionExpiryInterval
+      else:
+        sessionExpiryInterval = 0 # immediate expiry - change to spec
+      # will delay
+      willDelayInterval = 0
+      if hasattr(packet.WillProperties, "WillDelayInterval"):
+        willDelayInterval = packet.WillProperties.WillDelayInterval
+        delattr(packet.WillProperties, "WillDelayInterval") # must not be sent with will message
+      if willDelayInterval > sessionExpiryInterval:
+        willDelayInterval = sessionExpiryInterval
+      if me == None:
+        old = self.broker.getClient(packet.ClientIdentifier)
+        if old != None:
+          self.cancelTimers(old)
+          old.discardQueued() # the session being replaced
+        me = MQTTClients(packet.ClientIdentifier, packet.CleanStart, sessionExpiryInterval, willDelayInterval, keepalive, sock, self)
+      else:
+        me.socket = sock # set existing client state to new socket
+        me.cleanStart = packet.CleanStart
+        me.keepalive = keepalive
+        me.sessionExpiryInterval = sessionExpiryInterval
+        me.willDelayInterval = willDelayInterval
+      self.cancelTimers(me) # the will delay and session expiry
+      if me.delayedWillTime:
+        me.delayedWillTime = None
+        statements.info("[MQTT5-3.1.3-9] don't send delayed will if client connects in time")
+      if me.id in self.broker.willMessageClients:
+        self.broker.willMessageClients.remove(me.id)
+      # the topic alias maximum in the connect properties sets the maximum outgoing topic aliases for a client
+      me.topicAliasMaximum = packet.properties.TopicAliasMaximum if hasattr(packet.properties, "TopicAliasMaximum") else 0
+      me.maximumPacketSize = packet.properties.MaximumPacketSize if hasattr(packet.properties, "MaximumPacketSize") else MQTTV5.MAX_PACKET_SIZE
+      assert me.maximumPacketSize <= MQTTV5.MAX_PACKET_SIZE # is this the correct value?
+      me.receiveMaximum = packet.properties.ReceiveMaximum if hasattr(packet.properties, "ReceiveMaximum") else MQTTV5.MAX_PACKETID
+      assert me.receiveMaximum <= MQTTV5.MAX_PACKETID
+      statements.info("[MQTT-4.1.0-1] server must store data for at least as long as the network connection lasts")
+      if self.options["concurrency"] == "fine":
+        OutboundQueues.attach(sock)
+      self.clients[sock] = me
+      self.sockets[me.id] = sock
+      me.will = (packet.WillTopic, packet.WillQoS, packet.WillMessage, packet.WillRETAIN, packet.WillProperties) if packet.WillFlag else None
+      if me.will != None:
+        statements.info("[MQTT5-3.1.2-7] the will message must be stored if the WillFlag is set")
+      self.broker.connect(me, clean)
+      if me.keepalive > 0:
+        me.lastPacket = time.monotonic()
+        due = me.lastPacket + me.keepalive * 1.5
+        self.setTimer(me, "keepalive", due, self.keepaliveTimeout, due)
+      statements.info("[MQTT5-3.2.0-1] the first response to a client must be a connack")
+      statements.info("[MQTT5-3.1.4-5] the server must acknowledge the connect with a connack success")
+      resp.reasonCode.set("Success")
+      respond(sock, resp)
+      me.resend()
 
   def disconnect(self, sock, packet=None, sendWillMessage=False, reasonCode=None, properties=None):
-    logger.info("[MQTT-3.14.4-2] Client must not send any more packets after disconnect")
-    me = self.clients[sock]
-    me.clearTopicAliases()
-    # Session expiry
-    if packet and hasattr(packet.properties, "SessionExpiryInterval"):
-      if me.sessionExpiryInterval == 0 and packet.properties.SessionExpiryInterval > 0:
-        raise MQTTV5.ProtocolError("[MQTT-3.1.0-2] Can't reset SessionExpiryInterval from 0")
+    with self.lock:
+      statements.info("[MQTT-3.14.4-2] Client must not send any more packets after disconnect")
+      me = self.clients[sock]
+      me.clearTopicAliases()
+      # Session expiry
+      if packet and hasattr(packet.properties, "SessionExpiryInterval"):
+        if me.sessionExpiryInterval == 0 and packet.properties.SessionExpiryInterval > 0:
+          raise MQTTV5.ProtocolError("[MQTT-3.1.0-2] Can't reset SessionExpiryInterval from 0")
+        else:
+          me.sessionExpiryInterval = packet.properties.SessionExpiryInterval
+      if reasonCode:
+        resp = MQTTV5.Disconnects(reasonCode=reasonCode) # reasonCode is text
+        if properties:
+          resp.properties = properties
+        respond(sock, resp)
+      if sock in self.clients.keys():
+        self.cancelTimers(me)
+        self.broker.disconnect(me.id, willMessage=sendWillMessage,
+            sessionExpiryInterval=me.sessionExpiryInterval)
+        if me.sessionExpiryInterval == 0:
+          me.discardQueued()
+        else:
+          if me.delayedWillTime != None:
+            self.setTimer(me, "will", me.delayedWillTime, self.willDelayed)
+          if me.sessionExpiryInterval != NEVER_EXPIRES:
+            self.setTimer(me, "expiry", me.sessionEndedTime + me.sessionExpiryInterval, self.reaper.sessionExpired)
+        del self.clients[sock]
+        if self.sockets.get(me.id) is sock:
+          del self.sockets[me.id]
+    # a slow or full socket mustn't hold up the other clients' connects and disconnects
+    closeSocket(sock)
+
+  def setTimer(self, client, name, when, action, *args):
+    "schedule action(client, *args) at a time from time.monotonic, replacing the client's timer of that name"
+    if name in client.timers:
+      self.timers.cancel(client.timers[name])
+    client.timers[name] = self.timers.scheduleAt(when, action, client, *args)
+
+  def cancelTimers(self, client):
+    for timer in client.timers.values():
+      self.timers.cancel(timer)
+    client.timers = {}
+
+  def keepaliveTimeout(self, client, due):
+    "a client's keepalive timer, due at due, has fired: close its connection if nothing has arrived since"
+    if client.connected and self.clients.get(client.socket) is client:
+      if client.lastPacket + client.keepalive * 1.5 > due:
+        due = client.lastPacket + client.keepalive * 1.5
+        self.setTimer(client, "keepalive", due, self.keepaliveTimeout, due)
       else:
-        me.sessionExpiryInterval = packet.properties.SessionExpiryInterval
-    if reasonCode:
-      resp = MQTTV5.Disconnects(reasonCode=reasonCode) # reasonCode is text
-      if properties:
-        resp.properties = properties
-      respond(sock, resp)
-    if sock in self.clients.keys():
-      self.broker.disconnect(me.id, willMessage=sendWillMessage,
-          sessionExpiryInterval=me.sessionExpiryInterval)
-      del self.clients[sock]
-    try:
-      sock.shutdown(socket.SHUT_RDWR) # must call shutdown to close socket immediately
-    except:
-      pass # doesn't matter if the socket has been closed at the other end already
-    try:
-      sock.close()
-    except:
-      pass # doesn't matter if the socket has been closed at the other end already
+        statements.info("[MQTT5-3.1.2-22] keepalive timeout for client %s", client.id)
+        close(client.socket) # its handler then disconnects it, sending the will message
+        OutboundQueues.flush()
+
+  def willDelayed(self, client):
+    "the will delay of a disconnected client has passed"
+    with self.lock:
+      if client.delayedWillTime != None and self.broker.getClient(client.id) is client:
+        self.broker.sendWillMessage(client.id)
+    OutboundQueues.flush()
 
   def disconnectAll(self):
     for sock in list(self.clients.keys())[:]:
       self.disconnect(sock, None)
+    OutboundQueues.flush()
 
   def subscribe(self, sock, packet):
     topics = []
@@ -567,11 +740,11 @@ class MQTTBrokers:
     if len(topics) > 0:
       self.broker.subscribe(self.clients[sock].id, topics, optionss)
     resp = MQTTV5.Subacks()
-    logger.info("[MQTT5-2.2.1-6-suback] Suback has same message id as subscribe")
-    logger.info("[MQTT-3.8.4-1] Must respond with suback")
+    statements.info("[MQTT5-2.2.1-6-suback] Suback has same message id as subscribe")
+    statements.info("[MQTT-3.8.4-1] Must respond with suback")
     resp.packetIdentifier = packet.packetIdentifier
-    logger.info("[MQTT-3.8.4-5] return code must be returned for each topic in subscribe")
-    logger.info("[MQTT-3.9.3-1] the order of return codes must match order of topics in subscribe")
+    statements.info("[MQTT-3.8.4-5] return code must be returned for each topic in subscribe")
+    statements.info("[MQTT-3.9.3-1] the order of return codes must match order of topics in subscribe")
     resp.reasonCodes = respqoss
     # propagating user property is broker specific behaviour, to aid testing
     if hasattr(packet.properties, "UserProperty"):
@@ -581,11 +754,11 @@ class MQTTBrokers:
   def unsubscribe(self, sock, packet):
     reasonCodes = self.broker.unsubscribe(self.clients[sock].id, packet.topicFilters)
     resp = MQTTV5.Unsubacks()
-    logger.info("[MQTT5-2.2.1-6-unsuback] Unsuback has same message id as unsubscribe")
-    logger.info("[MQTT-3.10.4-4] Unsuback must be sent - same message id as unsubscribe")
+    statements.info("[MQTT5-2.2.1-6-unsuback] Unsuback has same message id as unsubscribe")
+    statements.info("[MQTT-3.10.4-4] Unsuback must be sent - same message id as unsubscribe")
     me = self.clients[sock]
     if len(me.outbound) > 0:
-      logger.info("[MQTT-3.10.4-3] sending unsuback has no effect on outward inflight messages")
+      statements.info("[MQTT-3.10.4-3] sending unsuback has no effect on outward inflight messages")
     # propagating user property is broker specific behaviour, to aid testing
     if hasattr(packet.properties, "UserProperty"):
       resp.properties.UserProperty = packet.properties.UserProperty
@@ -599,27 +772,33 @@ class MQTTBrokers:
       raise MQTTV5.AcksProtocolError("Topic name invalid %s" % packet.topicName)
     # Test Topic to disconnect the client
     if packet.topicName.startswith("cmd/"):
-        self.handleBehaviourPublish(sock, packet.topicName, packet.data)
+        self.handleBehaviourPublish(sock, packet.topicName, packet.payload())
     else:
+        if packet.fh.QoS > 0 or packet.fh.RETAIN:
+          # kept in sessions or as the retained message, so copied out of the received packet
+          packet.data = packet.payload()
         if packet.fh.QoS > 0 and len(self.clients[sock].inbound) >= self.options["receiveMaximum"]:
           self.disconnect(sock, reasonCode="Receive maximum of %d exceeded: %d" % 
              (self.options["receiveMaximum"], len(self.clients[sock].inbound)+1), sendWillMessage=True)
           return
         if hasattr(packet.properties, "UserProperty") and len(packet.properties.UserProperty) > 1:
-          logger.info("[MQTT-3.1.3-10] Must maintain order of user properties")
+          statements.info("[MQTT-3.1.3-10] Must maintain order of user properties")
         if packet.fh.QoS == 0:
           self.broker.publish(self.clients[sock].id, packet.topicName,
                  packet.data, packet.fh.QoS, packet.fh.RETAIN, packet.properties,
                  packet.receivedTime)
         elif packet.fh.QoS == 1:
           if packet.fh.DUP:
-            logger.info("[MQTT-3.3.1-3] Incoming publish DUP 1 ==> outgoing publish with DUP 0")
-            logger.info("[MQTT-4.3.2-2] server must store message in accordance with QoS 1")
+            statements.info("[MQTT-3.3.1-3] Incoming publish DUP 1 ==> outgoing publish with DUP 0")
+            statements.info("[MQTT-4.3.2-2] server must store message in accordance with QoS 1")
           subscribers = self.broker.publish(self.clients[sock].id, packet.topicName,
                 packet.data, packet.fh.QoS, packet.fh.RETAIN, packet.properties,
                 packet.receivedTime)
+          statements.info("[MQTT5-2.2.1-5-puback] puback message id same as publish")
+          if subscribers != None and packet.topicName != "test_qos_1_2_errors":
+            respondPlain(sock, MQTTV5.PacketTypes.PUBACK, packet.packetIdentifier)
+            return
           resp = MQTTV5.Pubacks()
-          logger.info("[MQTT5-2.2.1-5-puback] puback message id same as publish")
           resp.packetIdentifier = packet.packetIdentifier
           if subscribers == None:
             resp.reasonCode.set("No matching subscribers")
@@ -636,7 +815,7 @@ class MQTTBrokers:
               if packet.fh.DUP == 0:
                 logger.error("[MQTT-3.3.1-2] duplicate QoS 2 message id %d found with DUP 0", packet.packetIdentifier)
               else:
-                logger.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
+                statements.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
             else:
               myclient.inbound[packet.packetIdentifier] = packet
               if len(packet.topicName) == 0 and hasattr(packet.properties, "TopicAlias"):
@@ -647,10 +826,10 @@ class MQTTBrokers:
               if packet.fh.DUP == 0:
                 logger.error("[MQTT-3.3.1-2] duplicate QoS 2 message id %d found with DUP 0", packet.packetIdentifier)
               else:
-                logger.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
+                statements.info("[MQTT-3.3.1-2] DUP flag is 1 on redelivery")
             else:
-              myclient.inbound.append(packet.packetIdentifier)
-              logger.info("[MQTT-4.3.3-2] server must store message in accordance with QoS 2")
+              myclient.inbound.add(packet.packetIdentifier)
+              statements.info("[MQTT-4.3.3-2] server must store message in accordance with QoS 2")
               if len(packet.topicName) == 0 and hasattr(packet.properties, "TopicAlias"):
                 packet.topicName = self.broker.getAliasTopic(self.clients[sock].id, packet.properties.TopicAlias)
               subscribers = self.broker.publish(self.clients[sock].id, packet.topicName,
@@ -658,8 +837,11 @@ class MQTTBrokers:
                    packet.receivedTime)
               if packet.topicName == "test_qos_1_2_errors_pubcomp":
                 myclient.pubcomp_error = packet.packetIdentifier
+          statements.info("[MQTT5-2.2.1-5-pubrec] pubrec message id same as publish")
+          if subscribers != None and packet.topicName != "test_qos_1_2_errors":
+            respondPlain(sock, MQTTV5.PacketTypes.PUBREC, packet.packetIdentifier)
+            return
           resp = MQTTV5.Pubrecs()
-          logger.info("[MQTT5-2.2.1-5-pubrec] pubrec message id same as publish")
           resp.packetIdentifier = packet.packetIdentifier
           if subscribers == None:
             resp.reasonCode.set("No matching subscribers")
@@ -695,35 +877,41 @@ class MQTTBrokers:
 
 
   def pubrel(self, sock, packet):
+    self.pubrelArrived(sock, packet.packetIdentifier, packet.properties)
+
+  def pubrelArrived(self, sock, packetIdentifier, properties):
+    "properties is None for a pubrel which had none"
     myclient = self.clients[sock]
-    pub = myclient.pubrel(packet.packetIdentifier)
+    pub = myclient.pubrel(packetIdentifier)
     if pub:
       if self.options["publish_on_pubrel"]:
         self.broker.publish(myclient.id, pub.topicName, pub.data, pub.fh.QoS, pub.fh.RETAIN, pub.properties,
                 pub.receivedTime)
-        del myclient.inbound[packet.packetIdentifier]
+        del myclient.inbound[packetIdentifier]
       else:
-        myclient.inbound.remove(packet.packetIdentifier)
+        myclient.inbound.remove(packetIdentifier)
+    statements.info("[MQTT5-2.2.1-5-pubcomp] pubcomp message id same as publish")
+    if pub and not (hasattr(pub, "topicName") and pub.topicName == "test_qos_1_2_errors_pubcomp") and \
+         not (hasattr(myclient, "pubcomp_error") and myclient.pubcomp_error == packetIdentifier):
+      respondPlain(sock, MQTTV5.PacketTypes.PUBCOMP, packetIdentifier)
+      return
     resp = MQTTV5.Pubcomps()
-    logger.info("[MQTT5-2.2.1-5-pubcomp] pubcomp message id same as publish")
-    resp.packetIdentifier = packet.packetIdentifier
+    resp.packetIdentifier = packetIdentifier
     if not pub:
       resp.reasonCode.set("Packet identifier not found")
-      resp.properties.ReasonString = "Looking for packet id "+str(packet.packetIdentifier)
-    elif (hasattr(pub, "topicName") and pub.topicName == "test_qos_1_2_errors_pubcomp") or \
-         (hasattr(myclient, "pubcomp_error") and myclient.pubcomp_error == packet.packetIdentifier):
+      resp.properties.ReasonString = "Looking for packet id "+str(packetIdentifier)
+    else:
       resp.reasonCode.set("Packet identifier not found")
-      if hasattr(packet.properties, "UserProperty"):
-        resp.properties.UserProperty = packet.properties.UserProperty
+      if properties != None and hasattr(properties, "UserProperty"):
+        resp.properties.UserProperty = properties.UserProperty
       if hasattr(myclient, "pubcomp_error"):
         del myclient.pubcomp_error
     respond(sock, resp)
 
   def pingreq(self, sock, packet):
-    logger.info("[MQTT5-3.1.2-20] client must send ping in the absence of other packets")
-    resp = MQTTV5.Pingresps()
-    logger.info("[MQTT-3.12.4-1] sending pingresp in response to pingreq")
-    respond(sock, resp)
+    statements.info("[MQTT5-3.1.2-20] client must send ping in the absence of other packets")
+    statements.info("[MQTT-3.12.4-1] sending pingresp in response to pingreq")
+    respondPlain(sock, MQTTV5.PacketTypes.PINGRESP)
 
   def puback(self, sock, packet):
     "confirmed reception of qos 1"
@@ -731,22 +919,16 @@ class MQTTBrokers:
 
   def pubrec(self, sock, packet):
     "confirmed reception of qos 2"
+    self.pubrecArrived(sock, packet.packetIdentifier)
+
+  def pubrecArrived(self, sock, packetIdentifier):
     myclient = self.clients[sock]
-    if myclient.pubrec(packet.packetIdentifier):
-      logger.info("[MQTT-3.5.4-1] must reply with pubrel in response to pubrec")
-      resp = MQTTV5.Pubrels()
-      logger.info("[MQTT5-2.2.1-5-pubrel] pubrel message id same as publish")
-      resp.packetIdentifier = packet.packetIdentifier
-      respond(sock, resp)
+    if myclient.pubrec(packetIdentifier):
+      statements.info("[MQTT-3.5.4-1] must reply with pubrel in response to pubrec")
+      statements.info("[MQTT5-2.2.1-5-pubrel] pubrel message id same as publish")
+      respondPlain(sock, MQTTV5.PacketTypes.PUBREL, packetIdentifier)
 
   def pubcomp(self, sock, packet):
     "confirmed reception of qos 2"
     self.clients[sock].pubcomp(packet.packetIdentifier)
 
-  def keepalive(self, sock):
-    if sock in self.clients.keys():
-      client = self.clients[sock]
-      if client.keepalive > 0 and time.monotonic() - client.lastPacket > client.keepalive * 1.5:
-        # keep alive timeout
-        logger.info("[MQTT5-3.1.2-22] keepalive timeout for client %s", client.id)
-        self.disconnect(sock, None, sendWillMessage=True)
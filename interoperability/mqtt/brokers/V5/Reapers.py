@@ -0,0 +1,116 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+The reaper, which frees expired sessions and queued messages.
+
+The brokers' timer wheel keeps sessions and queued messages in order of expiry.  When
+they expire, it adds them to the reaper's queues, and the reaper frees them in batches of
+at most batchSize subscriptions or messages, releasing the broker lock between batches.
+While an expired session's subscriptions and queued messages are being freed, it is
+marked as expired, so that no more messages are queued for it, and a client connecting
+with the same client id gets a new session.
+"""
+
+import threading, collections, logging
+
+from .. import OutboundQueues
+
+logger = logging.getLogger('MQTT broker')
+
+
+class Reapers(threading.Thread):
+
+  def __init__(self, broker, batchSize=100):
+    threading.Thread.__init__(self, name="reaper", daemon=True)
+    self.broker = broker # the MQTTBrokers object
+    self.batchSize = batchSize
+    self.sessions = collections.deque() # expired sessions' client objects, oldest first
+    self.messages = collections.deque() # (client object, message object) for expired queued messages
+    self.work = threading.Event()
+    self.running = True
+    # counts
+    self.sessionsReaped = 0
+    self.subscriptionsReaped = 0
+    self.messagesReaped = 0
+    self.batches = 0
+    self.start()
+
+  def sessionExpired(self, client):
+    "called by the timer for a session's expiry"
+    self.sessions.append(client)
+    self.work.set()
+
+  def messageExpired(self, client, pub):
+    "called by the timer for a queued message's expiry"
+    self.messages.append((client, pub))
+    self.work.set()
+
+  def run(self):
+    while self.running:
+      self.work.wait()
+      self.work.clear()
+      while self.running and self.reap():
+        pass
+
+  def reap(self):
+    "free one batch, returning whether there is any more to do"
+    count = 0
+    with self.broker.lock:
+      while count < self.batchSize and len(self.messages) > 0:
+        client, pub = self.messages.popleft()
+        if client.removeExpired(pub):
+          self.messagesReaped += 1
+        count += 1
+      while count < self.batchSize and len(self.sessions) > 0:
+        count += self.reapSession(self.sessions[0], self.batchSize - count)
+    self.batches += 1
+    OutboundQueues.flush()
+    return len(self.messages) > 0 or len(self.sessions) > 0
+
+  def reapSession(self, client, limit):
+    "free up to limit of an expired session's subscriptions and messages, returning how many were"
+    broker = self.broker.broker
+    if client.connected or broker.getClient(client.id) is not client:
+      self.sessions.popleft() # the client has come back, or the session has been replaced
+      return 1
+    if not client.expired:
+      logger.info("Session for client %s has expired", client.id)
+      client.expired = True
+      self.broker.cancelTimers(client)
+      if client.delayedWillTime != None:
+        broker.sendWillMessage(client.id) # the will delay ends with the session
+    count = broker.se.clearSubscriptions(client.id, limit)
+    self.subscriptionsReaped += count
+    if count < limit:
+      count += client.discardQueued(limit - count)
+    if count < limit:
+      broker.disconnect(client.id, sessionExpiryInterval=0) # remove what is left of the session
+      self.sessions.popleft()
+      self.sessionsReaped += 1
+      count += 1
+    return count
+
+  def stats(self):
+    return {"sessions": self.sessionsReaped, "subscriptions": self.subscriptionsReaped,
+            "messages": self.messagesReaped, "batches": self.batches,
+            "waiting": len(self.sessions) + len(self.messages)}
+
+  def stop(self):
+    self.running = False
+    self.work.set()
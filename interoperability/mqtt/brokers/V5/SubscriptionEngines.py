@@ -16,28 +16,43 @@
 *******************************************************************
 """
 
-import types, logging
+import types, logging, threading
 
 from . import Topics, Subscriptions
+from ..TopicTrees import TopicTrees, TopicNameTrees
 import mqtt.formats.MQTTV5 as MQTTV5
 
 from .Subscriptions import *
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 def isDollarTopic(name):
   return name[0] == '$' and not name.startswith('$share/')
 
 class SubscriptionEngines:
 
-   def __init__(self, sharedData={}):
+   def __init__(self, sharedData={}, locks=None):
      self.sharedData = sharedData
+     if locks == None:
+       locks = {"subscriptions": threading.RLock(), "retained": threading.RLock()}
+     # locks can't be persisted with the shared data, so engines sharing it are given the same locks
+     self.__locks = locks
+     self.__subscriptionsLock = locks["subscriptions"]
+     self.__retainedLock = locks["retained"]
      if "subscriptions" not in self.sharedData:
-       self.sharedData["subscriptions"] = []  # list of subscriptions
+       self.sharedData["subscriptions"] = {}  # map of clientids to maps of topic filters to subscriptions
      else:
        logger.info("Sharing subscription data")
      if "dollar_subscriptions" not in self.sharedData:
-       self.sharedData["dollar_subscriptions"] = []  # list of subscriptions
+       self.sharedData["dollar_subscriptions"] = {}  # map of clientids to maps of topic filters to subscriptions
+     for name in ["subscriptions", "dollar_subscriptions"]:
+       if type(self.sharedData[name]) == type([]):
+         # persisted as a list of subscriptions, so index it by clientid and topic filter
+         clients = {}
+         for s in self.sharedData[name]:
+           clients.setdefault(s.getClientid(), {})[s.getTopic()] = s
+         self.sharedData[name] = clients
      self.__subscriptions = self.sharedData["subscriptions"] 
      self.__dollar_subscriptions = self.sharedData["dollar_subscriptions"] 
      if "retained" not in self.sharedData:
@@ -45,23 +60,46 @@ class SubscriptionEngines:
      self.__retained = self.sharedData["retained"]
      if "dollar_retained" not in self.sharedData:
        self.sharedData["dollar_retained"] = {}  # map of topics to retained msg+qos
-     self.__dollar_retained = self.sharedData["dollar_retained"] 
+     self.__dollar_retained = self.sharedData["dollar_retained"]
+     if "subscription_trees" not in self.sharedData:
+       # index of topic filters, rebuilt from the subscriptions if they were persisted without it
+       self.sharedData["subscription_trees"] = {}
+       for name in ["subscriptions", "dollar_subscriptions"]:
+         # only MQTT V5 shared subscriptions, which are never $ topics, have a $share prefix
+         tree = TopicTrees(sharedPrefix=(name == "subscriptions"))
+         self.sharedData["subscription_trees"][name] = tree
+         for clientSubscriptions in self.sharedData[name].values():
+           for s in clientSubscriptions.values():
+             tree.add(s.getTopic(), s)
+     self.__tree = self.sharedData["subscription_trees"]["subscriptions"]
+     self.__dollar_tree = self.sharedData["subscription_trees"]["dollar_subscriptions"]
+     if "retained_trees" not in self.sharedData:
+       # index of retained topic names, rebuilt from the retained messages if they were persisted without it
+       self.sharedData["retained_trees"] = {}
+       for name in ["retained", "dollar_retained"]:
+         tree = TopicNameTrees()
+         self.sharedData["retained_trees"][name] = tree
+         for topicName in self.sharedData[name].keys():
+           tree.add(topicName)
+     self.__retained_tree = self.sharedData["retained_trees"]["retained"]
+     self.__dollar_retained_tree = self.sharedData["retained_trees"]["dollar_retained"]
 
    def reinitialize(self):
-     self.__init__()
+     self.__init__(locks=self.__locks)
 
    def subscribe(self, aClientid, topic, options):
-     if type(topic) == type([]):
-       rc = []
-       count = 0
-       for aTopic in topic:
-         rc.append(self.__subscribe(aClientid, aTopic, options[count]))
-         count += 1
-       if count > 1:
-         logger.info("[MQTT-3.8.4-4] Multiple topics in one subscribe")
-     else:
-       rc = self.__subscribe(aClientid, topic, options)
-     return rc
+     with self.__subscriptionsLock:
+       if type(topic) == type([]):
+         rc = []
+         count = 0
+         for aTopic in topic:
+           rc.append(self.__subscribe(aClientid, aTopic, options[count]))
+           count += 1
+         if count > 1:
+           statements.info("[MQTT-3.8.4-4] Multiple topics in one subscribe")
+       else:
+         rc = self.__subscribe(aClientid, topic, options)
+       return rc
 
    def __subscribe(self, aClientid, aTopic, options):
      "subscribe to one topic"
@@ -69,123 +107,152 @@ class SubscriptionEngines:
      resubscribed = False
      if Topics.isValidTopicName(aTopic):
        subscriptions = self.__subscriptions if not isDollarTopic(aTopic) else self.__dollar_subscriptions
-       for s in subscriptions:
-         if s.getClientid() == aClientid and s.getTopic() == aTopic:
-           s.resubscribe(options)
-           resubscribed = True
-       if not resubscribed:
+       tree = self.__tree if not isDollarTopic(aTopic) else self.__dollar_tree
+       clientSubscriptions = subscriptions.setdefault(aClientid, {})
+       if aTopic in clientSubscriptions:
+         clientSubscriptions[aTopic].resubscribe(options)
+         resubscribed = True
+       else:
          rc = Subscriptions(aClientid, aTopic, options)
-         subscriptions.append(rc)
+         clientSubscriptions[aTopic] = rc
+         tree.add(aTopic, rc)
      return rc, resubscribed
 
    def unsubscribe(self, aClientid, aTopic):
-     rc = []
-     matchedAny = False
-     if type(aTopic) == type([]):
-       if len(aTopic) > 1:
-         logger.info("[MQTT-3.10.4-6] each topic must be processed in sequence")
-       for t in aTopic:
-         matched = self.__unsubscribe(aClientid, t)
-         rc.append(MQTTV5.ReasonCodes(MQTTV5.PacketTypes.UNSUBACK, "Success") if matched else
-                   MQTTV5.ReasonCodes(MQTTV5.PacketTypes.UNSUBACK, "No subscription found"))
-         if not matchedAny:
-           matchedAny = matched
-     else:
-       matchedAny = self.__unsubscribe(aClientid, aTopic)
-       rc.append(ReasonCodes(UNSUBACK, "Success") if matched else ReasonCodes(UNSUBACK, "No subscription found"))
-     if not matchedAny:
-       logger.info("[MQTT-3.10.4-5] Unsuback must be sent even if no topics are matched")
-     return rc
+     with self.__subscriptionsLock:
+       rc = []
+       matchedAny = False
+       if type(aTopic) == type([]):
+         if len(aTopic) > 1:
+           statements.info("[MQTT-3.10.4-6] each topic must be processed in sequence")
+         for t in aTopic:
+           matched = self.__unsubscribe(aClientid, t)
+           rc.append(MQTTV5.ReasonCodes(MQTTV5.PacketTypes.UNSUBACK, "Success") if matched else
+                     MQTTV5.ReasonCodes(MQTTV5.PacketTypes.UNSUBACK, "No subscription found"))
+           if not matchedAny:
+             matchedAny = matched
+       else:
+         matchedAny = self.__unsubscribe(aClientid, aTopic)
+         rc.append(ReasonCodes(UNSUBACK, "Success") if matched else ReasonCodes(UNSUBACK, "No subscription found"))
+       if not matchedAny:
+         statements.info("[MQTT-3.10.4-5] Unsuback must be sent even if no topics are matched")
+       return rc
 
    def __unsubscribe(self, aClientid, aTopic):
      "unsubscribe to one topic"
      matched = False
      if Topics.isValidTopicName(aTopic):
        subscriptions = self.__subscriptions if not isDollarTopic(aTopic) else self.__dollar_subscriptions
-       for s in subscriptions:
-         if s.getClientid() == aClientid and s.getTopic() == aTopic:
-           logger.info("[MQTT-3.10.4-1] topic filters must be compared byte for byte")
-           logger.info("[MQTT-3.10.4-2] no more messages must be added after unsubscribe is complete")
-           subscriptions.remove(s)
-           matched = True
-           break # once we've hit one, that's us done
+       tree = self.__tree if not isDollarTopic(aTopic) else self.__dollar_tree
+       clientSubscriptions = subscriptions.get(aClientid, {})
+       if aTopic in clientSubscriptions:
+         statements.info("[MQTT-3.10.4-1] topic filters must be compared byte for byte")
+         statements.info("[MQTT-3.10.4-2] no more messages must be added after unsubscribe is complete")
+         tree.remove(aTopic, clientSubscriptions.pop(aTopic))
+         if len(clientSubscriptions) == 0:
+           del subscriptions[aClientid]
+         matched = True
      return matched
 
-   def clearSubscriptions(self, aClientid):
-     for subscriptions in [self.__subscriptions, self.__dollar_subscriptions]:
-       for s in subscriptions[:]:
-         if s.getClientid() == aClientid:
-           subscriptions.remove(s)
+   def clearSubscriptions(self, aClientid, limit=None):
+     "remove a client's subscriptions, or up to limit of them.  Returns how many were removed"
+     with self.__subscriptionsLock:
+       count = 0
+       for subscriptions, tree in [(self.__subscriptions, self.__tree),
+                                   (self.__dollar_subscriptions, self.__dollar_tree)]:
+         if limit == None:
+           for s in subscriptions.pop(aClientid, {}).values():
+             tree.remove(s.getTopic(), s)
+             count += 1
+         elif aClientid in subscriptions:
+           clientSubscriptions = subscriptions[aClientid]
+           while len(clientSubscriptions) > 0 and count < limit:
+             topic, s = clientSubscriptions.popitem()
+             tree.remove(topic, s)
+             count += 1
+           if len(clientSubscriptions) == 0:
+             del subscriptions[aClientid]
+       return count
 
    def getSubscriptions(self, aTopic, aClientid=None):
      "return a list of subscriptions for this client"
-     rc = None
-     if Topics.isValidTopicName(aTopic):
-       subscriptions = self.__subscriptions if not isDollarTopic(aTopic) else self.__dollar_subscriptions
-       if aClientid == None:
-         rc = [sub for sub in subscriptions if Topics.topicMatches(sub.getTopic(), aTopic)]
-       else:
-         rc = [sub for sub in subscriptions if sub.getClientid() == aClientid and Topics.topicMatches(sub.getTopic(), aTopic)]
-     return rc
+     with self.__subscriptionsLock:
+       rc = None
+       if Topics.isValidTopicName(aTopic):
+         tree = self.__tree if not isDollarTopic(aTopic) else self.__dollar_tree
+         if aClientid == None:
+           rc = tree.match(aTopic)
+         else:
+           rc = [sub for sub in tree.match(aTopic) if sub.getClientid() == aClientid]
+       return rc
 
    def optionsOf(self, clientid, topic):
-     # if there are overlapping subscriptions, choose maximum QoS
-     chosen = None
-     for sub in self.getSubscriptions(topic, clientid):
-       if chosen == None:
-         if hasattr(sub, "getOptions"):
-           chosen = sub.getOptions()
-         else: # MQTT V3 case
-           chosen = (MQTTV5.SubscribeOptions(QoS=sub.getQoS()), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))
-       else:
-         logger.info("[MQTT-3.3.5-1] Overlapping subscriptions max QoS")
-         if sub.getQoS() > chosen[0].QoS:
+     with self.__subscriptionsLock:
+       # if there are overlapping subscriptions, choose maximum QoS
+       chosen = None
+       for sub in self.getSubscriptions(topic, clientid):
+         if chosen == None:
            if hasattr(sub, "getOptions"):
              chosen = sub.getOptions()
            else: # MQTT V3 case
              chosen = (MQTTV5.SubscribeOptions(QoS=sub.getQoS()), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))
-       # Omit the following optimization because we want to check for condition [MQTT-3.3.5-1]
-       #if chosen == 2:
-       #  break
-     return chosen
+         else:
+           statements.info("[MQTT-3.3.5-1] Overlapping subscriptions max QoS")
+           if sub.getQoS() > chosen[0].QoS:
+             if hasattr(sub, "getOptions"):
+               chosen = sub.getOptions()
+             else: # MQTT V3 case
+               chosen = (MQTTV5.SubscribeOptions(QoS=sub.getQoS()), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))
+         # Omit the following optimization because we want to check for condition [MQTT-3.3.5-1]
+         #if chosen == 2:
+         #  break
+       return chosen
 
    def subscriptions(self, aTopic):
      "list all clients subscribed to this (non-wildcard) topic"
-     result = set()
-     if Topics.isValidTopicName(aTopic):
-       subscriptions = self.__subscriptions if not isDollarTopic(aTopic) else self.__dollar_subscriptions
-       for s in subscriptions:
-         if Topics.topicMatches(s.getTopic(), aTopic):
-           result.add(s) # don't add a subscription twice
-     return result
+     with self.__subscriptionsLock:
+       result = set()
+       if Topics.isValidTopicName(aTopic):
+         tree = self.__tree if not isDollarTopic(aTopic) else self.__dollar_tree
+         result.update(tree.match(aTopic)) # don't add a subscription twice
+       return result
 
    def setRetained(self, aTopic, aMessage, aQoS, receivedTime, properties):
      "set a retained message on a non-wildcard topic"
-     if Topics.isValidTopicName(aTopic):
-       retained = self.__retained if not isDollarTopic(aTopic) else self.__dollar_retained
-       if len(aMessage) == 0:
-         if aTopic in retained.keys():
-           logger.info("[MQTT-3.3.1-11] Deleting zero byte retained message")
-           del retained[aTopic]
-       else:
-         retained[aTopic] = (aMessage, aQoS, receivedTime, properties)
+     with self.__retainedLock:
+       if Topics.isValidTopicName(aTopic):
+         retained = self.__retained if not isDollarTopic(aTopic) else self.__dollar_retained
+         tree = self.__retained_tree if not isDollarTopic(aTopic) else self.__dollar_retained_tree
+         if len(aMessage) == 0:
+           if aTopic in retained.keys():
+             statements.info("[MQTT-3.3.1-11] Deleting zero byte retained message")
+             del retained[aTopic]
+             tree.remove(aTopic)
+         else:
+           tree.add(aTopic)
+           retained[aTopic] = (aMessage, aQoS, receivedTime, properties)
 
    def getRetained(self, aTopic):
      "returns (msg, QoS, properties) for a topic"
-     result = None
-     if Topics.isValidTopicName(aTopic):
-       retained = self.__retained if not isDollarTopic(aTopic) else self.__dollar_retained
-       if aTopic in retained.keys():
-         result = retained[aTopic]
-     return result
+     with self.__retainedLock:
+       result = None
+       if Topics.isValidTopicName(aTopic):
+         retained = self.__retained if not isDollarTopic(aTopic) else self.__dollar_retained
+         if aTopic in retained.keys():
+           result = retained[aTopic]
+       return result
 
    def getRetainedTopics(self, aTopic):
-     "returns a list of topics for which retained publications exist"
-     if Topics.isValidTopicName(aTopic):
-       retained = self.__retained if not isDollarTopic(aTopic) else self.__dollar_retained
-       return retained.keys()
-     else:
-       return None
+     "returns the topics matching a topic filter for which retained publications exist, in the order they were retained"
+     with self.__retainedLock:
+       if Topics.isValidTopicName(aTopic):
+         tree = self.__retained_tree if not isDollarTopic(aTopic) else self.__dollar_retained_tree
+         if aTopic.startswith('$share'):
+           # strip shared prefix $share/sharename/
+           aTopic = aTopic.split('/', 2)[2]
+         return tree.match(aTopic)
+       else:
+         return None
 
 
 def unit_tests():
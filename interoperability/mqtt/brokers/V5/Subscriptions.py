@@ -21,6 +21,7 @@ import time, logging
 #from mqtt.formats import MQTTV5
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 class Subscriptions:
 
@@ -42,8 +43,8 @@ class Subscriptions:
     return self.__options
 
   def resubscribe(self, options):
-    logger.info("[MQTT-1.1.0-1] resubscription for client %s on topic %s", self.__clientid, self.__topic)
-    logger.info("[MQTT-3.8.4-3] resubscription for client %s on topic %s", self.__clientid, self.__topic)
+    statements.info("[MQTT-1.1.0-1] resubscription for client %s on topic %s", self.__clientid, self.__topic)
+    statements.info("[MQTT-3.8.4-3] resubscription for client %s on topic %s", self.__clientid, self.__topic)
     self.__options = options
 
   def __repr__(self):
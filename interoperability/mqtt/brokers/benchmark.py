@@ -0,0 +1,639 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Broker benchmarks.  Run all of them with:
+
+  python3 -m mqtt.brokers.benchmark
+
+or a selection by name:
+
+  python3 -m mqtt.brokers.benchmark subscriptions retained
+"""
+
+import sys, os, time, random, socket, threading
+
+from .TopicTrees import TopicTrees, TopicNameTrees
+from .V5 import Topics
+from .V5.SubscriptionEngines import SubscriptionEngines
+import mqtt.formats.MQTTV5 as MQTTV5
+
+
+def timed(fn, iterations):
+  "return the average time in microseconds of one call of fn"
+  start = time.perf_counter()
+  for i in range(iterations):
+    fn()
+  return (time.perf_counter() - start) * 1000000 / iterations
+
+
+def makeFilters(count):
+  "a mixture of plain and wildcard topic filters, some of them overlapping"
+  filters = []
+  for i in range(count):
+    kind = i % 4
+    if kind == 0:
+      filters.append("sensors/%d/temperature" % i)
+    elif kind == 1:
+      filters.append("sensors/%d/+" % i)
+    elif kind == 2:
+      filters.append("sensors/%d/#" % i)
+    else:
+      filters.append("+/%d/humidity" % i)
+  return filters
+
+
+def subscriptions(counts=(100, 1000, 10000, 50000), iterations=20):
+  "compare matching a topic against a list of subscriptions with the topic tree index"
+  print("subscriptions: time to find the matching subscriptions for one publish")
+  print("%10s %15s %15s %10s" % ("filters", "list scan us", "tree us", "matches"))
+  for count in counts:
+    filters = makeFilters(count)
+    tree = TopicTrees()
+    for f in filters:
+      tree.add(f, f)
+    topic = "sensors/%d/temperature" % random.randrange(count)
+    listscan = lambda: [f for f in filters if Topics.topicMatches(f, topic)]
+    assert sorted(listscan()) == sorted(tree.match(topic))
+    print("%10d %15.1f %15.1f %10d" % (count,
+      timed(listscan, max(1, iterations * 100 // count)),
+      timed(lambda: tree.match(topic), iterations * 100), len(tree.match(topic))))
+
+
+def resubscriptions(counts=(100, 1000, 10000), filtersPerClient=10):
+  "time for one client to clear its subscriptions and subscribe again, as on a clean session reconnect"
+  print("resubscriptions: time for one client to clear and remake %d subscriptions" % filtersPerClient)
+  print("%10s %15s" % ("clients", "us"))
+  options = (MQTTV5.SubscribeOptions(1), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))
+  for count in counts:
+    se = SubscriptionEngines({})
+    for i in range(count):
+      filters = ["clients/%d/%d" % (i, j) for j in range(filtersPerClient)]
+      se.subscribe("client%d" % i, filters, [options] * filtersPerClient)
+    clientid = "client%d" % random.randrange(count)
+    filters = ["clients/%s/%d" % (clientid, j) for j in range(filtersPerClient)]
+    def resubscribe():
+      se.clearSubscriptions(clientid)
+      se.subscribe(clientid, filters, [options] * filtersPerClient)
+    print("%10d %15.1f" % (count, timed(resubscribe, 100)))
+
+
+def retained(counts=(1000, 10000, 100000), iterations=10):
+  "compare finding the retained topics which match a filter with a scan of all retained topics"
+  print("retained: time to find the retained topics matching one filter")
+  print("%10s %20s %15s %15s %10s" % ("topics", "filter", "list scan us", "tree us", "matches"))
+  for count in counts:
+    names = ["sensors/%d/%s" % (i, ["temperature", "humidity"][i % 2]) for i in range(count)]
+    tree = TopicNameTrees()
+    for name in names:
+      tree.add(name)
+    for aFilter in ["sensors/%d/temperature" % (count // 2), "sensors/+/humidity", "#"]:
+      listscan = lambda: [name for name in names if Topics.topicMatches(aFilter, name)]
+      assert listscan() == tree.match(aFilter)
+      print("%10d %20s %15.1f %15.1f %10d" % (count, aFilter,
+        timed(listscan, max(1, iterations * 1000 // count)),
+        timed(lambda: tree.match(aFilter), iterations), len(tree.match(aFilter))))
+
+
+def residentMemory():
+  "the resident memory of this process in MB, where /proc is available"
+  try:
+    with open("/proc/self/statm") as statm:
+      return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1000000
+  except OSError:
+    return 0
+
+
+def connections(kinds=("selector", "asyncio", "tcp"), counts=(100, 1000, 5000), samples=100, port=18900):
+  "ping round trip times as the number of idle connections to each kind of listener grows"
+  from .start import default_options
+  from .V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+  from .V5.MQTTBrokers import MQTTBrokers as MQTTV5Brokers
+  from .listeners import TCPListeners, SelectorListeners, AsyncioListeners
+  import mqtt.formats.MQTTV311 as MQTTV3
+  listeners = {"tcp": TCPListeners, "selector": SelectorListeners, "asyncio": AsyncioListeners}
+  print("connections: ping round trip with many idle connections")
+  print("%10s %10s %10s %10s %10s %10s" % ("listener", "clients", "median us", "max us", "threads", "RSS MB"))
+  for kind in kinds:
+    lock = threading.RLock()
+    sharedData = {}
+    broker3 = MQTTV3Brokers(options=default_options(), lock=lock, sharedData=sharedData)
+    broker5 = MQTTV5Brokers(options=default_options(), lock=lock, sharedData=sharedData)
+    listeners[kind].setBrokers(broker3, broker5)
+    server = listeners[kind].create(port, host="localhost")
+    time.sleep(.5)
+    sockets = []
+    try:
+      for count in counts:
+        while len(sockets) < count:
+          sock = socket.create_connection(("localhost", port), timeout=5)
+          sockets.append(sock)
+          connect = MQTTV3.Connects()
+          connect.ClientIdentifier = "%s%d" % (kind, len(sockets))
+          connect.KeepAliveTimer = 0
+          sock.sendall(connect.pack())
+          assert MQTTV3.getPacket(sock)[0] == 0x20 # connack
+        times = []
+        for sock in random.sample(sockets, min(samples, len(sockets))):
+          start = time.perf_counter()
+          sock.sendall(MQTTV3.Pingreqs().pack())
+          assert MQTTV3.getPacket(sock)[0] == 0xd0 # pingresp
+          times.append((time.perf_counter() - start) * 1000000)
+        times.sort()
+        print("%10s %10d %10.1f %10.1f %10d %10.1f" % (kind, count, times[len(times) // 2], times[-1],
+          threading.active_count(), residentMemory()))
+    except Exception as exc:
+      print("%10s failed at connection %d: %s" % (kind, len(sockets), repr(exc)))
+    finally:
+      for sock in sockets:
+        sock.close()
+      server.shutdown()
+      broker3.shutdown()
+      broker5.shutdown()
+    port += 1
+
+
+class CountingSockets:
+  "a socket which counts the reads made on it"
+
+  def __init__(self, sock):
+    self.socket = sock
+    self.reads = 0
+
+  def recv(self, bufsize):
+    self.reads += 1
+    return self.socket.recv(bufsize)
+
+  def recv_into(self, buffer):
+    self.reads += 1
+    return self.socket.recv_into(buffer)
+
+  def __getattr__(self, name):
+    return getattr(self.socket, name)
+
+
+def framing(count=100000):
+  "reads and time taken to receive small QoS 0 publishes, a byte at a time or with a packet framer"
+  from .listeners.TCPListeners import BufferedSockets
+  import mqtt.formats.MQTTV311 as MQTTV3
+  print("framing: receiving %d QoS 0 publishes with a 10 byte payload" % count)
+  print("%8s %12s %15s %15s" % ("codec", "reader", "reads/packet", "packets/s"))
+  for codec in [MQTTV3, MQTTV5]:
+    publish = codec.Publishes()
+    publish.topicName = "sensors/1/temperature"
+    publish.data = b"0123456789"
+    data = publish.pack() * 1000
+    for reader in ["byte-wise", "buffered", "framer"]:
+      client, server = socket.socketpair()
+      def send():
+        for i in range(count // 1000):
+          client.sendall(data)
+      sender = threading.Thread(target=send)
+      sender.start()
+      sock = CountingSockets(server)
+      received = 0
+      start = time.perf_counter()
+      if reader == "framer":
+        framer = codec.PacketFramers()
+        while received < count:
+          framer.fill(sock)
+          for packet in framer.packets():
+            received += 1
+      else:
+        if reader == "buffered":
+          sock = BufferedSockets(sock)
+        while received < count:
+          codec.getPacket(sock)
+          received += 1
+      elapsed = time.perf_counter() - start
+      sender.join()
+      client.close()
+      server.close()
+      reads = sock.socket.reads if reader == "buffered" else sock.reads
+      print("%8s %12s %15.3f %15d" % (codec.__name__.split(".")[-1], reader, reads / count, count / elapsed))
+
+
+def websockets(payloads=(10, 1000, 65536), megabytes=4):
+  "reads and time taken to receive publishes in masked websocket frames, byte-wise or buffered"
+  from .listeners.TCPListeners import BufferedSockets, wsheader, unmask
+
+  class ByteWiseSockets(BufferedSockets):
+    "buffered sockets reading websocket frames as they used to, the header a byte at a time"
+
+    def wsrecv(self):
+      header1 = self.socket.recv(1)
+      if len(header1) == 0:
+        return 0
+      header2 = ord(self.socket.recv(1))
+      length = (header2 & 0x7f)
+      if length == 126:
+        length = ord(self.socket.recv(1)) * 256 + ord(self.socket.recv(1))
+      elif length == 127:
+        length = 0
+        for i in range(0, 8):
+          length += ord(self.socket.recv(1)) * 2**((7 - i)*8)
+      mask = self.socket.recv(4)
+      mpayload = bytearray()
+      while len(mpayload) < length:
+        mpayload += self.socket.recv(length - len(mpayload))
+      buffer = bytearray()
+      mi = 0
+      for i in mpayload:
+        buffer.append(i ^ mask[mi])
+        mi = (mi+1)%4
+      self.framer.feed(buffer)
+      return 2 + length
+
+  print("websockets: receiving about %d MB of QoS 0 publishes, one to a websocket frame" % megabytes)
+  print("%10s %12s %10s %15s %15s %10s" % ("payload", "reader", "packets", "reads/packet", "packets/s", "MB/s"))
+  mask = b"\x01\x02\x03\x04"
+  for payload in payloads:
+    publish = MQTTV5.Publishes()
+    publish.topicName = "sensors/1/temperature"
+    publish.data = b"x" * payload
+    packet = publish.pack()
+    header = bytearray(wsheader(0x82, len(packet)))
+    header[1] |= 0x80 # masked, as frames from clients are
+    frame = bytes(header) + mask + unmask(packet, mask)
+    count = max(100, min(100000, megabytes * 1048576 // len(frame)))
+    perSend = min(count, max(1, 65536 // len(frame)))
+    count -= count % perSend
+    for reader in ["byte-wise", "buffered"]:
+      client, server = socket.socketpair()
+      def send():
+        for i in range(count // perSend):
+          client.sendall(frame * perSend)
+      sender = threading.Thread(target=send)
+      sender.start()
+      counted = CountingSockets(server)
+      sock = (ByteWiseSockets if reader == "byte-wise" else BufferedSockets)(counted)
+      sock.websockets = True
+      received = 0
+      start = time.perf_counter()
+      while received < count:
+        assert sock.getPacket() == packet
+        received += 1
+      elapsed = time.perf_counter() - start
+      sender.join()
+      client.close()
+      server.close()
+      print("%10d %12s %10d %15.3f %15d %10.1f" % (payload, reader, count, counted.reads / count,
+            count / elapsed, count * len(frame) / elapsed / 1048576))
+
+
+def fanout(subscribers=1000, payloads=(100, 65536)):
+  "time to encode one publish for each of its subscribers, with and without a shared template"
+  print("fanout: time to encode a publish with properties for %d subscribers" % subscribers)
+  print("%10s %15s %15s" % ("payload", "pack ms", "template ms"))
+  properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+  properties.ContentType = "application/json"
+  properties.UserProperty = [("source", "benchmark"), ("unit", "celsius")]
+  for size in payloads:
+    data = b"x" * size
+    def encode(template):
+      for i in range(subscribers):
+        # per subscriber fields, as set by the broker
+        if hasattr(properties, "SubscriptionIdentifier"):
+          del properties.SubscriptionIdentifier
+        properties.SubscriptionIdentifier = i % 10 + 1
+        pub = MQTTV5.Publishes(QoS=1, MsgId=i % 65535 + 1, TopicName="sensors/1/temperature", Payload=data)
+        pub.properties = properties
+        if template:
+          pub.template = template
+          pub.packBuffers()
+        else:
+          pub.pack() # as before templates, copying the payload
+    packed = timed(lambda: encode(None), 3) / 1000
+    templated = timed(lambda: encode(MQTTV5.PublishTemplates("sensors/1/temperature", properties, data)), 3) / 1000
+    print("%10d %15.2f %15.2f" % (size, packed, templated))
+
+
+def concurrency(modes=("single", "fine"), publishers=4, seconds=2, port=18910):
+  "publish round trips of several clients while another client's publishes wait on a subscriber which doesn't read"
+  from .start import default_options
+  from .V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+  from .V5.MQTTBrokers import MQTTBrokers as MQTTV5Brokers
+  from .listeners import TCPListeners
+  import mqtt.formats.MQTTV311 as MQTTV3
+  print("concurrency: QoS 1 publishes from %d clients in %d seconds, with a stalled subscriber" % (publishers, seconds))
+  print("%10s %15s" % ("mode", "publishes/s"))
+
+  def connect(clientid):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.settimeout(seconds)
+    sock.connect(("localhost", port))
+    connect = MQTTV3.Connects()
+    connect.ClientIdentifier = clientid
+    sock.sendall(connect.pack())
+    MQTTV3.getPacket(sock) # connack
+    return sock
+
+  for mode in modes:
+    options = default_options()
+    options["concurrency"] = mode
+    lock = threading.RLock()
+    locks = {"subscriptions": threading.RLock(), "retained": threading.RLock()}
+    sharedData = {}
+    broker3 = MQTTV3Brokers(options=options.copy(), lock=lock, sharedData=sharedData, locks=locks)
+    broker5 = MQTTV5Brokers(options=options.copy(), lock=lock, sharedData=sharedData, locks=locks)
+    TCPListeners.setBrokers(broker3, broker5)
+    server = TCPListeners.create(port, host="localhost")
+    time.sleep(.5)
+    subscriber = connect("stalled")
+    subscribe = MQTTV3.Subscribes()
+    subscribe.messageIdentifier = 1
+    subscribe.data = [("stalled/#", 0)]
+    subscriber.sendall(subscribe.pack())
+    MQTTV3.getPacket(subscriber) # suback, and then the subscriber reads no more
+
+    def stall():
+      # publish to the subscriber until its socket buffers are full, and the broker waits to write to it
+      publish = MQTTV3.Publishes()
+      publish.topicName = "stalled/topic"
+      publish.data = b"x" * 65536
+      data = publish.pack()
+      try:
+        for i in range(1000):
+          staller.sendall(data)
+      except OSError:
+        pass
+    staller = connect("staller")
+    stalling = threading.Thread(target=stall, daemon=True)
+    stalling.start()
+    time.sleep(1)
+
+    counts = [0] * publishers
+    def publish(index):
+      try:
+        sock = connect("publisher%d" % index)
+        publish = MQTTV3.Publishes()
+        publish.topicName = "other/topic%d" % index
+        publish.data = b"x" * 100
+        publish.fh.QoS = 1
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+          publish.messageIdentifier = counts[index] % 65535 + 1
+          sock.sendall(publish.pack())
+          MQTTV3.getPacket(sock) # puback
+          counts[index] += 1
+        sock.close()
+      except OSError:
+        pass # timed out waiting for the broker
+    threads = [threading.Thread(target=publish, args=(i,)) for i in range(publishers)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    print("%10s %15.1f" % (mode, sum(counts) / seconds))
+    subscriber.close() # lets the broker's write finish
+    staller.close()
+    stalling.join()
+    server.shutdown()
+    broker3.shutdown()
+    broker5.shutdown()
+    port += 1
+
+
+def conformance(count=20000, port=18920):
+  "publish throughput as the broker logs conformance statements, counting them or not"
+  import logging
+  from .start import default_options
+  from .coverage import filter, production
+  from .V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+  from .V5.MQTTBrokers import MQTTBrokers as MQTTV5Brokers
+  from .listeners import TCPListeners
+  print("conformance: %d QoS 0 publishes from one client to another" % count)
+  print("%12s %15s" % ("statements", "publishes/s"))
+  logger = logging.getLogger('MQTT broker')
+  handlers, level, propagate = logger.handlers[:], logger.level, logger.propagate
+  devnull = open(os.devnull, "w")
+  logger.handlers = [logging.StreamHandler(devnull)]
+  logger.setLevel(logging.INFO)
+  logger.propagate = False
+
+  def connect(clientid):
+    sock = socket.create_connection(("localhost", port))
+    connect = MQTTV5.Connects()
+    connect.ClientIdentifier = clientid
+    sock.sendall(connect.pack())
+    MQTTV5.getPacket(sock) # connack
+    return sock
+
+  try:
+    for mode in ["counted", "dropped"]:
+      if mode == "counted":
+        filter.attach(logger)
+      else:
+        filter.detach(logger)
+        production(logger)
+      broker3 = MQTTV3Brokers(options=default_options(), sharedData={})
+      broker5 = MQTTV5Brokers(options=default_options(), sharedData={})
+      TCPListeners.setBrokers(broker3, broker5)
+      server = TCPListeners.create(port, host="localhost")
+      time.sleep(.5)
+      subscriber = connect("subscriber")
+      subscribe = MQTTV5.Subscribes()
+      subscribe.packetIdentifier = 1
+      subscribe.data = [("conformance/#", MQTTV5.SubscribeOptions(0))]
+      subscriber.sendall(subscribe.pack())
+      MQTTV5.getPacket(subscriber) # suback
+      publisher = connect("publisher")
+      publish = MQTTV5.Publishes()
+      publish.topicName = "conformance/topic"
+      publish.data = b"x" * 100
+      data = publish.pack()
+      framer = MQTTV5.PacketFramers()
+      start = time.perf_counter()
+      sender = threading.Thread(target=lambda: publisher.sendall(data * count))
+      sender.start()
+      received = 0
+      while received < count:
+        framer.fill(subscriber, 65536)
+        for packet in framer.packets():
+          received += 1
+      elapsed = time.perf_counter() - start
+      sender.join()
+      print("%12s %15d" % (mode, count / elapsed))
+      publisher.close()
+      subscriber.close()
+      server.shutdown()
+      broker3.shutdown()
+      broker5.shutdown()
+      port += 1
+  finally:
+    filter.detach(logger)
+    logger.getChild("statements").setLevel(logging.NOTSET)
+    logger.handlers, logger.propagate = handlers, propagate
+    logger.setLevel(level)
+    devnull.close()
+
+
+def scannedUTF(data):
+  "the way strings used to be checked: one scan of the string for each code point from D800"
+  buf = data.decode("utf-8")
+  if buf.find("\x00") != -1:
+    raise MQTTV5.MalformedPacket("[MQTT5-1.5.4-2] Null found in UTF data "+buf)
+  for c in range (0xD800, 0xDFFF):
+    if buf.find(chr(c)) != -1:
+      raise MQTTV5.MalformedPacket("[MQTT5-1.5.4-1] D800-DFFF found in UTF data "+buf)
+  return buf
+
+
+def strings(iterations=100000):
+  "microseconds to decode and check typical topic names, with the old per code point scans, in one pass, and cached"
+  topics = {"short": "a/b",
+            "typical": "sensors/1/temperature",
+            "long": "building/3/floor/12/room/1207/sensors/hvac/supply-air/temperature",
+            "non-ASCII": "capteurs/salle-à-manger/température"}
+  print("strings: microseconds to decode one topic name")
+  print("%10s %8s %12s %12s %12s" % ("topic", "bytes", "scanned", "single pass", "cached"))
+  for name, topic in topics.items():
+    data = MQTTV5.writeUTF(topic)
+    encoded = data[2:]
+    scanned = timed(lambda: scannedUTF(encoded), iterations // 100)
+    def uncached():
+      MQTTV5.utfCache.clear()
+      MQTTV5.readUTF(data, len(data))
+    clearing = timed(MQTTV5.utfCache.clear, iterations)
+    single = timed(uncached, iterations) - clearing
+    cached = timed(lambda: MQTTV5.readUTF(data, len(data)), iterations)
+    print("%10s %8d %12.3f %12.3f %12.3f" % (name, len(encoded), scanned, single, cached))
+
+
+def properties(instances=10000, iterations=20000):
+  "memory per MQTT V5 properties object, and microseconds to encode and decode publishes with properties"
+  import tracemalloc
+  def publishProperties():
+    properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+    properties.MessageExpiryInterval = 60
+    properties.ContentType = "application/json"
+    properties.UserProperty = ("source", "sensor 1")
+    return properties
+  print("properties: bytes per Properties object")
+  print("%12s %8s" % ("properties", "bytes"))
+  for name, create in [("none", lambda: MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)),
+                       ("three", publishProperties)]:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [create() for i in range(instances)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    print("%12s %8d" % (name, used // instances))
+  print("properties: microseconds per packet")
+  print("%12s %10s %10s %10s" % ("properties", "encode", "decode", "forward"))
+  for name, properties in [("none", MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)),
+                           ("three", publishProperties())]:
+    publish = MQTTV5.Publishes(QoS=1, MsgId=1, TopicName="sensors/1/temperature", Payload=b"21.5")
+    publish.properties = properties
+    data = publish.pack()
+    encode = timed(publish.pack, iterations)
+    decode = timed(lambda: MQTTV5.unpackPacket(data), iterations)
+    forward = timed(lambda: MQTTV5.unpackPacket(data).pack(), iterations) # decoded and encoded again
+    print("%12s %10.3f %10.3f %10.3f" % (name, encode, decode, forward))
+
+
+def decoding(sizes=(100, 65536, 1048576)):
+  "microseconds to decode a publish with three properties, from bytes and from a memoryview"
+  properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+  properties.MessageExpiryInterval = 60
+  properties.ContentType = "application/json"
+  properties.UserProperty = ("source", "sensor 1")
+  print("decoding: microseconds to decode one MQTT V5 publish")
+  print("%10s %12s %12s" % ("payload", "bytes", "memoryview"))
+  for size in sizes:
+    publish = MQTTV5.Publishes(QoS=1, MsgId=1, TopicName="sensors/1/temperature", Payload=b"x" * size)
+    publish.properties = properties
+    data = publish.pack()
+    iterations = max(20, 2000000 // (size + 100))
+    fromBytes = timed(lambda: MQTTV5.unpackPacket(data), iterations)
+    fromView = timed(lambda: MQTTV5.unpackPacket(memoryview(data)), iterations)
+    print("%10d %12.3f %12.3f" % (size, fromBytes, fromView))
+
+
+def acks(iterations=100000):
+  "microseconds to pack and unpack acks with Acks objects, and from the plain templates"
+  print("acks: microseconds per packet")
+  print("%10s %12s %12s %12s %12s" % ("ack", "pack", "plain pack", "unpack", "plain unpack"))
+  for ack in [MQTTV5.Pubacks, MQTTV5.Pubrecs, MQTTV5.Pubrels, MQTTV5.Pubcomps]:
+    ackType = ack().fh.PacketType
+    data = MQTTV5.packAck(ackType, 300)
+    def pack():
+      packet = ack()
+      packet.packetIdentifier = 300
+      return packet.pack()
+    packed = timed(pack, iterations)
+    plainPacked = timed(lambda: MQTTV5.packAck(ackType, 300), iterations)
+    unpacked = timed(lambda: MQTTV5.unpackPacket(data), iterations)
+    plainUnpacked = timed(lambda: MQTTV5.unpackAck(data), iterations)
+    print("%10s %12.3f %12.3f %12.3f %12.3f" % (MQTTV5.Packets.Names[ackType], packed, plainPacked,
+          unpacked, plainUnpacked))
+  packed = timed(lambda: MQTTV5.Pingresps().pack(), iterations)
+  print("%10s %12.3f %12s" % ("Pingresp", packed, "constant"))
+
+
+def storms(counts=(1000, 10000, 50000)):
+  "time to connect, then to reconnect every client at once, as after a network failure, taking over the old sessions"
+  from .start import default_options
+  from .V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+  from .V5.MQTTBrokers import MQTTBrokers as MQTTV5Brokers
+  import mqtt.formats.MQTTV311 as MQTTV3
+  class Sockets:
+    "a connection which drops what is sent to it"
+    def handlePacket(self, packet):
+      pass
+    def shutdown(self, how):
+      pass
+    def close(self):
+      pass
+  print("storms: microseconds per connect, for each client connecting and then reconnecting")
+  print("%10s %10s %12s %12s %12s" % ("version", "clients", "connect", "reconnect", "scan"))
+  for version, brokerClass, connects in [("V5", MQTTV5Brokers, MQTTV5.Connects), ("V311", MQTTV3Brokers, MQTTV3.Connects)]:
+    for count in counts:
+      broker = brokerClass(default_options())
+      try:
+        packets = []
+        for i in range(count):
+          connect = connects()
+          connect.ClientIdentifier = "storm%d" % i
+          packets.append(connect)
+        times = []
+        for i in range(2): # the second time round takes over each connection
+          start = time.perf_counter()
+          for connect in packets:
+            broker.connect(Sockets(), connect)
+          times.append((time.perf_counter() - start) * 1000000 / count)
+        assert len(broker.clients) == count
+        # what finding the old connection from the client objects, as before the index, costs for each connect
+        scan = timed(lambda: "storm0" in [client.id for client in broker.clients.values()], max(1, 100000 // count))
+        print("%10s %10d %12.1f %12.1f %12.1f" % (version, count, times[0], times[1], scan))
+      finally:
+        broker.clients = {} # so that shutdown doesn't disconnect them one by one
+        broker.shutdown()
+
+
+benchmarks = [subscriptions, resubscriptions, retained, connections, framing, websockets, fanout, concurrency,
+              conformance, strings, properties,
+              decoding, acks, storms]
+
+if __name__ == "__main__":
+  names = sys.argv[1:]
+  for benchmark in benchmarks:
+    if len(names) == 0 or benchmark.__name__ in names:
+      benchmark()
@@ -29,7 +29,10 @@ modules = [m for m in locals().values() if inspect.ismodule(m) and m.__name__.st
 """
 
     assert self.messageIdentifier > 0, "[MQTT-2.3.1-1] packet indentifier must be > 0"
-    logger.info("[MQTT-3.9.3-1] the order of return codes must match order of topics in subscribe")
+    statements.info("[MQTT-3.9.3-1] the order of return codes must match order of topics in subscribe")
+
+  where statements is the "statements" child of the broker logger, so that they can be
+  turned off separately.
 
 """
 
@@ -109,6 +112,22 @@ class Filters:
     for curline in self.getmeasures():
       logger.info(curline)
 
+  def attach(self, aLogger):
+    "count the conformance statements logged by aLogger, logging each one once"
+    statements = aLogger.getChild("statements")
+    statements.setLevel(logging.NOTSET)
+    for each in [aLogger, statements]:
+      each.addFilter(self)
+
+  def detach(self, aLogger):
+    for each in [aLogger, aLogger.getChild("statements")]:
+      each.removeFilter(self)
+
+
+def production(aLogger):
+  "turn off the conformance statements of aLogger, so that no log records are made for them"
+  aLogger.getChild("statements").setLevel(logging.WARNING)
+
 filter = Filters()
 
 def measure():
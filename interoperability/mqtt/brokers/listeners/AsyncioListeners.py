@@ -0,0 +1,253 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2019 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+A TCP listener built on asyncio.start_server.  All the connections are served by
+one event loop thread, with a reader task for each connection, so that idle
+connections cost a coroutine rather than a thread.
+
+The reader task frames the MQTT packets read, as in SelectorListeners, and passes
+them to the broker's handleRequest on a small pool of threads, so that the broker's
+locks are never waited for in the event loop.  The reader task waits for each
+packet to be handled before reading more.  Data sent to a connection is written to
+its StreamWriter by the event loop.  A thread sending to a connection which has more
+than highWater bytes waiting to be written waits for it to drain, as a thread writing
+to a full socket would, so a client which doesn't read is not sent ever more data.
+"""
+
+import asyncio, concurrent.futures, threading, queue, ssl, logging
+
+from mqtt.brokers.listeners import SelectorListeners
+from mqtt.brokers.listeners.SelectorListeners import SelectorSockets, EOF
+from mqtt.brokers.listeners.TCPListeners import TLSContext
+
+logger = logging.getLogger('MQTT broker')
+
+
+class StreamSockets:
+  """
+  The socket interface used by the brokers, for an asyncio stream writer.
+  Can be used from any thread.
+  """
+
+  highWater = 65536 # bytes waiting to be written, above which senders wait
+
+  def __init__(self, writer, server):
+    self.writer = writer
+    self.server = server
+    self.loop = server.loop
+    self.fd = writer.get_extra_info("socket").fileno()
+    self.closed = False
+    self.lock = threading.Lock()
+    self.scheduled = 0   # bytes passed to the event loop, not yet written to the transport
+    self.buffered = 0    # bytes in the transport's buffer, as last seen by the event loop
+    self.draining = asyncio.Lock() # only one drain can wait on a StreamWriter at a time
+
+  def inLoop(self):
+    return threading.get_ident() == self.server.thread_id
+
+  def write(self, buffers, length):
+    "called in the event loop thread"
+    with self.lock:
+      self.scheduled -= length
+    self.writer.writelines(buffers)
+    self.buffered = self.writer.transport.get_write_buffer_size()
+
+  async def drain(self):
+    async with self.draining:
+      try:
+        await self.writer.drain()
+      except ConnectionError:
+        pass # the reader task finds that the connection has gone
+      self.buffered = self.writer.transport.get_write_buffer_size()
+
+  def waitDrained(self):
+    "wait in the sending thread until the data waiting to be written has drained"
+    future = asyncio.run_coroutine_threadsafe(self.drain(), self.loop)
+    while not self.server.stopped.is_set():
+      try:
+        return future.result(1)
+      except concurrent.futures.TimeoutError:
+        pass
+
+  def send(self, data):
+    return self.sendmsg([bytes(data)])
+
+  sendall = send
+
+  def sendmsg(self, buffers):
+    length = sum(len(buffer) for buffer in buffers)
+    if self.inLoop():
+      self.writer.writelines(buffers)
+    else:
+      with self.lock:
+        self.scheduled += length
+        waiting = self.scheduled + self.buffered
+      self.loop.call_soon_threadsafe(self.write, buffers, length)
+      if waiting > self.highWater and not self.closed:
+        self.waitDrained()
+    return length
+
+  def shutdown(self, how):
+    self.close() # the buffered data is sent before the transport closes
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      if self.inLoop():
+        self.writer.close()
+      else:
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+  def fileno(self):
+    return self.fd
+
+  def settimeout(self, timeout):
+    pass # reads are done by the reader task, not the brokers
+
+
+class AsyncioServers:
+
+  def __init__(self, address, threads=4, context=None):
+    self.address = address
+    self.threads = threads
+    self.context = context
+    self.work = queue.Queue() # (connection, future) to be handled by the pool
+    self.connections = set()
+    self.loop = asyncio.new_event_loop()
+    self.thread_id = None # of the event loop thread
+    self.server = None
+    self.stopped = threading.Event()
+
+  # the SelectorSockets callbacks: work items are handled by the reader task as soon as they are framed
+  def schedule(self, connection, item):
+    connection.packets.append(item)
+
+  def unregister(self, connection):
+    self.connections.discard(connection)
+
+  def handle(self, connection):
+    "handle the work items of one connection.  Returns whether the connection is finished"
+    while len(connection.packets) > 0 and not connection.closed:
+      item = connection.packets.popleft()
+      if connection.handle(item):
+        connection.finish()
+    connection.packets.clear()
+    return connection.closed
+
+  def handleInPool(self, connection):
+    "a future for handling the work items of one connection on a pool thread"
+    future = self.loop.create_future()
+    self.work.put((connection, future))
+    return future
+
+  def worker(self):
+    while not self.stopped.is_set():
+      try:
+        connection, future = self.work.get(timeout=1)
+      except queue.Empty:
+        continue
+      finished = self.handle(connection)
+      try:
+        self.loop.call_soon_threadsafe(self.handled, future, finished)
+      except RuntimeError:
+        pass # the event loop has closed
+
+  def handled(self, future, finished):
+    if not future.done(): # the reader task may have been cancelled
+      future.set_result(finished)
+
+  async def connected(self, reader, writer):
+    sock = StreamSockets(writer, self)
+    connection = SelectorSockets(sock, self)
+    logger.info("Starting communications for socket %d", connection.fileno())
+    self.connections.add(connection)
+    try:
+      while not await self.handleInPool(connection):
+        try:
+          data = await reader.read(65536)
+        except (ConnectionError, ssl.SSLError):
+          data = b""
+        if len(data) == 0:
+          self.schedule(connection, EOF)
+        else:
+          connection.frame(data)
+        if await self.handleInPool(connection):
+          break
+        await sock.drain()
+    except asyncio.CancelledError:
+      pass # the server is shutting down
+    except:
+      logger.exception("AsyncioServers")
+      connection.finish()
+    finally:
+      self.unregister(connection)
+
+  async def serve(self):
+    self.thread_id = threading.get_ident()
+    self.server = await asyncio.start_server(self.connected, self.address[0], self.address[1],
+        ssl=self.context, backlog=1024, reuse_address=True)
+    try:
+      await self.server.serve_forever()
+    except asyncio.CancelledError:
+      pass
+    # stop the reader tasks, which may be waiting for the pool
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  def serve_forever(self):
+    for i in range(self.threads):
+      thread = threading.Thread(target = self.worker)
+      thread.daemon = True
+      thread.start()
+    try:
+      self.loop.run_until_complete(self.serve())
+    finally:
+      self.stopped.set()
+
+  def shutdown(self):
+    if self.server:
+      self.loop.call_soon_threadsafe(self.server.close)
+    self.stopped.wait()
+
+
+def setBrokers(aBroker3, aBroker5):
+  SelectorListeners.setBrokers(aBroker3, aBroker5)
+
+
+def create(port, host="", TLS=False, serve_forever=False, threads=4,
+    cert_reqs=ssl.CERT_REQUIRED,
+    ca_certs=None, certfile=None, keyfile=None, allow_non_sni_connections=True):
+  logger.info("Starting asyncio TCP listener on address '%s' port %d %s", host, port,
+     "with TLS support" if TLS else "")
+  bind_address = None # all interfaces
+  if host not in ["", "INADDR_ANY"]:
+    bind_address = host
+  context = None
+  if TLS:
+    context = TLSContext(cert_reqs, ca_certs, certfile, keyfile, allow_non_sni_connections)
+  server = AsyncioServers((bind_address, port), threads, context)
+  if serve_forever:
+    server.serve_forever()
+  else:
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+  return server
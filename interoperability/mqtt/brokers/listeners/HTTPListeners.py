@@ -59,7 +59,8 @@ def get_clients(*args):
   return 200, json.dumps(clients)
 
 def get_subscriptions(*args):
-  return 200, json.dumps([jsonize(s) for s in sharedData["subscriptions"]])
+  return 200, json.dumps([jsonize(s) for clientSubscriptions in sharedData["subscriptions"].values()
+                                      for s in clientSubscriptions.values()])
 
 def get_retained_messages(*args):
   out = {}
@@ -69,6 +70,14 @@ def get_retained_messages(*args):
     out[topic] = value
   return 200, json.dumps(out)
 
+def get_stats(*args):
+  # the numbers of subscriptions and retained topic names indexed in the topic trees
+  stats = {"topic_trees": {name: len(tree) for trees in ("subscription_trees", "retained_trees")
+                           for name, tree in sharedData[trees].items()},
+           "message_queues": broker5.queueLimits.stats(), # shared with the MQTT 3.1.1 broker
+           "reaper": broker5.reaper.stats()}
+  return 200, json.dumps(stats)
+
 class APIs:
 
   def __init__(self):
@@ -77,6 +86,7 @@ class APIs:
       ("/api/v0001/clients/([^/]*)$", get_client),   
       ("/api/v0001/subscriptions$", get_subscriptions),  
       ("/api/v0001/retained$", get_retained_messages), 
+      ("/api/v0001/stats$", get_stats),
       ]
 
     self.puts = [
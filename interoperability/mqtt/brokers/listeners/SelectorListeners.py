@@ -0,0 +1,402 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2019 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+A TCP listener which uses one selector thread to accept connections and read from all
+their sockets, and a small fixed pool of threads to handle the MQTT packets read,
+rather than a thread for each connection.  Websockets and TLS are supported as in
+TCPListeners.
+
+The selector thread splits the data read from each socket into complete MQTT packets.
+Each packet is then passed to the broker's handleRequest through getPacket, so that
+handleRequest never waits on the socket.  The packets of one connection are handled
+by only one thread at a time, in the order they were received.
+
+The sockets are non-blocking, so that a TLS client which has sent part of a record
+doesn't hold up the selector thread.  The selector thread never writes: what it has to
+send, such as the websocket handshake response, is queued for the pool like a packet.
+The pool and broker threads writing to a socket wait for it when it is full.  As
+the selector thread reads a TLS connection while others write to it, which OpenSSL
+doesn't allow, each TLS read and write is done holding the connection's lock.
+"""
+
+import selectors, socket, ssl, threading, queue, collections, contextlib, logging
+
+from mqtt.brokers import OutboundQueues
+from mqtt.brokers.listeners.TCPListeners import BufferedSockets, TLSContext, handshakeResponse, wsheader
+from mqtt.formats.MQTTV311 import MQTTException as MQTTV3Exception
+from mqtt.formats.MQTTV5 import MQTTException as MQTTV5Exception
+
+logger = logging.getLogger('MQTT broker')
+
+# work items queued for a connection, other than packets
+EOF = "eof"
+WRITE = "write" # (WRITE, data): data to be written as it is, by a pool thread
+
+
+def protocolVersion(packet):
+  "the protocol version of a connect packet, or None if the packet is not a connect"
+  if packet[0] != 0x10:
+    return None
+  pos = 1
+  while packet[pos] & 0x80:
+    pos += 1
+  pos += 1
+  pos += 2 + int.from_bytes(packet[pos:pos+2], "big") # skip the protocol name
+  return packet[pos] if pos < len(packet) else None
+
+
+class SelectorSockets(BufferedSockets):
+  """
+  A connection's socket.  Data read from the network is framed into packets,
+  and getPacket, as called by the brokers, returns the packet being handled.
+  """
+
+  def __init__(self, socket, server):
+    BufferedSockets.__init__(self, socket)
+    self.server = server
+    self.packet = None          # the packet being handled
+    self.packets = collections.deque() # packets and other work items waiting to be handled
+    self.scheduled = False      # whether a thread is handling, or about to handle, this connection
+    self.first = True
+    self.broker = None
+    self.closed = False
+    # an OpenSSL connection can't be read and written by two threads at once
+    self.tlsLock = threading.Lock() if isinstance(socket, ssl.SSLSocket) else contextlib.nullcontext()
+
+  def getPacket(self):
+    packet = self.packet
+    self.packet = None
+    return packet
+
+  def close(self):
+    self.closed = True
+    self.server.unregister(self)
+    self.socket.close()
+
+  def finish(self):
+    if not self.closed:
+      logger.info("Finishing communications for socket %d", self.socket.fileno())
+      try:
+        with self.tlsLock: # the SSL object is dropped
+          self.socket.shutdown(socket.SHUT_RDWR)
+      except:
+        pass
+      self.close()
+
+  def read(self):
+    "called by the selector thread when the socket is readable"
+    try:
+      with self.tlsLock:
+        if self.first or self.websockets:
+          data = self.socket.recv(65536)
+          count = len(data)
+        else: # read straight into the framer
+          count = self.framer.fill(self.socket)
+        if isinstance(self.socket, ssl.SSLSocket):
+          while self.socket.pending() > 0: # data already decrypted is not seen by the selector
+            if self.first or self.websockets:
+              data += self.socket.recv(self.socket.pending())
+            else:
+              self.framer.fill(self.socket, self.socket.pending())
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+      return # not a complete TLS record yet, or nothing to read after all
+    except OSError:
+      count = 0
+    if count == 0:
+      self.server.unregister(self)
+      self.server.schedule(self, EOF)
+    elif self.first or self.websockets:
+      self.frame(data)
+    else:
+      self.schedulePackets()
+
+  def frame(self, data):
+    "add data read from the network, scheduling any packets which are now complete"
+    if self.first:
+      self.received += data
+      if self.received[0:1] == b"G": # should be websocket connection
+        end = self.received.find(b"\r\n\r\n")
+        if end == -1:
+          return # wait for the rest of the opening handshake
+        self.server.schedule(self, (WRITE, handshakeResponse(self.received[:end+4].decode('utf-8'))))
+        del self.received[:end+4]
+        self.websockets = True
+        logger.info("Switching to websockets for socket %d", self.socket.fileno())
+      data = bytes(self.received)
+      self.received = bytearray()
+      self.first = False
+    if self.websockets:
+      if not self.wsfeed(data):
+        self.server.unregister(self)
+        self.server.schedule(self, EOF)
+        return
+    else:
+      self.framer.feed(data)
+    self.schedulePackets()
+
+  def wswrite(self, data):
+    "websocket control frames are written by the pool too, in order with the packets"
+    self.server.schedule(self, (WRITE, data))
+
+  def schedulePackets(self):
+    for packet in self.framer.packets():
+      self.server.schedule(self, bytes(packet))
+
+  def waitWritable(self):
+    "wait until the socket can take more data, on the thread writing to it"
+    with selectors.DefaultSelector() as selector:
+      selector.register(self.socket, selectors.EVENT_WRITE)
+      selector.select(1) # a TLS socket may be waiting to read instead, so look again soon
+
+  def sendAll(self, data):
+    "write all of data to the non-blocking socket"
+    view = memoryview(data)
+    sent = 0
+    while sent < len(view):
+      try:
+        with self.tlsLock: # not held while waiting, so that the selector thread can read
+          sent += self.socket.send(view[sent:])
+      except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+        self.waitWritable()
+    return sent
+
+  def send(self, data):
+    if self.websockets:
+      data = wsheader(0x82, len(data)) + data # binary frame
+    return self.sendAll(data)
+
+  def sendmsg(self, buffers):
+    "send a list of buffers, gathered by the socket rather than joined where it can"
+    if self.websockets or isinstance(self.socket, ssl.SSLSocket) or not hasattr(self.socket, "sendmsg"):
+      return self.send(b"".join(buffers))
+    length = sum(len(buffer) for buffer in buffers)
+    total = 0
+    while total < length:
+      try:
+        sent = self.socket.sendmsg(buffers)
+      except BlockingIOError:
+        self.waitWritable()
+        continue
+      total += sent
+      # remove what was sent, to send the rest
+      while sent > 0 and sent >= len(buffers[0]):
+        sent -= len(buffers[0])
+        buffers = buffers[1:]
+      if sent > 0:
+        buffers = [memoryview(buffers[0])[sent:]] + buffers[1:]
+    return total
+
+  def write(self, data):
+    "write data queued by the selector thread, after any packets the broker has queued"
+    outbound = getattr(self, "outbound", None)
+    if outbound != None:
+      outbound.put(lambda: self.sendAll(data))
+      OutboundQueues.flush()
+    else:
+      self.sendAll(data)
+
+  def handle(self, item):
+    "handle one work item.  Returns whether to close the connection"
+    try:
+      terminate = self.handleItem(item)
+    except UnicodeDecodeError:
+      logger.error("[MQTT-1.4.0-1] Unicode field encoding error")
+      terminate = True
+    except MQTTV3Exception as exc:
+      logger.error(exc.args[0])
+      terminate = True
+    except MQTTV5Exception as exc:
+      logger.error(exc.args[0])
+      terminate = True
+    except AssertionError as exc:
+      if (len(exc.args) > 0):
+        logger.error(exc.args[0])
+      else:
+        logger.error("")
+      terminate = True
+    except:
+      logger.exception(self.server.__class__.__name__)
+      terminate = True
+    return terminate
+
+  def handleItem(self, item):
+    "pass a packet to the broker, or disconnect"
+    terminate = False
+    if item == EOF:
+      if self.broker != None:
+        self.packet = None # so that the broker reads no packet, and disconnects the client
+        self.broker.handleRequest(self)
+      terminate = True
+    elif type(item) == tuple and item[0] == WRITE:
+      self.write(item[1])
+    else:
+      if self.broker == None:
+        version = protocolVersion(item)
+        if version == 4:
+          self.broker = broker3
+        elif version == 5:
+          self.broker = broker5
+      if self.broker == None:
+        terminate = True
+      else:
+        self.packet = item
+        terminate = self.broker.handleRequest(self)
+    return terminate
+
+
+class SelectorServers:
+
+  def __init__(self, address, threads=4, context=None):
+    self.address = address
+    self.threads = threads
+    self.context = context
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(address)
+    self.socket.listen(50)
+    self.socket.setblocking(False)
+    self.selector = selectors.DefaultSelector()
+    self.selector.register(self.socket, selectors.EVENT_READ, None)
+    self.lock = threading.Lock()
+    self.connections = set()
+    self.work = queue.Queue()
+    self.terminate = False
+    self.stopped = threading.Event()
+
+  def register(self, sock):
+    sock.setblocking(False) # after any TLS handshake, so that reads never wait
+    connection = SelectorSockets(sock, self)
+    logger.info("Starting communications for socket %d", sock.fileno())
+    with self.lock:
+      self.connections.add(connection)
+      self.selector.register(sock, selectors.EVENT_READ, connection)
+
+  def unregister(self, connection):
+    with self.lock:
+      if connection in self.connections:
+        self.connections.remove(connection)
+        try:
+          self.selector.unregister(connection.socket)
+        except (KeyError, ValueError):
+          pass
+
+  def schedule(self, connection, item):
+    "add a work item for a connection, queueing the connection if no thread is handling it"
+    with self.lock:
+      connection.packets.append(item)
+      if connection.scheduled:
+        return
+      connection.scheduled = True
+    self.work.put((self.handle, connection))
+
+  def handle(self, connection):
+    "handle the work items of one connection, until there are none left"
+    while True:
+      with self.lock:
+        if len(connection.packets) == 0 or connection.closed:
+          connection.packets.clear()
+          connection.scheduled = False
+          return
+        item = connection.packets.popleft()
+      if connection.handle(item):
+        connection.finish()
+
+  def starttls(self, sock):
+    "the TLS handshake is done by a pool thread so that it doesn't hold up the selector thread"
+    try:
+      sock.settimeout(10)
+      sock = self.context.wrap_socket(sock, server_side=True)
+      sock.settimeout(None)
+    except:
+      logger.exception("TLS handshake failed")
+      sock.close()
+      return
+    self.register(sock)
+
+  def accept(self):
+    try:
+      sock, address = self.socket.accept()
+    except (BlockingIOError, ssl.SSLError):
+      return
+    sock.setblocking(True)
+    if self.context:
+      self.work.put((self.starttls, sock))
+    else:
+      self.register(sock)
+
+  def worker(self):
+    while not self.terminate:
+      try:
+        fn, arg = self.work.get(timeout=1)
+      except queue.Empty:
+        continue
+      fn(arg)
+
+  def serve_forever(self):
+    for i in range(self.threads):
+      thread = threading.Thread(target = self.worker)
+      thread.daemon = True
+      thread.start()
+    try:
+      while not self.terminate:
+        for key, mask in self.selector.select(timeout=1):
+          if key.data == None:
+            self.accept()
+          else:
+            try:
+              key.data.read()
+            except:
+              logger.exception("SelectorServers")
+              self.unregister(key.data)
+              self.schedule(key.data, EOF)
+    finally:
+      self.stopped.set()
+
+  def shutdown(self):
+    self.terminate = True
+    self.stopped.wait()
+    self.selector.close()
+    self.socket.close()
+
+
+def setBrokers(aBroker3, aBroker5):
+  global broker3, broker5
+  broker3 = aBroker3
+  broker5 = aBroker5
+
+
+def create(port, host="", TLS=False, serve_forever=False, threads=4,
+    cert_reqs=ssl.CERT_REQUIRED,
+    ca_certs=None, certfile=None, keyfile=None, allow_non_sni_connections=True):
+  logger.info("Starting selector TCP listener on address '%s' port %d with %d threads %s", host, port,
+     threads, "with TLS support" if TLS else "")
+  bind_address = ""
+  if host not in ["", "INADDR_ANY"]:
+    bind_address = host
+  context = None
+  if TLS:
+    context = TLSContext(cert_reqs, ca_certs, certfile, keyfile, allow_non_sni_connections)
+  server = SelectorServers((bind_address, port), threads, context)
+  if serve_forever:
+    server.serve_forever()
+  else:
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+  return server
@@ -19,10 +19,11 @@
 """
 
 import socketserver, select, sys, traceback, socket, logging, getopt, hashlib, base64
-import threading, ssl
+import threading, ssl, struct
 
 from mqtt.brokers.V311 import MQTTBrokers as MQTTV3Brokers
 from mqtt.brokers.V5 import MQTTBrokers as MQTTV5Brokers
+import mqtt.formats.MQTTV5 as MQTTV5
 from mqtt.formats.MQTTV311 import MQTTException as MQTTV3Exception
 from mqtt.formats.MQTTV5 import MQTTException as MQTTV5Exception
 
@@ -30,118 +31,206 @@ server = None
 logger = logging.getLogger('MQTT broker')
 
 class BufferedSockets:
+  """
+  A connection's socket.  Data is read from the network in large chunks, and any
+  websocket framing removed, into a packet framer, so that each packet doesn't take
+  several reads.
+  """
 
   def __init__(self, socket):
     self.socket = socket
-    self.buffer = bytearray()
+    # V3 and V5 packets are framed in the same way
+    self.framer = MQTTV5.PacketFramers()
     self.websockets = False
+    self.received = bytearray() # data read, before websocket frames are removed
 
   def rebuffer(self, data):
-    self.buffer = data + self.buffer
+    "put data read back at the front of the buffer"
+    self.framer.feed(data + self.framer.read(len(self.framer)))
 
   def wsrecv(self):
-    header1 = ord(self.socket.recv(1))
-    header2 = ord(self.socket.recv(1))
-
-    opcode = (header1 & 0x0f)
-    maskbit = (header2 & 0x80) == 0x80
-    length = (header2 & 0x7f) # works for 0 to 125 inclusive
-    if length == 126: # for 126 to 65535 inclusive
-      lb1 = ord(self.socket.recv(1))
-      lb2 = ord(self.socket.recv(1))
-      length = lb1*256 + lb2
-    elif length == 127:
-      length = 0
-      for i in range(0, 8):
-        length += ord(self.socket.recv(1)) * 2**((7 - i)*8)
-    assert maskbit == True
-    if maskbit:
-      mask = self.socket.recv(4)
-    mpayload = bytearray()
-    while len(mpayload) < length:
-      mpayload += self.socket.recv(length - len(mpayload))
-    buffer = bytearray()
-    if maskbit:
-      mi = 0
-      for i in mpayload:
-        buffer.append(i ^ mask[mi])
-        mi = (mi+1)%4
-    else:
-      buffer = mpayload
-    self.buffer += buffer
+    "read from the network, removing the websocket framing.  Returns 0 at end of file"
+    data = self.socket.recv(65536)
+    if len(data) == 0 or not self.wsfeed(data):
+      return 0
+    return len(data)
+
+  def wsfeed(self, data):
+    """add data read to any incomplete websocket frame, feeding the payloads of the
+       complete data frames to the packet framer, and answering control frames.
+       Returns False once the client has closed the websocket"""
+    self.received += data
+    start = 0
+    frame = wsframe(self.received, start)
+    while frame:
+      opcode, payload, length = frame
+      start += length
+      if opcode in [0x0, 0x1, 0x2]: # continuation, text or binary
+        self.framer.feed(payload)
+      elif opcode == 0x8: # close, which is echoed
+        self.wswrite(wsheader(0x88, len(payload[:2])) + payload[:2])
+        self.received = bytearray()
+        return False
+      elif opcode == 0x9: # ping
+        self.wswrite(wsheader(0x8a, len(payload)) + payload)
+      frame = wsframe(self.received, start)
+    del self.received[:start]
+    return True
+
+  def wswrite(self, data):
+    "write a websocket control frame"
+    self.socket.sendall(data)
+
+  def wsaccept(self):
+    "answer the opening handshake of a websocket connection, already read in part"
+    data = self.framer.read(len(self.framer))
+    while data.find(b"\r\n\r\n") == -1:
+      more = self.socket.recv(1024)
+      if len(more) == 0:
+        raise socket.error("Connection closed in the websocket opening handshake")
+      data += more
+    end = data.find(b"\r\n\r\n") + 4
+    self.socket.sendall(handshakeResponse(data[:end].decode('utf-8')))
+    self.websockets = True
+    # the client may not have waited for the response to send its first frames
+    return self.wsfeed(data[end:])
+
+  def fill(self):
+    "read from the network into the framer.  Returns 0 at end of file"
+    if self.websockets:
+      return self.wsrecv()
+    return self.framer.fill(self.socket)
+
+  def pending(self):
+    "whether a packet can be read without waiting for the network"
+    if isinstance(self.socket, ssl.SSLSocket) and self.socket.pending() > 0:
+      return True # data already decrypted is not seen by select
+    length = self.framer.packetLength()
+    return length != None and length <= len(self.framer)
 
   def recv(self, bufsize):
-    if self.websockets:
-      while len(self.buffer) < bufsize:
-        self.wsrecv()
-      out = self.buffer[:bufsize]
-      self.buffer = self.buffer[bufsize:]
-    else:
-      if bufsize <= len(self.buffer):
-        out = self.buffer[:bufsize]
-        self.buffer = self.buffer[bufsize:]
-      else:
-        out = self.buffer + self.socket.recv(bufsize - len(self.buffer))
-        self.buffer = bytes()
-    return out
+    while len(self.framer) == 0:
+      if self.fill() == 0:
+        break
+    return self.framer.read(bufsize)
+
+  def getPacket(self):
+    "the next packet, or None at end of file"
+    packet = self.framer.nextPacket()
+    while packet == None:
+      if self.fill() == 0:
+        return None
+      packet = self.framer.nextPacket()
+    return bytes(packet)
 
   def __getattr__(self, name):
     return getattr(self.socket, name)
 
   def send(self, data):
-    header = bytearray()
     if self.websockets:
-      header.append(0x82) # opcode
-      l = len(data)
-      if l < 126:
-        header.append(l)
-      elif l < 65536:
-        """ If 126, the following 2 bytes interpreted as a 16-bit unsigned integer are
-            the payload length.
-        """
-        header += bytearray([126, l // 256, l % 256])
-      elif l < 2**64:
-        """ If 127, the following 8 bytes interpreted as a 64-bit unsigned integer (the
-            most significant bit MUST be 0) are the payload length.
-        """
-        mybytes = [127]
-        for i in range(0, 7):
-          divisor = 2**((7 - i)*8)
-          mybytes.append(l // divisor)
-          l %= divisor
-        mybytes.append(l) # units
-        header += bytearray(mybytes)
-    totaldata = header + data
+      data = wsheader(0x82, len(data)) + data # binary frame
     # Ensure the entire packet is sent by calling send again if necessary
-    sent = self.socket.send(totaldata)
-    while sent < len(totaldata):
-      sent += self.socket.send(totaldata[sent:])
+    sent = self.socket.send(data)
+    while sent < len(data):
+      sent += self.socket.send(data[sent:])
     return sent
 
+  def sendmsg(self, buffers):
+    "send a list of buffers, gathered by the socket rather than joined where it can"
+    if self.websockets or isinstance(self.socket, ssl.SSLSocket) or not hasattr(self.socket, "sendmsg"):
+      return self.send(b"".join(buffers))
+    length = sum(len(buffer) for buffer in buffers)
+    sent = total = self.socket.sendmsg(buffers)
+    while total < length:
+      # remove what was sent, and send the rest
+      while sent >= len(buffers[0]):
+        sent -= len(buffers[0])
+        buffers = buffers[1:]
+      buffers = [memoryview(buffers[0])[sent:]] + buffers[1:]
+      sent = self.socket.sendmsg(buffers)
+      total += sent
+    return total
+
+
+wsheaders = [struct.Struct("!BB"), struct.Struct("!BBH"), struct.Struct("!BBQ")]
+
+def wsheader(firstByte, length):
+  "the header of a websocket frame sent by the server, which is not masked"
+  if length < 126:
+    return wsheaders[0].pack(firstByte, length)
+  elif length < 65536: # the following 2 bytes are the payload length
+    return wsheaders[1].pack(firstByte, 126, length)
+  else: # the following 8 bytes are the payload length
+    return wsheaders[2].pack(firstByte, 127, length)
+
+def unmask(payload, mask):
+  "unmask a websocket payload with one XOR of whole integers, rather than a byte at a time"
+  length = len(payload)
+  if length == 0:
+    return b""
+  masks = mask * (length // 4 + 1)
+  if len(masks) > length:
+    masks = masks[:length]
+  return (int.from_bytes(payload, "big") ^ int.from_bytes(masks, "big")).to_bytes(length, "big")
+
+def wsframe(buffer, start=0):
+  """parse the websocket frame at start in a buffer.
+     Returns (opcode, unmasked payload, frame length), or None if the frame is incomplete"""
+  if len(buffer) < start + 2:
+    return None
+  opcode = (buffer[start] & 0x0f)
+  maskbit = (buffer[start + 1] & 0x80) == 0x80
+  length = (buffer[start + 1] & 0x7f) # works for 0 to 125 inclusive
+  pos = start + 2
+  if length == 126: # for 126 to 65535 inclusive
+    pos += 2
+  elif length == 127:
+    pos += 8
+  if len(buffer) < pos:
+    return None
+  if pos > start + 2:
+    length = int.from_bytes(buffer[start + 2:pos], "big")
+  if maskbit:
+    mask = bytes(buffer[pos:pos+4])
+    pos += 4
+  if len(buffer) < pos + length:
+    return None
+  if opcode >= 0x8:
+    assert length <= 125, "control frame payloads must be 125 bytes or less"
+  payload = memoryview(buffer)[pos:pos+length]
+  payload = unmask(payload, mask) if maskbit else bytes(payload)
+  return opcode, payload, pos + length - start
+
+def getheaders(data):
+  "return headers: keys are converted to upper case so that checks are case insensitive"
+  headers = {}
+  lines = data.splitlines()
+  for curline in lines[1:]:
+    if curline.find(":") != -1:
+      key, value = curline.split(": ", 1)
+      headers[key.upper()] = value     # headers are case insensitive
+  return headers
+
+def handshakeResponse(data):
+  "the response to a websocket opening handshake request"
+  GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+  headers = getheaders(data)
+  digest = base64.b64encode(hashlib.sha1((headers['SEC-WEBSOCKET-KEY'] + GUID).encode("utf-8")).digest())
+  resp = b"HTTP/1.1 101 Switching Protocols\r\n" +\
+         b"Upgrade: websocket\r\n" +\
+         b"Connection: Upgrade\r\n" +\
+         b"Sec-WebSocket-Protocol: mqtt\r\n" +\
+         b"Sec-WebSocket-Accept: " + digest +b"\r\n\r\n"
+  return resp
+
 
 class WebSocketTCPHandler(socketserver.StreamRequestHandler):
 
   def getheaders(self, data):
-    "return headers: keys are converted to upper case so that checks are case insensitive"
-    headers = {}
-    lines = data.splitlines()
-    for curline in lines[1:]:
-      if curline.find(":") != -1:
-        key, value = curline.split(": ", 1)
-        headers[key.upper()] = value     # headers are case insensitive
-    return headers
+    return getheaders(data)
 
   def handshake(self, client):
-    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-    data = client.recv(1024).decode('utf-8')
-    headers = self.getheaders(data)
-    digest = base64.b64encode(hashlib.sha1((headers['SEC-WEBSOCKET-KEY'] + GUID).encode("utf-8")).digest())
-    resp = b"HTTP/1.1 101 Switching Protocols\r\n" +\
-           b"Upgrade: websocket\r\n" +\
-           b"Connection: Upgrade\r\n" +\
-           b"Sec-WebSocket-Protocol: mqtt\r\n" +\
-           b"Sec-WebSocket-Accept: " + digest +b"\r\n\r\n"
-    return client.send(resp)
+    return client.wsaccept()
 
   def handle(self):
     global server
@@ -155,14 +244,16 @@ class WebSocketTCPHandler(socketserver.StreamRequestHandler):
       try:
         if not keptalive:
           logger.debug("Waiting for request")
-        (i, o, e) = select.select([sock], [], [], 1)
+        if sock.pending():
+          (i, o, e) = ([sock], [], [])
+        else:
+          (i, o, e) = select.select([sock], [], [], 1)
         if i == [sock]:
           if first:
             char = sock.recv(1)
             sock.rebuffer(char)
             if char == b"G":    # should be websocket connection
-              self.handshake(sock)
-              sock.websockets = True
+              terminate = not self.handshake(sock)
               logger.info("Switching to websockets for socket %d", sock_no)
           if sock.websockets and first:
             pass
@@ -186,9 +277,7 @@ class WebSocketTCPHandler(socketserver.StreamRequestHandler):
           keptalive = False
           first = False
         elif (i, o, e) == ([], [], []):
-          broker3.keepalive(sock)
-          broker5.keepalive(sock)
-          keptalive = True
+          keptalive = True # keepalive timeouts are on the brokers' timers
         else:
           break
       except UnicodeDecodeError:
@@ -229,11 +318,8 @@ def setBrokers(aBroker3, aBroker5):
 
 
 
-def create(port, host="", TLS=False, serve_forever=False,
-    cert_reqs=ssl.CERT_REQUIRED,
-    ca_certs=None, certfile=None, keyfile=None, allow_non_sni_connections=True):
-  global server
-  logger.info("Starting TCP listener on address '%s' port %d %s", host, port, "with TLS support" if TLS else "")
+def TLSContext(cert_reqs=ssl.CERT_REQUIRED, ca_certs=None, certfile=None, keyfile=None,
+    allow_non_sni_connections=True):
 
   def snicallback(socket, text, context):
     rc = None # success
@@ -244,25 +330,34 @@ def create(port, host="", TLS=False, serve_forever=False,
       rc = ssl.ALERT_DESCRIPTION_INTERNAL_ERROR # stop connection
     return rc
 
+  context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1_2)
+  try:
+    context.set_ciphers('ALL:@SECLEVEL=1') # until we have seclevel 2 TLS config
+  except:
+    pass # set_ciphers doesn't work on older Python versions
+  try:
+    context.sni_callback = snicallback
+  except:
+    logger.error("SNI callback not supported")
+  if certfile:
+    context.load_cert_chain(certfile, keyfile)
+  if ca_certs:
+    context.load_verify_locations(ca_certs)
+  context.verify_mode = cert_reqs
+  return context
+
+
+def create(port, host="", TLS=False, serve_forever=False,
+    cert_reqs=ssl.CERT_REQUIRED,
+    ca_certs=None, certfile=None, keyfile=None, allow_non_sni_connections=True):
+  global server
+  logger.info("Starting TCP listener on address '%s' port %d %s", host, port, "with TLS support" if TLS else "")
   bind_address = ""
   if host not in ["", "INADDR_ANY"]:
     bind_address = host
   server = ThreadingTCPServer((bind_address, port), WebSocketTCPHandler, False)
   if TLS:
-    context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1_2)
-    try:
-      context.set_ciphers('ALL:@SECLEVEL=1') # until we have seclevel 2 TLS config
-    except:
-      pass # set_ciphers doesn't work on older Python versions
-    try:
-      context.sni_callback = snicallback
-    except:
-      logger.error("SNI callback not supported")
-    if certfile:
-      context.load_cert_chain(certfile, keyfile)
-    if ca_certs:
-      context.load_verify_locations(ca_certs)
-    context.verify_mode = cert_reqs
+    context = TLSContext(cert_reqs, ca_certs, certfile, keyfile, allow_non_sni_connections)
     server.socket = context.wrap_socket(server.socket, server_side=True)
   server.request_queue_size = 50
   server.terminate = False
@@ -276,8 +371,3 @@ def create(port, host="", TLS=False, serve_forever=False,
     thread.daemon = True
     thread.start()
   return server
-
-
-
-
-
@@ -23,11 +23,13 @@ import sys, traceback, logging, getopt, threading, ssl, signal
 from .V311 import MQTTBrokers as MQTTV3Brokers
 from .V5 import MQTTBrokers as MQTTV5Brokers
 from .SN import MQTTSNBrokers
-from .coverage import filter, measure
+from .MessageQueues import QueueLimits, policies
+from .TimerWheels import TimerWheels
+from .coverage import filter, measure, production
 from mqtt.formats.MQTTV311 import MQTTException as MQTTV3Exception
 from mqtt.formats.MQTTV5 import MQTTException as MQTTV5Exception
 from mqtt.formats.MQTTSN import MQTTSNException
-from mqtt.brokers.listeners import TCPListeners, UDPListeners, HTTPListeners
+from mqtt.brokers.listeners import TCPListeners, UDPListeners, HTTPListeners, SelectorListeners, AsyncioListeners
 from mqtt.brokers.bridges import TCPBridges
 
 logger = None
@@ -73,8 +75,23 @@ def process_config(config, options):
         options["topicAliasMaximum"] = int(words[1])
       elif words[0] in ["maximum_packet_size", "message_size_limit"]:
         options["maximumPacketSize"] = int(words[1])
+      elif words[0] in ["max_queued_messages", "max_queued_bytes",
+              "max_total_queued_messages", "max_total_queued_bytes"]:
+        names = {"max_queued_messages": "maxQueuedMessages", "max_queued_bytes": "maxQueuedBytes",
+                 "max_total_queued_messages": "maxTotalQueuedMessages", "max_total_queued_bytes": "maxTotalQueuedBytes"}
+        options[names[words[0]]] = int(words[1]) if int(words[1]) > 0 else None # 0 for no limit
+      elif words[0] == "queue_overflow_policy" and words[1] in policies:
+        options["queueOverflowPolicy"] = words[1]
+      elif words[0] == "timer_precision":
+        options["timerPrecision"] = float(words[1])
+      elif words[0] == "reaper_batch_size" and int(words[1]) > 0:
+        options["reaperBatchSize"] = int(words[1])
+      elif words[0] == "concurrency" and words[1] in ["single", "fine"]:
+        options["concurrency"] = words[1]
       elif words[0] == "persistence" and words[1] == "true":
         options["persistence"] = True
+      elif words[0] == "coverage" and words[1] == "false":
+        options["coverage"] = False
       elif words[0] in ["maximum_qos", "retain_available", "subscription_identifier_available",
               "shared_subscription_available", "server_keep_alive", "visual", "mscfile"]:
         bools = {"true":True,'false':False}
@@ -91,14 +108,14 @@ def process_config(config, options):
         ca_certs = certfile = keyfile = None
         cert_reqs=ssl.CERT_REQUIRED
         bind_address = ""
-        port = 1883; TLS=False; allow_non_sni_connections=True;
+        port = 1883; TLS=False; allow_non_sni_connections=True; threads=4
         if len(words) > 1:
           port = int(words[1])
         protocol = "mqtt"
         if len(words) >= 3:
           bind_address = words[2]
         if len(words) >= 4:
-          if words[3] in ["mqttsn", "http"]:
+          if words[3] in ["mqttsn", "http", "selector", "asyncio"]:
             protocol = words[3]
         while lineno < len(config) and not config[lineno].strip().startswith("listener"):
           curline = config[lineno].strip()
@@ -118,10 +135,20 @@ def process_config(config, options):
           elif words[0] == "allow_non_sni_connections":
             if words[1] == "false":
               allow_non_sni_connections = False
+          elif words[0] == "threads":
+            threads = int(words[1])
         if protocol == "mqtt":
           servers_to_create.append((TCPListeners, {"host":bind_address, "port":port, "TLS":TLS, "cert_reqs":cert_reqs,
                       "ca_certs":ca_certs, "certfile":certfile, "keyfile":keyfile, 
                       "allow_non_sni_connections":allow_non_sni_connections}))
+        elif protocol == "selector":
+          servers_to_create.append((SelectorListeners, {"host":bind_address, "port":port, "TLS":TLS, "cert_reqs":cert_reqs,
+                      "ca_certs":ca_certs, "certfile":certfile, "keyfile":keyfile,
+                      "allow_non_sni_connections":allow_non_sni_connections, "threads":threads}))
+        elif protocol == "asyncio":
+          servers_to_create.append((AsyncioListeners, {"host":bind_address, "port":port, "TLS":TLS, "cert_reqs":cert_reqs,
+                      "ca_certs":ca_certs, "certfile":certfile, "keyfile":keyfile,
+                      "allow_non_sni_connections":allow_non_sni_connections, "threads":threads}))
         elif protocol == "mqttsn":
           servers_to_create.append((UDPListeners, {"host":bind_address, "port":port}))
         elif protocol == "http":
@@ -130,19 +157,8 @@ def process_config(config, options):
     servers_to_create[-1][1]["serve_forever"] = True
     return servers_to_create, options
 
-def run(config=None):
-  global logger, broker3, broker5, brokerSN, server
-  logger = logging.getLogger('MQTT broker')
-  logger.setLevel(logging.INFO)
-  logger.addFilter(filter)
-
-  logger.info("Python version "+sys.version)
-
-  signal.signal(signal.SIGTERM, handler)
-
-  lock = threading.RLock() # shared lock
-
-  options = {
+def default_options():
+  return {
     "visual":False,
     "persistence": False,
     "overlapping_single": True,
@@ -158,8 +174,33 @@ def run(config=None):
     "subscription_identifier_available":True,
     "shared_subscription_available":True,
     "server_keep_alive":None,
+    "concurrency":"single", # or "fine" for separate session, subscription, retained and client locks
+    "coverage":True, # count the conformance statements, or drop them for speed
+    # limits on the messages queued for clients, for each session and for all of them, None for no limit
+    "maxQueuedMessages":None,
+    "maxQueuedBytes":None,
+    "maxTotalQueuedMessages":None,
+    "maxTotalQueuedBytes":None,
+    "queueOverflowPolicy":"drop_oldest", # or "drop_newest", "drop_qos0", "disconnect"
+    "timerPrecision":1.0, # seconds, for keepalive, will delay, session expiry and message expiry
+    "reaperBatchSize":100, # subscriptions and messages freed for expired sessions each time the lock is taken
   }
 
+def run(config=None):
+  global logger, broker3, broker5, brokerSN, server
+  logger = logging.getLogger('MQTT broker')
+  logger.setLevel(logging.INFO)
+
+  logger.info("Python version "+sys.version)
+
+  signal.signal(signal.SIGTERM, handler)
+
+  lock = threading.RLock() # shared lock
+  # locks for the subscriptions and retained messages, which all the brokers share
+  locks = {"subscriptions": threading.RLock(), "retained": threading.RLock()}
+
+  options = default_options()
+
   if config != None:
     servers_to_create, options = process_config(config, options)
 
@@ -170,11 +211,23 @@ def run(config=None):
     sharedData = {}
   logger.debug("Starting sharedData %s", sharedData)
 
-  broker3 = MQTTV3Brokers(options=options.copy(), lock=lock, sharedData=sharedData)
+  if options["coverage"]:
+    filter.attach(logger)
+  else:
+    logger.info("Conformance statements will not be logged or counted")
+    filter.detach(logger)
+    production(logger)
+
+  queueLimits = QueueLimits(options) # the total limits are for the clients of both brokers
+  timers = TimerWheels(options["timerPrecision"])
+
+  broker3 = MQTTV3Brokers(options=options.copy(), lock=lock, sharedData=sharedData, locks=locks,
+      queueLimits=queueLimits, timers=timers)
 
-  broker5 = MQTTV5Brokers(options=options.copy(), lock=lock, sharedData=sharedData)
+  broker5 = MQTTV5Brokers(options=options.copy(), lock=lock, sharedData=sharedData, locks=locks,
+      queueLimits=queueLimits, timers=timers)
 
-  brokerSN = MQTTSNBrokers(lock=lock, sharedData=sharedData)
+  brokerSN = MQTTSNBrokers(lock=lock, sharedData=sharedData, locks=locks)
 
   brokers = [broker3, broker5, brokerSN]
 
@@ -187,6 +240,8 @@ def run(config=None):
   servers = []
   UDPListeners.setBroker(brokerSN)
   TCPListeners.setBrokers(broker3, broker5)
+  SelectorListeners.setBrokers(broker3, broker5)
+  AsyncioListeners.setBrokers(broker3, broker5)
   HTTPListeners.setBrokers(broker3, broker5, brokerSN)
   HTTPListeners.setSharedData(lock, sharedData)
 
@@ -219,7 +274,8 @@ def run(config=None):
       broker.shutdown()
     except:
       traceback.print_exc()
-  filter.measure()
+  if options["coverage"]:
+    filter.measure()
 
   logger.debug("Ending sharedData %s", sharedData)
   if options["persistence"]:
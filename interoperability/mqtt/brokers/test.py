@@ -0,0 +1,881 @@
+import unittest, socket, threading, logging
+
+from mqtt.brokers.TopicTrees import TopicTrees, TopicNameTrees
+from mqtt.brokers import OutboundQueues, coverage
+from mqtt.brokers.V5 import Topics
+from mqtt.brokers.V311 import Topics as V3Topics
+from mqtt.brokers.V5.SubscriptionEngines import SubscriptionEngines
+from mqtt.brokers.V5.Subscriptions import Subscriptions
+from mqtt.brokers.V311.SubscriptionEngines import SubscriptionEngines as V3SubscriptionEngines
+from mqtt.brokers.listeners import TCPListeners, SelectorListeners
+import mqtt.formats.MQTTV5 as MQTTV5
+import mqtt.formats.MQTTV311 as MQTTV3
+
+filters = ['level1/+/level3', 'level1/#', 'level1/level2', 'le(el1/le)el2',
+   '+/le?el2', '/le?el2', '/+', '/#', '#', '+/+', '+', '$share/group/level1/+',
+   'level1/level2/level3/#', '+/level2/#']
+
+topics = ['level1', 'level1/level2', 'level1/level2/level3',
+   'le(el1/le?el2', '/level1a', '/', 'level1/', 'a/b/c/d']
+
+class Test(unittest.TestCase):
+
+    def testTopicTrees(self):
+      tree = TopicTrees()
+      for f in filters:
+        tree.add(f, f)
+      self.assertEqual(len(tree), len(filters))
+      for t in topics:
+        self.assertEqual(tree.match(t), [f for f in filters if Topics.topicMatches(f, t)],
+            "For topic %s" % t)
+      for f in filters:
+        self.assertTrue(tree.remove(f, f))
+        self.assertFalse(tree.remove(f, f))
+      self.assertEqual(len(tree), 0)
+      self.assertEqual(tree.root.children, {})
+
+    def testTopicNameTrees(self):
+      tree = TopicNameTrees()
+      for t in topics:
+        tree.add(t)
+      tree.add(topics[0])
+      self.assertEqual(len(tree), len(topics))
+      for f in filters + ['level1/+/+/#', '+/+/+/+', '+/']:
+        names = f.split('/', 2)[2] if f.startswith('$share/') else f
+        self.assertEqual(tree.match(names), [t for t in topics if Topics.topicMatches(f, t)],
+            "For filter %s" % f)
+      for t in topics:
+        self.assertTrue(tree.remove(t))
+        self.assertFalse(tree.remove(t))
+      self.assertEqual(len(tree), 0)
+      self.assertEqual(tree.root.children, {})
+
+    def testTopicMatches(self):
+      names = ['level1', 'level1/level2', 'level1/level2/level3',
+         'le(el1/le?el2', '/level1a', 'level1/']
+      tests = \
+      [('level1/+/level3', [False, False, True, False, False, False]),
+       ('level1/#', [True, True, True, False, False, True]),
+       ('level1/level2', [False, True, False, False, False, False]),
+       ('le(el1/le)el2', [False, False, False, False, False, False]),
+       ('+/le?el2', [False, False, False, True, False, False]),
+       ('/le?el2', [False, False, False, False, False, False]),
+       ('/+', [False, False, False, False, True, False]),
+       ('/#', [False, False, False, False, True, False]),
+       ('+/+', [False, True, False, True, False, False]),
+       ('level1/+', [False, True, False, False, False, False]),
+       ('#', [True, True, True, True, True, True])]
+      for wild, results in tests:
+        for i in range(len(results)):
+          self.assertEqual(Topics.topicMatches(wild, names[i]), results[i],
+            "For filter %s and topic %s" % (wild, names[i]))
+          self.assertEqual(V3Topics.topicMatches(wild, names[i]), results[i])
+      self.assertTrue(Topics.topicMatches("$share/group/level1/#", "level1/level2"))
+      self.assertFalse(V3Topics.topicMatches("$share/group/level1/#", "level1/level2"))
+      self.assertFalse(Topics.topicMatches("1/2/#", "1/2s/s"))
+      self.assertTrue(Topics.topicMatches("1/2/#", "1/2/s"))
+
+    def testSubscriptionEngines(self):
+      sharedData = {}
+      se = SubscriptionEngines(sharedData)
+      se3 = V3SubscriptionEngines(sharedData)
+      options = (MQTTV5.SubscribeOptions(1), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))
+      se.subscribe("Client1", ["topic1", "topic2/+"], [options, options])
+      se.subscribe("Client2", ["#", "$SYS/#"], [options, options])
+      se3.subscribe("Client3", ["topic1", "topic2/#"], [0, 2])
+      self.assertEqual([s.getClientid() for s in se.getSubscriptions("topic1")],
+        ["Client1", "Client2", "Client3"])
+      self.assertEqual(se3.subscribers("topic2/a"), ["Client1", "Client2", "Client3"])
+      self.assertEqual([s.getClientid() for s in se.subscriptions("$SYS/a")], ["Client2"])
+      self.assertEqual(se3.qosOf("Client3", "topic2/a"), 2)
+      se.clearSubscriptions("Client2")
+      se3.unsubscribe("Client3", "topic1")
+      self.assertEqual(se3.subscribers("topic1"), ["Client1"])
+      self.assertEqual(se.subscriptions("$SYS/a"), set())
+      self.assertEqual(list(sharedData["subscriptions"].keys()), ["Client1", "Client3"])
+      self.assertEqual(list(sharedData["subscriptions"]["Client3"].keys()), ["topic2/#"])
+      self.assertEqual(sharedData["dollar_subscriptions"], {})
+      se3.clearSubscriptions("Client3")
+      se.unsubscribe("Client1", ["topic1", "topic2/+"])
+      self.assertEqual(sharedData["subscriptions"], {})
+      self.assertEqual(len(sharedData["subscription_trees"]["subscriptions"]), 0)
+
+    def testRetained(self):
+      sharedData = {}
+      se = SubscriptionEngines(sharedData)
+      se3 = V3SubscriptionEngines(sharedData)
+      se.setRetained("a/b", b"1", 1, 0, None)
+      se3.setRetained("a/c", b"2", 0, 0)
+      se3.setRetained("$SYS/a", b"3", 0, 0)
+      self.assertEqual(se.getRetainedTopics("a/+"), ["a/b", "a/c"])
+      self.assertEqual(se.getRetainedTopics("$share/group/a/#"), ["a/b", "a/c"])
+      self.assertEqual(se3.getRetainedTopics("#"), ["a/b", "a/c"])
+      self.assertEqual(se3.getRetainedTopics("$SYS/#"), ["$SYS/a"])
+      se.setRetained("a/b", b"", 1, 0, None)
+      self.assertEqual(se3.getRetainedTopics("a/#"), ["a/c"])
+      self.assertEqual(se.getRetained("a/c"), (b"2", 0, 0))
+      # in the order they were retained, as in the retained messages, whatever the levels
+      for topic in ["a/b", "a/a", "a", "a/c/d"]:
+        se.setRetained(topic, b"4", 0, 0, None)
+      se.setRetained("a/c", b"5", 0, 0, None) # replaced, so not moved
+      self.assertEqual(se.getRetainedTopics("a/#"), ["a/c", "a/b", "a/a", "a", "a/c/d"])
+      self.assertEqual(se.getRetainedTopics("a/#"), [topic for topic in sharedData["retained"] if topic.startswith("a")])
+
+    def testFraming(self):
+      connect = MQTTV5.Connects().pack()
+      publish = MQTTV5.Publishes()
+      publish.topicName = "topic"
+      publish.data = b"x" * 200 # a two byte remaining length
+      publish = publish.pack()
+      self.assertEqual(SelectorListeners.protocolVersion(connect), 5)
+      self.assertEqual(SelectorListeners.protocolVersion(MQTTV3.Connects().pack()), 4)
+      self.assertEqual(SelectorListeners.protocolVersion(publish), None)
+
+      mask = b"\x01\x02\x03\x04"
+      def wsframe(packet):
+        return bytes([0x82, 0x80 | 126]) + len(packet).to_bytes(2, "big") + mask + \
+          bytes([b ^ mask[i % 4] for i, b in enumerate(packet)])
+      frame = wsframe(publish)
+      self.assertEqual(TCPListeners.wsframe(frame[:-1]), None)
+      self.assertEqual(TCPListeners.wsframe(frame + b"\x82"), (0x2, publish, len(frame)))
+
+      # buffered sockets, with and without websockets
+      for websockets in [False, True]:
+        client, server = socket.socketpair()
+        sock = TCPListeners.BufferedSockets(server)
+        sock.websockets = websockets
+        packets = [connect] + [publish] * 3
+        client.sendall(b"".join(map(wsframe, packets)) if websockets else b"".join(packets))
+        self.assertEqual(sock.recv(1), connect[:1])
+        sock.rebuffer(connect[:1])
+        self.assertEqual(MQTTV5.getPacket(sock), connect)
+        self.assertTrue(sock.pending())
+        self.assertEqual(MQTTV3.getPacket(sock), publish)
+        client.close()
+        while MQTTV5.getPacket(sock) != None:
+          pass
+        self.assertFalse(sock.pending())
+        server.close()
+
+      # websocket control frames, and packets split across frames and reads
+      def maskedFrame(firstByte, payload):
+        return bytes([firstByte, 0x80 | len(payload)]) + mask + \
+          bytes([b ^ mask[i % 4] for i, b in enumerate(payload)])
+      large = MQTTV5.Publishes()
+      large.topicName = "topic"
+      large.data = b"x" * 70000 # an eight byte websocket length
+      large = large.pack()
+      frame = bytes([0x82, 0x80 | 127]) + len(large).to_bytes(8, "big") + mask + \
+          TCPListeners.unmask(large, mask)
+      self.assertEqual(TCPListeners.wsframe(frame), (0x2, large, len(frame)))
+      client, server = socket.socketpair()
+      sock = TCPListeners.BufferedSockets(server)
+      sock.websockets = True
+      data = maskedFrame(0x02, publish[:100]) + maskedFrame(0x89, b"ping") + \
+             maskedFrame(0x80, publish[100:]) + maskedFrame(0x88, b"\x03\xe8")
+      self.assertTrue(sock.wsfeed(data[:150]))
+      self.assertEqual(sock.framer.nextPacket(), None)
+      self.assertEqual(client.recv(100), b"\x8a\x04ping")
+      self.assertFalse(sock.wsfeed(data[150:]))
+      self.assertEqual(bytes(sock.framer.nextPacket()), publish)
+      self.assertEqual(client.recv(100), b"\x88\x02\x03\xe8")
+      self.assertEqual(sock.send(connect), len(connect) + 2)
+      self.assertEqual(client.recv(100), b"\x82" + bytes([len(connect)]) + connect)
+      client.close()
+      server.close()
+
+    def testSelectorSockets(self):
+      "the selector thread neither waits on a socket nor writes, and writers wait for a full socket"
+      class Servers:
+        def __init__(self):
+          self.items = []
+        def schedule(self, connection, item):
+          self.items.append(item)
+        def unregister(self, connection):
+          pass
+      server = Servers()
+      client, sock = socket.socketpair()
+      sock.setblocking(False)
+      connection = SelectorListeners.SelectorSockets(sock, server)
+      connection.read() # nothing to read yet
+      self.assertEqual(server.items, [])
+      pingreq = MQTTV5.Pingreqs().pack()
+      connection.packet = pingreq
+      self.assertEqual(MQTTV5.getPacket(connection), pingreq)
+      self.assertEqual(sock.gettimeout(), 0.0) # getPacket leaves the socket non-blocking
+      request = b"GET /mqtt HTTP/1.1\r\nUpgrade: websocket\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n" + \
+          b"Sec-WebSocket-Protocol: mqtt\r\n\r\n"
+      client.sendall(request[:20])
+      connection.read()
+      client.sendall(request[20:])
+      connection.read()
+      self.assertEqual([item[0] for item in server.items], [SelectorListeners.WRITE]) # the response, for the pool
+      self.assertTrue(connection.websockets)
+      # websocket control frames are answered by the pool too
+      del server.items[:]
+      client.sendall(bytes([0x89, 0x84]) + b"\0\0\0\0" + b"ping")
+      connection.read()
+      self.assertEqual(server.items, [(SelectorListeners.WRITE, b"\x8a\x04ping")])
+      # a write larger than the socket buffer waits for the client to read it
+      data = b"x" * 4000000
+      received = []
+      def reader():
+        while sum(map(len, received)) < len(data) + 10:
+          received.append(client.recv(65536))
+      thread = threading.Thread(target=reader)
+      thread.start()
+      self.assertEqual(connection.send(data), len(data) + 10) # with a websocket header
+      thread.join()
+      self.assertEqual(b"".join(received)[10:], data)
+      client.close()
+      sock.close()
+
+    def testAsyncioBackpressure(self):
+      "a client which doesn't read holds up the threads sending to it, rather than filling memory"
+      import time
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      from mqtt.brokers.V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+      from mqtt.brokers.listeners import AsyncioListeners
+      port = 18990
+      broker3 = MQTTV3Brokers(default_options(), sharedData={})
+      broker5 = MQTTBrokers(default_options(), sharedData={})
+      AsyncioListeners.setBrokers(broker3, broker5)
+      server = AsyncioListeners.create(port, host="localhost", threads=2)
+      time.sleep(.5)
+      socks = []
+      def connect(clientid):
+        sock = socket.create_connection(("localhost", port), timeout=5)
+        socks.append(sock)
+        connect = MQTTV5.Connects()
+        connect.ClientIdentifier = clientid
+        sock.sendall(connect.pack())
+        MQTTV5.getPacket(sock) # connack
+        return sock
+      try:
+        subscriber = connect("subscriber")
+        subscriber.sendall(MQTTV5.Subscribes(MsgId=1, Data=[("t", MQTTV5.SubscribeOptions(0))]).pack())
+        MQTTV5.getPacket(subscriber) # suback
+        publisher = connect("publisher")
+        publish = MQTTV5.Publishes()
+        publish.topicName = "t"
+        publish.data = b"x" * 200 # within the default maximum packet size
+        data = publish.pack()
+        def sender():
+          try:
+            publisher.sendall(data * 100000)
+          except OSError:
+            pass # held up until the sockets are closed
+        thread = threading.Thread(target=sender, daemon=True)
+        thread.start()
+        time.sleep(2)
+        waiting = max(connection.socket.scheduled + connection.socket.writer.transport.get_write_buffer_size()
+            for connection in list(server.connections))
+        self.assertLess(waiting, AsyncioListeners.StreamSockets.highWater + 2 * len(data))
+      finally:
+        for sock in socks:
+          sock.close()
+        for i in range(50): # the disconnections are handled by the pool, before the brokers shut down
+          if len(server.connections) == 0:
+            break
+          time.sleep(.1)
+        server.shutdown()
+        broker5.shutdown()
+        broker3.shutdown()
+
+    def testSelectorTLS(self):
+      "a TLS connection is read by the selector thread while another thread writes to it"
+      import ssl, os, selectors
+      keys = os.path.join(os.path.dirname(__file__), "..", "..", "tls_testing", "keys", "server")
+      context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+      context.load_cert_chain(os.path.join(keys, "server.crt"), os.path.join(keys, "server.key"))
+      clientContext = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+      clientContext.check_hostname = False
+      clientContext.verify_mode = ssl.CERT_NONE
+      client, sock = socket.socketpair()
+      received = []
+      handshake = threading.Thread(target=lambda: received.append(clientContext.wrap_socket(client)))
+      handshake.start()
+      sock = context.wrap_socket(sock, server_side=True)
+      handshake.join()
+      client = received.pop()
+      class Servers:
+        def __init__(self):
+          self.items = []
+        def schedule(self, connection, item):
+          self.items.append(item)
+        def unregister(self, connection):
+          pass
+      server = Servers()
+      sock.setblocking(False)
+      connection = SelectorListeners.SelectorSockets(sock, server)
+      publish = MQTTV5.Publishes()
+      publish.topicName = "topic"
+      publish.data = b"x" * 1000
+      publish = publish.pack()
+      data = b"y" * 4000000
+      def peer():
+        client.sendall(publish * 2000)
+        while sum(map(len, received)) < len(data):
+          received.append(client.recv(65536))
+      threads = [threading.Thread(target=peer), threading.Thread(target=connection.sendAll, args=(data,))]
+      for thread in threads:
+        thread.start()
+      with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        while len(server.items) < 2000:
+          selector.select(5)
+          connection.read()
+      for thread in threads:
+        thread.join()
+      self.assertEqual(server.items, [publish] * 2000)
+      self.assertEqual(b"".join(received), data)
+      client.close()
+      sock.close()
+
+    def testUnpackPackets(self):
+      publish = MQTTV3.Publishes()
+      publish.topicName = "topic"
+      publish.data = b"x" * 200
+      stream = MQTTV3.Pingreqs().pack() + publish.pack() * 2
+      generator = MQTTV3.unpackPackets(stream + publish.pack()[:10])
+      unpacked = []
+      try:
+        while True:
+          unpacked.append(next(generator))
+      except StopIteration as stop:
+        self.assertEqual(stop.value, len(stream))
+      self.assertEqual(unpacked, [MQTTV3.Pingreqs(), publish, publish])
+      self.assertEqual(MQTTV3.packetLength(stream, 2), len(publish.pack()))
+      self.assertEqual(MQTTV3.packetLength(stream, 2, 3), None)
+
+    def testV3Packing(self):
+      publish = MQTTV3.Publishes()
+      publish.topicName = "topic"
+      publish.messageIdentifier = 258
+      for qos, size, header in [(0, 0, b"\x30\x07"), (1, 200, b"\x32\xd1\x01"), (2, 20000, b"\x34\xa9\x9c\x01")]:
+        publish.fh.QoS = qos
+        publish.data = b"x" * size
+        identifier = b"\x01\x02" if qos else b""
+        self.assertEqual(publish.pack(), header + b"\x00\x05topic" + identifier + publish.data)
+        self.assertEqual(MQTTV3.unpackPacket(publish.pack()), publish)
+        self.assertEqual(MQTTV3.unpackPacket(bytearray(publish.pack())), publish)
+        self.assertEqual(MQTTV3.unpackPacket(memoryview(publish.pack())), publish)
+      self.assertEqual(MQTTV3.Pubrels(MsgId=258).pack(), b"\x62\x02\x01\x02")
+      self.assertEqual(MQTTV3.Subscribes(MsgId=1, Data=[("a", 1), ("b/#", 2)]).pack(),
+                       b"\x82\x0c\x00\x01\x00\x01a\x01\x00\x03b/#\x02")
+      connect = MQTTV3.Connects()
+      connect.ClientIdentifier = "client"
+      self.assertEqual(connect.pack(), b"\x10\x12\x00\x04MQTT\x04\x02\x00\x1e\x00\x06client")
+      for packet in MQTTV3.classes[1:]:
+        self.assertFalse(hasattr(packet(), "__dict__"), packet.__name__)
+      self.assertTrue(MQTTV3.Publishes(Retain=True).fh.RETAIN)
+
+    def testPersistedSubscriptions(self):
+      "subscriptions persisted as lists are indexed when the engines start"
+      options = (MQTTV5.SubscribeOptions(1), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))
+      subscriptions = [Subscriptions("Client1", "topic1", options),
+                       Subscriptions("Client2", "#", options)]
+      sharedData = {"subscriptions": subscriptions[:], "dollar_subscriptions": []}
+      se = SubscriptionEngines(sharedData)
+      self.assertEqual(se.getSubscriptions("topic1"), subscriptions)
+      self.assertEqual(sharedData["subscriptions"]["Client2"], {"#": subscriptions[1]})
+      self.assertEqual(se.subscribe("Client2", "#", options), (None, True))
+
+    def testOutboundQueues(self):
+      written = []
+      queue = OutboundQueues.OutboundQueues()
+      for i in range(3):
+        queue.put(lambda i=i: written.append(i))
+      self.assertEqual(written, [])
+      OutboundQueues.flush()
+      self.assertEqual(written, [0, 1, 2])
+
+      # while another thread is writing, flush doesn't wait, and that thread writes what is queued
+      writing, release = threading.Event(), threading.Event()
+      def slow():
+        writing.set()
+        release.wait()
+      queue.items.append(slow)
+      writer = threading.Thread(target=queue.flush)
+      writer.start()
+      writing.wait()
+      queue.put(lambda: written.append(3))
+      OutboundQueues.flush()
+      self.assertEqual(written, [0, 1, 2])
+      release.set()
+      writer.join()
+      self.assertEqual(written, [0, 1, 2, 3])
+
+    def testClientQueues(self):
+      "messages are sent in order, within the receive maximum, and resent in the same order"
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers, MQTTClients
+      class Sockets:
+        def __init__(self):
+          self.packets = []
+        def handlePacket(self, packet):
+          self.packets.append((packet.data, packet.packetIdentifier if packet.fh.QoS else None, packet.fh.DUP))
+      options = default_options()
+      options["dropQoS0"] = False
+      broker = MQTTBrokers(options)
+      try:
+        sock = Sockets()
+        client = MQTTClients("client", False, 60, 0, 60, sock, broker)
+        client.receiveMaximum = 2
+        for msg, qos in [(b"1", 1), (b"2", 2), (b"3", 0), (b"4", 1)]:
+          client.publishArrived("topic", msg, qos, None, 0)
+        self.assertEqual(sock.packets, [])
+        client.connected = True
+        client.resend()
+        self.assertEqual(sock.packets, [(b"1", 1, 0), (b"2", 2, 0)])
+        client.publishArrived("topic", b"5", 1, None, 0) # queued behind the others
+        client.puback(1)
+        self.assertEqual(sock.packets[2:], [(b"3", None, 0), (b"4", 3, 0)])
+        self.assertEqual(list(client.outbound.keys()), [2, 3])
+        self.assertEqual(len(client.queued), 1)
+        self.assertTrue(client.pubrec(2))
+        client.pubcomp(2)
+        self.assertEqual(sock.packets[4:], [(b"5", 4, 0)])
+        del sock.packets[:]
+        client.resend()
+        self.assertEqual(sock.packets, [(b"4", 3, 1), (b"5", 4, 1)])
+      finally:
+        broker.shutdown()
+
+    def testQueueLimits(self):
+      "the messages queued for sessions are limited, and the overflow policy applied"
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers, MQTTClients
+      from mqtt.brokers.MessageQueues import QueueLimits
+      class Sockets:
+        def __init__(self):
+          self.packets = []
+        def handlePacket(self, packet):
+          self.packets.append(packet.data if hasattr(packet, "data") else str(packet.reasonCode))
+        def shutdown(self, how):
+          self.packets.append("shutdown")
+      def queue(policy, messages, **limits):
+        "the data queued for two offline sessions, after publishing messages to each, and the stats"
+        options = default_options()
+        options["dropQoS0"] = False
+        options["queueOverflowPolicy"] = policy
+        options.update(limits)
+        broker = MQTTBrokers(options)
+        try:
+          clients = [MQTTClients(id, False, 60, 0, 60, Sockets(), broker) for id in ["a", "b"]]
+          for client in clients:
+            for msg, qos in messages:
+              client.publishArrived("t", msg, qos, None, 0)
+          return [[pub.data for pub in client.queued] for client in clients], broker.queueLimits.stats()
+        finally:
+          broker.shutdown()
+      messages = [(b"1", 1), (b"2", 0), (b"3", 1), (b"4", 0), (b"5", 1)]
+      queued, stats = queue("drop_oldest", messages)
+      self.assertEqual(queued, [[b"1", b"2", b"3", b"4", b"5"]] * 2)
+      self.assertEqual((stats["messages"], stats["bytes"], stats["dropped"]), (10, 20, 0))
+      queued, stats = queue("drop_oldest", messages, maxQueuedMessages=3)
+      self.assertEqual(queued, [[b"3", b"4", b"5"]] * 2)
+      self.assertEqual((stats["messages"], stats["dropped"], stats["max_messages"]), (6, 4, 6))
+      queued, stats = queue("drop_newest", messages, maxQueuedBytes=6) # 2 bytes each
+      self.assertEqual(queued, [[b"1", b"2", b"3"]] * 2)
+      queued, stats = queue("drop_qos0", messages, maxQueuedMessages=3)
+      self.assertEqual(queued, [[b"1", b"3", b"5"]] * 2)
+      queued, stats = queue("drop_qos0", messages + [(b"6", 1)], maxQueuedMessages=3)
+      self.assertEqual(queued, [[b"1", b"3", b"5"]] * 2)
+      queued, stats = queue("drop_oldest", messages, maxTotalQueuedMessages=7)
+      self.assertEqual(queued, [[b"1", b"2", b"3", b"4", b"5"], [b"4", b"5"]])
+      queued, stats = queue("drop_newest", messages, maxTotalQueuedBytes=14)
+      self.assertEqual(queued, [[b"1", b"2", b"3", b"4", b"5"], [b"1", b"2"]])
+      self.assertEqual((stats["messages"], stats["bytes"], stats["dropped"]), (7, 14, 3))
+      # a connected client not taking its messages is disconnected, and the counts kept
+      options = default_options()
+      options.update({"maxQueuedMessages": 1, "queueOverflowPolicy": "disconnect"})
+      broker = MQTTBrokers(options)
+      try:
+        sock = Sockets()
+        client = MQTTClients("client", False, 60, 0, 60, sock, broker)
+        client.receiveMaximum = 1
+        client.connected = True
+        for msg in [b"1", b"2", b"3"]:
+          client.publishArrived("t", msg, 1, None, 0)
+        self.assertEqual(sock.packets, [b"1", "Quota exceeded", "shutdown"])
+        stats = broker.queueLimits.stats()
+        self.assertEqual((stats["messages"], stats["dropped"], stats["disconnects"]), (1, 1, 1))
+        client.puback(1)
+        self.assertEqual(sock.packets[3:], [b"2"])
+        self.assertEqual(broker.queueLimits.stats()["messages"], 0)
+      finally:
+        broker.shutdown()
+      # the expiry timers of dropped messages are cancelled
+      for policy in ["drop_oldest", "drop_newest"]:
+        options = default_options()
+        options.update({"maxQueuedMessages": 1, "queueOverflowPolicy": policy})
+        broker = MQTTBrokers(options)
+        try:
+          client = MQTTClients("client", False, 60, 0, 60, Sockets(), broker)
+          properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+          properties.MessageExpiryInterval = 3600
+          for i in range(10):
+            client.publishArrived("t", b"%d" % i, 1, properties, 0)
+          self.assertEqual([pub.data for pub in client.queued], [b"9" if policy == "drop_oldest" else b"0"])
+          self.assertEqual(list(client.expiryTimers), [id(pub) for pub in client.queued])
+          self.assertEqual(sum(len(slot) for wheel in broker.timers.wheels for slot in wheel), 1)
+        finally:
+          broker.shutdown()
+      # any queued message can be removed, such as one which has expired, leaving the others in order
+      from mqtt.brokers.MessageQueues import MessageQueues
+      limits = QueueLimits()
+      queue = MessageQueues(limits)
+      pubs = []
+      for i in range(5):
+        pubs.append(MQTTV5.Publishes())
+        pubs[-1].topicName = "t"
+        pubs[-1].data = b"%d" % i
+        queue.append(pubs[-1])
+      self.assertTrue(queue.remove(pubs[2]))
+      self.assertFalse(queue.remove(pubs[2]))
+      self.assertEqual([pub.data for pub in queue], [b"0", b"1", b"3", b"4"])
+      self.assertEqual((limits.messages, limits.bytes), (4, 8))
+      self.assertEqual(queue.popleft(), pubs[0])
+      self.assertRaises(ValueError, QueueLimits, {"queueOverflowPolicy": "drop_all"})
+
+    def testTimerWheels(self):
+      "timers fire in order, within the precision and never early, however far ahead they are"
+      import random
+      from mqtt.brokers.TimerWheels import TimerWheels
+      timers = TimerWheels(precision=0.5, slots=4, wheels=3) # covers 32 seconds, then cascades again
+      timers.stop() # fired here instead
+      fired = []
+      random.seed(0)
+      times = [timers.started + random.uniform(0, 100) for i in range(1000)]
+      scheduled = [timers.scheduleAt(when, fired.append, i) for i, when in enumerate(times)]
+      cancelled = set(range(0, 1000, 7))
+      for i in cancelled:
+        timers.cancel(scheduled[i])
+      now = timers.started
+      while now < timers.started + 101:
+        count = len(fired)
+        timers.fire(now)
+        for i in fired[count:]:
+          self.assertTrue(now - 0.6 < times[i] <= now + 1e-9) # now goes up in steps of 0.1
+        now += 0.1
+      self.assertEqual(sorted(fired), [i for i in range(1000) if i not in cancelled])
+      # a timer already due fires on the next tick, and one scheduled by a timer is kept
+      timers.schedule(-5, lambda: timers.schedule(0, fired.append, "again"))
+      timers.fire(now + 0.5)
+      timers.fire(now + 1)
+      self.assertEqual(fired[-1], "again")
+
+    def testBrokerTimers(self):
+      "keepalive, will delay, session expiry and message expiry are timed by the broker's timers"
+      import time
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      from mqtt.brokers.TimerWheels import TimerWheels
+      class Sockets:
+        def __init__(self):
+          self.packets = []
+          self.shut = False
+        def handlePacket(self, packet):
+          self.packets.append(packet)
+        def shutdown(self, how):
+          self.shut = True
+        def close(self):
+          pass
+      timers = TimerWheels(precision=0.1)
+      timers.stop() # fired here instead
+      broker = MQTTBrokers(default_options(), timers=timers)
+      broker.reaper.stop() # reaped here instead
+      try:
+        connect = MQTTV5.Connects()
+        connect.ClientIdentifier = "timed"
+        connect.KeepAliveTimer = 2
+        connect.properties.SessionExpiryInterval = 10
+        connect.WillFlag = True
+        connect.WillTopic = "will"
+        connect.WillMessage = b"gone"
+        connect.WillQoS = 1
+        connect.WillProperties.WillDelayInterval = 5
+        sock = Sockets()
+        start = time.monotonic()
+        broker.connect(sock, connect)
+        client = broker.broker.getClient("timed")
+        subscribe = MQTTV5.Subscribes(MsgId=1, Data=[("#", MQTTV5.SubscribeOptions(1))])
+        broker.subscribe(sock, subscribe)
+        client.lastPacket = start + 1 # a packet received after a second
+        timers.fire(start + 2.9)
+        self.assertFalse(sock.shut)
+        timers.fire(start + 4.1)
+        self.assertTrue(sock.shut)
+        broker.disconnect(sock, None, sendWillMessage=True) # as its handler would
+        self.assertEqual(client.will[1:3], (1, b"gone"))
+        properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+        properties.MessageExpiryInterval = 1
+        client.publishArrived("topic", b"expires", 1, properties, start + 3.5)
+        client.publishArrived("topic", b"stays", 1, None, start + 3.5)
+        self.assertEqual(len(client.queued), 2)
+        timers.fire(start + 4.9)
+        self.assertFalse(broker.reaper.reap())
+        self.assertEqual([pub.data for pub in client.queued], [b"stays"])
+        self.assertNotEqual(client.will, None)
+        timers.fire(start + 5.1)
+        self.assertEqual(client.will, None) # sent after the will delay
+        self.assertEqual([pub.data for pub in client.queued], [b"stays", b"gone"])
+        timers.fire(start + 14)
+        self.assertEqual(broker.broker.getClient("timed"), client) # until reaped
+        self.assertFalse(broker.reaper.reap())
+        self.assertEqual(broker.broker.getClient("timed"), None) # expired
+        self.assertEqual(broker.queueLimits.stats()["messages"], 0)
+        self.assertEqual(broker.broker.se.getSubscriptions("topic"), [])
+      finally:
+        broker.shutdown()
+
+    def testReaper(self):
+      "expired sessions are freed in batches, and can be replaced while that is done"
+      import time
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      from mqtt.brokers.TimerWheels import TimerWheels
+      class Sockets:
+        def handlePacket(self, packet):
+          pass
+        def shutdown(self, how):
+          pass
+        def close(self):
+          pass
+      timers = TimerWheels(precision=0.1)
+      timers.stop() # fired here instead
+      options = default_options()
+      options["reaperBatchSize"] = 100
+      broker = MQTTBrokers(options, timers=timers)
+      broker.reaper.stop() # reaped here instead
+      try:
+        def session(id):
+          "a disconnected session with 250 subscriptions and 150 queued messages"
+          connect = MQTTV5.Connects()
+          connect.ClientIdentifier = id
+          connect.properties.SessionExpiryInterval = 1
+          sock = Sockets()
+          broker.connect(sock, connect)
+          subscribe = MQTTV5.Subscribes(MsgId=1,
+              Data=[("topic/%d" % i, MQTTV5.SubscribeOptions(1)) for i in range(250)])
+          broker.subscribe(sock, subscribe)
+          broker.disconnect(sock, None)
+          client = broker.broker.getClient(id)
+          for i in range(150):
+            client.publishArrived("topic/0", b"queued", 1, None, time.monotonic())
+          return client
+        client = session("reaped")
+        timers.fire(time.monotonic() + 2)
+        self.assertEqual(broker.reaper.stats()["waiting"], 1)
+        for queued in [150, 150, 100]: # 250 subscriptions, then 150 messages, 100 at a time
+          self.assertTrue(broker.reaper.reap())
+          self.assertTrue(client.expired)
+          self.assertEqual(broker.broker.getClient("reaped"), client)
+          self.assertEqual(len(client.queued), queued)
+        self.assertEqual(len(broker.broker.se.getSubscriptions("topic/0")), 0)
+        client.publishArrived("topic/0", b"dropped", 1, None, time.monotonic())
+        self.assertEqual(len(client.queued), 100) # nothing more is queued for it
+        self.assertTrue(broker.reaper.reap())
+        self.assertFalse(broker.reaper.reap())
+        self.assertEqual(broker.broker.getClient("reaped"), None)
+        self.assertEqual(broker.queueLimits.stats()["messages"], 0)
+        self.assertEqual(broker.reaper.stats(),
+            {"sessions": 1, "subscriptions": 250, "messages": 0, "batches": 5, "waiting": 0})
+        # a client connecting while its old session is being reaped gets a new one
+        client = session("replaced")
+        timers.fire(time.monotonic() + 4) # the wheel has already been moved on 2 seconds
+        self.assertTrue(broker.reaper.reap())
+        connect = MQTTV5.Connects()
+        connect.ClientIdentifier = "replaced"
+        connect.CleanStart = False
+        broker.connect(Sockets(), connect)
+        self.assertNotEqual(broker.broker.getClient("replaced"), client)
+        self.assertEqual(broker.broker.se.getSubscriptions("topic/200"), [])
+        self.assertEqual(broker.queueLimits.stats()["messages"], 0)
+        self.assertFalse(broker.reaper.reap())
+        self.assertEqual(broker.reaper.stats()["sessions"], 1)
+      finally:
+        broker.shutdown()
+
+    def testTakeover(self):
+      "a client connecting with the client id of a connected client takes over its session"
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      from mqtt.brokers.V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+      class Sockets:
+        def __init__(self):
+          self.shut = False
+        def handlePacket(self, packet):
+          pass
+        def shutdown(self, how):
+          self.shut = True
+        def close(self):
+          pass
+      for brokerClass, connects in [(MQTTBrokers, MQTTV5.Connects), (MQTTV3Brokers, MQTTV3.Connects)]:
+        broker = brokerClass(default_options())
+        try:
+          socks = [Sockets() for i in range(3)]
+          for sock, clientid in zip(socks, ["a", "b", "a"]):
+            connect = connects()
+            connect.ClientIdentifier = clientid
+            broker.connect(sock, connect)
+          self.assertEqual([sock.shut for sock in socks], [True, False, False])
+          self.assertEqual(broker.sockets, {"a": socks[2], "b": socks[1]})
+          self.assertEqual([client.id for client in broker.clients.values()], ["b", "a"])
+          broker.disconnect(socks[2], None)
+          self.assertEqual(broker.sockets, {"b": socks[1]})
+        finally:
+          broker.shutdown()
+
+    def testPublishToDepartedSubscriber(self):
+      "a publish skips subscribers whose sessions end while it is being sent, without the sessions lock"
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      from mqtt.brokers.V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+      class Sockets:
+        def __init__(self):
+          self.packets = []
+        def handlePacket(self, packet):
+          self.packets.append(packet)
+        def shutdown(self, how):
+          pass
+        def close(self):
+          pass
+      sharedData = {}
+      broker3 = MQTTV3Brokers(default_options(), sharedData=sharedData)
+      broker5 = MQTTBrokers(default_options(), sharedData=sharedData)
+      broker5.setBroker3(broker3)
+      broker3.setBroker5(broker5)
+      try:
+        socks = {}
+        for clientid in ["gone", "here"]:
+          socks[clientid] = Sockets()
+          connect = MQTTV5.Connects()
+          connect.ClientIdentifier = clientid
+          broker5.connect(socks[clientid], connect)
+          broker5.subscribe(socks[clientid], MQTTV5.Subscribes(MsgId=1, Data=[("t", MQTTV5.SubscribeOptions(0))]))
+        del broker5.broker.getClients()["gone"] # as a disconnect on another thread does
+        for broker in [broker5.broker, broker3.broker]:
+          del socks["here"].packets[:]
+          if broker is broker5.broker:
+            broker.publish("here", "t", b"data", 0, False, None, 0)
+          else:
+            broker.publish("here", "t", b"data", 0, False, 0)
+          self.assertEqual([packet.data for packet in socks["here"].packets], [b"data"])
+      finally:
+        broker5.shutdown()
+        broker3.shutdown()
+
+    def testStats(self):
+      "the HTTP listener reports the sizes of the shared topic trees"
+      import json
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      from mqtt.brokers.V311.MQTTBrokers import MQTTBrokers as MQTTV3Brokers
+      from mqtt.brokers.listeners import HTTPListeners
+      sharedData = {}
+      broker3 = MQTTV3Brokers(default_options(), sharedData=sharedData)
+      broker5 = MQTTBrokers(default_options(), sharedData=sharedData)
+      try:
+        broker5.broker.se.subscribe("Client1", ["a/+", "$SYS/#"],
+          [(MQTTV5.SubscribeOptions(0), MQTTV5.Properties(MQTTV5.PacketTypes.SUBSCRIBE))] * 2)
+        broker3.broker.se.setRetained("a/b", b"1", 0, 0)
+        HTTPListeners.setBrokers(broker3, broker5, None)
+        HTTPListeners.setSharedData(None, sharedData)
+        code, body = HTTPListeners.get_stats()
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(body)["topic_trees"],
+          {"subscriptions": 1, "dollar_subscriptions": 1, "retained": 1, "dollar_retained": 0})
+      finally:
+        broker5.shutdown()
+        broker3.shutdown()
+
+    def testDisconnectWhileWriting(self):
+      "a client whose socket is being written to is disconnected without holding the broker lock for the write"
+      from mqtt.brokers.start import default_options
+      from mqtt.brokers.V5.MQTTBrokers import MQTTBrokers
+      class Sockets:
+        def __init__(self):
+          self.packets = []
+          self.closed = False
+          self.outbound = OutboundQueues.OutboundQueues()
+        def handlePacket(self, packet):
+          self.packets.append(packet)
+        def shutdown(self, how):
+          pass
+        def close(self):
+          self.closed = True
+      options = default_options()
+      options["concurrency"] = "fine"
+      broker = MQTTBrokers(options)
+      try:
+        sock = Sockets()
+        connect = MQTTV5.Connects()
+        connect.ClientIdentifier = "slow"
+        broker.connect(sock, connect)
+        writing, release = threading.Event(), threading.Event()
+        def slow():
+          writing.set()
+          release.wait()
+        sock.outbound.put(slow)
+        writer = threading.Thread(target=sock.outbound.flush)
+        writer.start()
+        writing.wait()
+        broker.disconnect(sock)
+        OutboundQueues.flush() # as the broker does once it holds no locks
+        self.assertFalse(sock.closed) # the writer closes it, when it has finished
+        self.assertEqual(broker.broker.getClient("slow"), None)
+        release.set()
+        writer.join()
+        self.assertTrue(sock.closed)
+      finally:
+        broker.shutdown()
+
+    def testConformanceStatements(self):
+      records = []
+      logger = logging.getLogger("conformance test")
+      logger.setLevel(logging.INFO)
+      logger.propagate = False
+      handler = logging.Handler()
+      handler.emit = records.append
+      logger.addHandler(handler)
+      statements = logger.getChild("statements")
+      def log():
+        for i in range(2):
+          statements.info("[MQTT-3.3.2-5] Delete expired message")
+          statements.info("[MQTT-3.3.2-6] Message Expiry Interval set to %d", i)
+          logger.info("Not a conformance statement")
+          logger.error("[MQTT-3.1.2-2] Wrong protocol version %d", i)
+
+      # each statement is logged once, by its caller
+      filter = coverage.Filters()
+      filter.attach(logger)
+      del records[:]
+      log()
+      self.assertEqual(len(records), 5)
+      self.assertEqual(set(record.funcName for record in records), set(["log"]))
+      self.assertEqual(filter.found, set(["[MQTT-3.3.2-5]", "[MQTT-3.3.2-6]", "[MQTT-3.1.2-2]"]))
+      filter.detach(logger)
+
+      # in production, no records are made for the statements, but errors are still logged
+      coverage.production(logger)
+      makeRecord = logger.makeRecord
+      def countRecord(name, *args, **kwargs):
+        made.append(name)
+        return makeRecord(name, *args, **kwargs)
+      made = []
+      statements.makeRecord = countRecord
+      del records[:]
+      log()
+      self.assertEqual(made, [])
+      self.assertEqual([record.getMessage() for record in records],
+        ["Not a conformance statement", "[MQTT-3.1.2-2] Wrong protocol version 0"] +
+        ["Not a conformance statement", "[MQTT-3.1.2-2] Wrong protocol version 1"])
+      del statements.makeRecord
+      statements.setLevel(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    unittest.main()
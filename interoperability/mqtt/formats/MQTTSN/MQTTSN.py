@@ -286,7 +286,7 @@ class Publishes(Messages):
       self.unpack(buffer)
 
   def pack(self):
-    msglen = 6 + len(self.Data)
+    msglen = 7 + len(self.Data) # length, message type, flags, topic id and message id
     buffer = bytes([msglen, self.messageType]) + self.Flags.pack() +\
       writeInt16(self.TopicId) + writeInt16(self.MsgId) + writeData(self.Data)
     return buffer
@@ -328,3 +328,29 @@ def unpackPacket(buffer, maximumPacketSize=MAX_PACKET_SIZE):
   else:
     packet = None
   return packet
+
+def packetLength(buffer, start=0, end=None):
+  "the length of the packet at start in the buffer, or None if its length field is incomplete"
+  if end == None:
+    end = len(buffer)
+  if end - start < 1 or (buffer[start] == 1 and end - start < 3):
+    return None
+  length, lenlen = MessageLens.decode(buffer[start:start + 3])
+  if length < lenlen + 1: # too short to hold the length and the message type
+    raise MQTTSNException("Message length %d too short" % length)
+  return length
+
+def unpackPackets(buffer, maximumPacketSize=MAX_PACKET_SIZE):
+  """Generate the packets unpacked from a buffer holding any number of complete packets,
+  and perhaps the start of one more.  The generator returns the number of bytes used,
+  so that the rest can be kept until more data arrives:
+
+    consumed = yield from unpackPackets(buffer)
+  """
+  start = 0
+  length = packetLength(buffer, start)
+  while length != None and start + length <= len(buffer):
+    yield unpackPacket(bytes(buffer[start:start + length]), maximumPacketSize)
+    start += length
+    length = packetLength(buffer, start)
+  return start
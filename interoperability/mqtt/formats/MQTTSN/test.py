@@ -22,6 +22,23 @@ class Test(unittest.TestCase):
         #print("out", str(outpacket))
         assert inpacket == outpacket
 
+    def testUnpackPackets(self):
+      publish = MQTTSN.Publishes()
+      publish.Data = b"x" * 100
+      packets = [MQTTSN.Connects(), publish, MQTTSN.Connacks()]
+      stream = b"".join(packet.pack() for packet in packets)
+      generator = MQTTSN.unpackPackets(stream + publish.pack()[:2])
+      unpacked = []
+      try:
+        while True:
+          unpacked.append(next(generator))
+      except StopIteration as stop:
+        self.assertEqual(stop.value, len(stream))
+      self.assertEqual(unpacked, packets)
+      self.assertEqual(list(MQTTSN.unpackPackets(b"\x01\x01")), []) # a three byte length, incomplete
+      with self.assertRaises(MQTTSN.MQTTSNException):
+        list(MQTTSN.unpackPackets(b"\x00"))
+
 
 
 if __name__ == "__main__":
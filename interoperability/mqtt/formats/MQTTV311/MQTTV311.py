@@ -24,9 +24,12 @@ so that the tests that use this package can send invalid data for error testing.
 
 """
 
-import logging
+import logging, re, struct
+
+from mqtt.formats import PacketFramers as PacketFraming
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 # Low-level protocol interface
 
@@ -60,6 +63,9 @@ def MessageType(byte):
 
 def getPacket(aSocket):
   "receive the next packet"
+  if hasattr(aSocket, "getPacket"):
+    # a buffered socket, which frames the packets itself
+    return aSocket.getPacket()
   buf = aSocket.recv(1) # get the first byte fixed header
   if len(buf) == 0:
     return None
@@ -83,7 +89,7 @@ def getPacket(aSocket):
       break
     multiplier *= 128
   # receive the remaining length if there is any
-  rest = bytes([])
+  rest = bytearray()
   if remlength > 0:
     while len(rest) < remlength:
       before = len(rest)
@@ -95,7 +101,40 @@ def getPacket(aSocket):
   return buf + rest
 
 
-class FixedHeaders:
+def packetLength(buffer, start=0, end=None):
+  "the length of the packet at start in the buffer, or None if its fixed header is incomplete"
+  return PacketFraming.packetLength(buffer, start, end, MQTTException)
+
+
+class PacketFramers(PacketFraming.PacketFramers):
+  "splits a stream of data into MQTT 3.1.1 packets, as PacketFraming.PacketFramers"
+  exception = MQTTException
+
+
+class SlottedObjects(object):
+  """objects whose attributes are fixed by __slots__, so that they have no __dict__.
+
+  They are pickled as a dictionary of the attributes which are set, as they were before.
+  """
+
+  __slots__ = ()
+
+  def __getstate__(self):
+    state = {}
+    for aClass in type(self).__mro__:
+      for name in aClass.__dict__.get("__slots__", ()):
+        if hasattr(self, name):
+          state[name] = getattr(self, name)
+    return state
+
+  def __setstate__(self, state):
+    for name, value in state.items():
+      setattr(self, name, value)
+
+
+class FixedHeaders(SlottedObjects):
+
+  __slots__ = ["MessageType", "DUP", "QoS", "RETAIN", "remainingLength"]
 
   def __init__(self, aMessageType):
     self.MessageType = aMessageType
@@ -118,11 +157,17 @@ class FixedHeaders:
 
   def pack(self, length):
     "pack data into string buffer ready for transmission down socket"
-    buffer = bytes([(self.MessageType << 4) | (self.DUP << 3) |\
-                         (self.QoS << 1) | self.RETAIN])
     self.remainingLength = length
-    buffer += self.encode(length)
-    return buffer
+    if length < 128:
+      return headers.pack(self.firstByte(), length)
+    return bytes([self.firstByte()]) + self.encode(length)
+
+  def packWith(self, parts):
+    "the fixed header followed by the parts of the packet, which are copied once"
+    return b"".join([self.pack(sum(map(len, parts)))] + parts)
+
+  def firstByte(self):
+    return (self.MessageType << 4) | (self.DUP << 3) | (self.QoS << 1) | self.RETAIN
 
   def encode(self, x):
     assert 0 <= x <= 268435455
@@ -162,15 +207,31 @@ class FixedHeaders:
     return (value, bytes)
 
 
+# The fixed parts of packets are packed with these, and joined with the variable
+# parts once their lengths are known, rather than concatenated piece by piece
+headers = struct.Struct("!BB") # a fixed header with a remaining length of less than 128
+idHeaders = struct.Struct("!BBH") # the fixed header of a packet which is just a message identifier
+int16s = struct.Struct("!H")
+connectHeaders = struct.Struct("!BBH") # protocol version, connect flags and keep alive timer
+
 def writeInt16(length):
-  return bytes([length // 256, length % 256])
+  return int16s.pack(length)
 
 def readInt16(buf):
   return buf[0]*256 + buf[1]
 
 def writeUTF(data):
   # data could be a string, or bytes.  If string, encode into bytes with utf-8
-  return writeInt16(len(data)) + (data if type(data) == type(b"") else bytes(data, "utf-8"))
+  if type(data) != type(b""):
+    data = bytes(data, "utf-8")
+  return writeInt16(len(data)) + data
+
+# null, and the code points which must not be encoded in UTF-8 strings
+invalidUTF = re.compile("[\x00\uD800-\uDFFE]")
+
+utfCache = {} # validated strings, such as repeated topic names, by their encoding
+UTF_CACHE_ENTRIES = 1024
+UTF_CACHE_LENGTH = 256 # longest encoding to cache
 
 def readUTF(buffer, maxlen):
   if maxlen >= 2:
@@ -180,17 +241,33 @@ def readUTF(buffer, maxlen):
   maxlen -= 2
   if length > maxlen:
     raise MQTTException("Length delimited string too long")
-  buf = buffer[2:2+length].decode("utf-8")
-  logger.info("[MQTT-4.7.3-2] topic names and filters not include null")
-  zz = buf.find("\x00") # look for null in the UTF string
-  if zz != -1:
-    raise MQTTException("[MQTT-1.5.3-2] Null found in UTF data "+buf)
-  for c in range (0xD800, 0xDFFF):
-    zz = buf.find(chr(c)) # look for D800-DFFF in the UTF string
-    if zz != -1:
+  data = bytes(buffer[2:2+length])
+  buf = utfCache.get(data)
+  if buf == None:
+    buf = decodeUTF(data)
+  else:
+    statements.info("[MQTT-4.7.3-2] topic names and filters not include null")
+  return buf
+
+def decodeUTF(data):
+  "decode a UTF-8 string and check it in one pass, or none at all if it is ASCII with no null"
+  buf = data.decode("utf-8")
+  statements.info("[MQTT-4.7.3-2] topic names and filters not include null")
+  if len(buf) == len(data): # one byte for each character, so ASCII
+    if "\x00" in buf:
+      raise MQTTException("[MQTT-1.5.3-2] Null found in UTF data "+buf)
+  else:
+    if invalidUTF.search(buf):
+      if "\x00" in buf:
+        raise MQTTException("[MQTT-1.5.3-2] Null found in UTF data "+buf)
       raise MQTTException("[MQTT-1.5.3-1] D800-DFFF found in UTF data "+buf)
-  if buf.find("\uFEFF") != -1:
-    logger.info("[MQTT-1.5.3-3] U+FEFF in UTF string")
+    if "\uFEFF" in buf:
+      statements.info("[MQTT-1.5.3-3] U+FEFF in UTF string")
+      return buf # not cached, so that this is logged each time
+  if len(data) <= UTF_CACHE_LENGTH:
+    if len(utfCache) >= UTF_CACHE_ENTRIES:
+      utfCache.clear()
+    utfCache[data] = buf
   return buf
 
 def writeBytes(buffer):
@@ -201,7 +278,9 @@ def readBytes(buffer):
   return buffer[2:2+length]
 
 
-class Packets:
+class Packets(SlottedObjects):
+
+  __slots__ = ["fh"]
 
   def pack(self):
     buffer = self.fh.pack(0)
@@ -216,6 +295,10 @@ class Packets:
 
 class Connects(Packets):
 
+  __slots__ = ["ProtocolName", "ProtocolVersion", "CleanSession", "WillFlag", "WillQoS",
+    "WillRETAIN", "KeepAliveTimer", "usernameFlag", "passwordFlag", "ClientIdentifier",
+    "WillTopic", "WillMessage", "username", "password"]
+
   def __init__(self, buffer = None):
     self.fh = FixedHeaders(CONNECT)
 
@@ -241,21 +324,19 @@ class Connects(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    connectFlags = bytes([(self.CleanSession << 1) | (self.WillFlag << 2) | \
-                       (self.WillQoS << 3) | (self.WillRETAIN << 5) | \
-                       (self.usernameFlag << 6) | (self.passwordFlag << 7)])
-    buffer = writeUTF(self.ProtocolName) + bytes([self.ProtocolVersion]) + \
-              connectFlags + writeInt16(self.KeepAliveTimer)
-    buffer += writeUTF(self.ClientIdentifier)
+    connectFlags = (self.CleanSession << 1) | (self.WillFlag << 2) | \
+                   (self.WillQoS << 3) | (self.WillRETAIN << 5) | \
+                   (self.usernameFlag << 6) | (self.passwordFlag << 7)
+    parts = [writeUTF(self.ProtocolName),
+             connectHeaders.pack(self.ProtocolVersion, connectFlags, self.KeepAliveTimer),
+             writeUTF(self.ClientIdentifier)]
     if self.WillFlag:
-      buffer += writeUTF(self.WillTopic)
-      buffer += writeBytes(self.WillMessage)
+      parts += [writeUTF(self.WillTopic), writeBytes(self.WillMessage)]
     if self.usernameFlag:
-      buffer += writeUTF(self.username)
+      parts.append(writeUTF(self.username))
     if self.passwordFlag:
-      buffer += writeBytes(self.password)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+      parts.append(writeBytes(self.password))
+    return self.fh.packWith(parts)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -295,8 +376,8 @@ class Connects(Packets):
 
       self.KeepAliveTimer = readInt16(buffer[curlen:])
       curlen += 2
-      logger.info("[MQTT-3.1.3-3] Clientid must be present, and first field")
-      logger.info("[MQTT-3.1.3-4] Clientid must be Unicode, and between 0 and 65535 bytes long")
+      statements.info("[MQTT-3.1.3-3] Clientid must be present, and first field")
+      statements.info("[MQTT-3.1.3-4] Clientid must be Unicode, and between 0 and 65535 bytes long")
       self.ClientIdentifier = readUTF(buffer[curlen:], packlen - curlen)
       curlen += len(self.ClientIdentifier) + 2
 
@@ -305,7 +386,7 @@ class Connects(Packets):
         curlen += len(self.WillTopic) + 2
         self.WillMessage = readBytes(buffer[curlen:])
         curlen += len(self.WillMessage) + 2
-        logger.info("[MQTT-3.1.2-9] will topic and will message fields must be present")
+        statements.info("[MQTT-3.1.2-9] will topic and will message fields must be present")
       else:
         self.WillTopic = self.WillMessage = None
 
@@ -313,21 +394,21 @@ class Connects(Packets):
         assert len(buffer) > curlen+2, "Buffer too short to read username length"
         self.username = readUTF(buffer[curlen:], packlen - curlen)
         curlen += len(self.username) + 2
-        logger.info("[MQTT-3.1.2-19] username must be in payload if user name flag is 1")
+        statements.info("[MQTT-3.1.2-19] username must be in payload if user name flag is 1")
       else:
-        logger.info("[MQTT-3.1.2-18] username must not be in payload if user name flag is 0")
+        statements.info("[MQTT-3.1.2-18] username must not be in payload if user name flag is 0")
         assert self.passwordFlag == False, "[MQTT-3.1.2-22] password flag must be 0 if username flag is 0"
 
       if self.passwordFlag:
         assert len(buffer) > curlen+2, "Buffer too short to read password length"
         self.password = readBytes(buffer[curlen:])
         curlen += len(self.password) + 2
-        logger.info("[MQTT-3.1.2-21] password must be in payload if password flag is 0")
+        statements.info("[MQTT-3.1.2-21] password must be in payload if password flag is 0")
       else:
-        logger.info("[MQTT-3.1.2-20] password must not be in payload if password flag is 0")
+        statements.info("[MQTT-3.1.2-20] password must not be in payload if password flag is 0")
 
       if self.WillFlag and self.usernameFlag and self.passwordFlag:
-        logger.info("[MQTT-3.1.3-1] clientid, will topic, will message, username and password all present")
+        statements.info("[MQTT-3.1.3-1] clientid, will topic, will message, username and password all present")
 
       assert curlen == packlen, "Packet is wrong length curlen %d != packlen %d"
     except:
@@ -372,20 +453,20 @@ class Connects(Packets):
 
 class Connacks(Packets):
 
+  __slots__ = ["flags", "returnCode"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, ReturnCode=0):
     self.fh = FixedHeaders(CONNACK)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     self.flags = 0
     self.returnCode = ReturnCode
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = bytes([self.flags, self.returnCode])
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    return self.fh.pack(2) + bytes([self.flags, self.returnCode])
 
   def unpack(self, buffer):
     assert len(buffer) >= 4
@@ -409,11 +490,13 @@ class Connacks(Packets):
 
 class Disconnects(Packets):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False):
     self.fh = FixedHeaders(DISCONNECT)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     if buffer != None:
       self.unpack(buffer)
 
@@ -422,7 +505,7 @@ class Disconnects(Packets):
     assert MessageType(buffer) == DISCONNECT
     self.fh.unpack(buffer)
     assert self.fh.remainingLength == 0, "Disconnect packet is wrong length %d" % self.fh.remainingLength
-    logger.info("[MQTT-3.14.1-1] disconnect reserved bits must be 0")
+    statements.info("[MQTT-3.14.1-1] disconnect reserved bits must be 0")
     assert self.fh.DUP == False, "[MQTT-2.1.2-1]"
     assert self.fh.QoS == 0, "[MQTT-2.1.2-1]"
     assert self.fh.RETAIN == False, "[MQTT-2.1.2-1]"
@@ -433,11 +516,14 @@ class Disconnects(Packets):
 
 class Publishes(Packets):
 
+  __slots__ = ["topicName", "messageIdentifier", "data", "qos2state", "receivedTime",
+    "pubrec_received"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, MsgId=0, TopicName="", Payload=b""):
     self.fh = FixedHeaders(PUBLISH)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.topicName = TopicName
     self.messageIdentifier = MsgId
@@ -447,12 +533,9 @@ class Publishes(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeUTF(self.topicName)
     if self.fh.QoS != 0:
-      buffer +=  writeInt16(self.messageIdentifier)
-    buffer += self.data
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+      return self.fh.packWith([writeUTF(self.topicName), int16s.pack(self.messageIdentifier), self.data])
+    return self.fh.packWith([writeUTF(self.topicName), self.data])
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -465,16 +548,16 @@ class Publishes(Packets):
     try:
       self.topicName = readUTF(buffer[fhlen:], packlen - curlen)
     except UnicodeDecodeError:
-      logger.info("[MQTT-3.3.2-1] topic name in publish must be utf-8")
+      statements.info("[MQTT-3.3.2-1] topic name in publish must be utf-8")
       raise
     curlen += len(self.topicName) + 2
     if self.fh.QoS != 0:
       self.messageIdentifier = readInt16(buffer[curlen:])
-      logger.info("[MQTT-2.3.1-1] packet indentifier must be in publish if QoS is 1 or 2")
+      statements.info("[MQTT-2.3.1-1] packet indentifier must be in publish if QoS is 1 or 2")
       curlen += 2
       assert self.messageIdentifier > 0, "[MQTT-2.3.1-1] packet indentifier must be > 0"
     else:
-      logger.info("[MQTT-2.3.1-5] no packet indentifier in publish if QoS is 0")
+      statements.info("[MQTT-2.3.1-5] no packet indentifier in publish if QoS is 0")
       self.messageIdentifier = 0
     self.data = buffer[curlen:fhlen + self.fh.remainingLength]
     if self.fh.QoS == 0:
@@ -499,20 +582,21 @@ class Publishes(Packets):
 
 class Pubacks(Packets):
 
+  __slots__ = ["messageIdentifier"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, MsgId=0):
     self.fh = FixedHeaders(PUBACK)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    self.fh.remainingLength = 2
+    return idHeaders.pack(self.fh.firstByte(), 2, self.messageIdentifier)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -536,20 +620,21 @@ class Pubacks(Packets):
 
 class Pubrecs(Packets):
 
+  __slots__ = ["messageIdentifier"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, MsgId=0):
     self.fh = FixedHeaders(PUBREC)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    self.fh.remainingLength = 2
+    return idHeaders.pack(self.fh.firstByte(), 2, self.messageIdentifier)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -573,20 +658,21 @@ class Pubrecs(Packets):
 
 class Pubrels(Packets):
 
+  __slots__ = ["messageIdentifier"]
+
   def __init__(self, buffer=None, DUP=False, QoS=1, Retain=False, MsgId=0):
     self.fh = FixedHeaders(PUBREL)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    self.fh.remainingLength = 2
+    return idHeaders.pack(self.fh.firstByte(), 2, self.messageIdentifier)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -598,7 +684,7 @@ class Pubrels(Packets):
     assert self.fh.DUP == False, "[MQTT-2.1.2-1] DUP should be False in PUBREL"
     assert self.fh.QoS == 1, "[MQTT-2.1.2-1] QoS should be 1 in PUBREL"
     assert self.fh.RETAIN == False, "[MQTT-2.1.2-1] RETAIN should be False in PUBREL"
-    logger.info("[MQTT-3.6.1-1] bits in fixed header for pubrel are ok")
+    statements.info("[MQTT-3.6.1-1] bits in fixed header for pubrel are ok")
     return fhlen + 2
 
   def __repr__(self):
@@ -611,20 +697,21 @@ class Pubrels(Packets):
 
 class Pubcomps(Packets):
 
+  __slots__ = ["messageIdentifier"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, MsgId=0):
     self.fh = FixedHeaders(PUBCOMP)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    self.fh.remainingLength = 2
+    return idHeaders.pack(self.fh.firstByte(), 2, self.messageIdentifier)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -648,11 +735,13 @@ class Pubcomps(Packets):
 
 class Subscribes(Packets):
 
+  __slots__ = ["messageIdentifier", "data"]
+
   def __init__(self, buffer=None, DUP=False, QoS=1, Retain=False, MsgId=0, Data=[]):
     self.fh = FixedHeaders(SUBSCRIBE)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     # payload - list of topic, qos pairs
@@ -661,18 +750,17 @@ class Subscribes(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
+    parts = [int16s.pack(self.messageIdentifier)]
     for d in self.data:
-      buffer += writeUTF(d[0]) + bytes([d[1]])
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+      parts += [writeUTF(d[0]), bytes([d[1]])]
+    return self.fh.packWith(parts)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
     assert MessageType(buffer) == SUBSCRIBE
     fhlen = self.fh.unpack(buffer)
     assert len(buffer) >= fhlen + self.fh.remainingLength
-    logger.info("[MQTT-2.3.1-1] packet indentifier must be in subscribe")
+    statements.info("[MQTT-2.3.1-1] packet indentifier must be in subscribe")
     self.messageIdentifier = readInt16(buffer[fhlen:])
     assert self.messageIdentifier > 0, "[MQTT-2.3.1-1] packet indentifier must be > 0"
     leftlen = self.fh.remainingLength - 2
@@ -703,11 +791,13 @@ class Subscribes(Packets):
 
 class Subacks(Packets):
 
+  __slots__ = ["messageIdentifier", "data"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, MsgId=0, Data=[]):
     self.fh = FixedHeaders(SUBACK)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     # payload - list of qos
@@ -716,11 +806,7 @@ class Subacks(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    for d in self.data:
-      buffer += bytes([d])
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    return self.fh.packWith([int16s.pack(self.messageIdentifier), bytes(self.data)])
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -753,11 +839,13 @@ class Subacks(Packets):
 
 class Unsubscribes(Packets):
 
+  __slots__ = ["messageIdentifier", "data"]
+
   def __init__(self, buffer=None, DUP=False, QoS=1, Retain=False, MsgId=0, Data=[]):
     self.fh = FixedHeaders(UNSUBSCRIBE)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     # payload - list of topics
@@ -766,18 +854,14 @@ class Unsubscribes(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    for d in self.data:
-      buffer += writeUTF(d)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    return self.fh.packWith([int16s.pack(self.messageIdentifier)] + [writeUTF(d) for d in self.data])
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
     assert MessageType(buffer) == UNSUBSCRIBE
     fhlen = self.fh.unpack(buffer)
     assert len(buffer) >= fhlen + self.fh.remainingLength
-    logger.info("[MQTT-2.3.1-1] packet indentifier must be in unsubscribe")
+    statements.info("[MQTT-2.3.1-1] packet indentifier must be in unsubscribe")
     self.messageIdentifier = readInt16(buffer[fhlen:])
     assert self.messageIdentifier > 0, "[MQTT-2.3.1-1] packet indentifier must be > 0"
     leftlen = self.fh.remainingLength - 2
@@ -790,7 +874,7 @@ class Unsubscribes(Packets):
     assert self.fh.DUP == False, "[MQTT-2.1.2-1]"
     assert self.fh.QoS == 1, "[MQTT-2.1.2-1]"
     assert self.fh.RETAIN == False, "[MQTT-2.1.2-1]"
-    logger.info("[MQTT-3-10.1-1] fixed header bits are 0,0,1,0")
+    statements.info("[MQTT-3-10.1-1] fixed header bits are 0,0,1,0")
     return fhlen + self.fh.remainingLength
 
   def __repr__(self):
@@ -805,20 +889,21 @@ class Unsubscribes(Packets):
 
 class Unsubacks(Packets):
 
+  __slots__ = ["messageIdentifier"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False, MsgId=0):
     self.fh = FixedHeaders(UNSUBACK)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     # variable header
     self.messageIdentifier = MsgId
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.messageIdentifier)
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    self.fh.remainingLength = 2
+    return idHeaders.pack(self.fh.firstByte(), 2, self.messageIdentifier)
 
   def unpack(self, buffer):
     assert len(buffer) >= 2
@@ -843,11 +928,13 @@ class Unsubacks(Packets):
 
 class Pingreqs(Packets):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False):
     self.fh = FixedHeaders(PINGREQ)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     if buffer != None:
       self.unpack(buffer)
 
@@ -867,11 +954,13 @@ class Pingreqs(Packets):
 
 class Pingresps(Packets):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, Retain=False):
     self.fh = FixedHeaders(PINGRESP)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
-    self.fh.Retain = Retain
+    self.fh.RETAIN = Retain
     if buffer != None:
       self.unpack(buffer)
 
@@ -900,6 +989,21 @@ def unpackPacket(buffer):
     packet = None
   return packet
 
+def unpackPackets(buffer):
+  """Generate the packets unpacked from a buffer holding any number of complete packets,
+  and perhaps the start of one more.  The generator returns the number of bytes used,
+  so that the rest can be kept until more data arrives:
+
+    consumed = yield from unpackPackets(buffer)
+  """
+  start = 0
+  length = packetLength(buffer, start)
+  while length != None and start + length <= len(buffer):
+    yield unpackPacket(bytes(buffer[start:start + length]))
+    start += length
+    length = packetLength(buffer, start)
+  return start
+
 if __name__ == "__main__":
   fh = FixedHeaders(CONNECT)
   tests = [0, 56, 127, 128, 8888, 16383, 16384, 65535, 2097151, 2097152,
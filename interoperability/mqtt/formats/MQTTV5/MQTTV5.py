@@ -24,9 +24,12 @@ so that the tests that use this package can send invalid data for error testing.
 
 """
 
-import logging, struct
+import logging, struct, re
+
+from mqtt.formats import PacketFramers as PacketFraming
 
 logger = logging.getLogger('MQTT broker')
+statements = logger.getChild('statements')
 
 # Low-level protocol interface
 
@@ -58,7 +61,32 @@ class PacketTypes:
   WILLMESSAGE = 99
 
 
-class Packets(object):
+class SlottedObjects(object):
+  """objects whose attributes are fixed by __slots__, so that they have no __dict__, and
+  assigning to any other attribute fails as it is stored rather than being checked first.
+
+  They are pickled as a dictionary of the attributes which are set, as they were before.
+  """
+
+  __slots__ = ()
+
+  def __getstate__(self):
+    state = {}
+    for aClass in type(self).__mro__:
+      for name in aClass.__dict__.get("__slots__", ()):
+        if hasattr(self, name):
+          state[name] = getattr(self, name)
+    return state
+
+  def __setstate__(self, state):
+    for name, value in state.items():
+      if name != "names": # the attribute names, once kept on each instance
+        setattr(self, name, value)
+
+
+class Packets(SlottedObjects):
+
+  __slots__ = ["fh"]
 
   Names = [ "reserved", \
     "Connect", "Connack", "Publish", "Puback", "Pubrec", "Pubrel", \
@@ -78,11 +106,6 @@ class Packets(object):
   def __eq__(self, packet):
     return self.fh == packet.fh if packet else False
 
-  def __setattr__(self, name, value):
-    if name not in self.names:
-      raise MQTTException(name + " Attribute name must be one of "+str(self.names))
-    object.__setattr__(self, name, value)
-
 
 def PacketType(byte):
   """
@@ -259,18 +282,22 @@ class VBIs:  # Variable Byte Integer
     value = 0
     bytes = 0
     while 1:
+      digit = buffer[bytes]
       bytes += 1
-      digit = buffer[0]
-      buffer = buffer[1:]
       value += (digit & 127) * multiplier
       if digit & 128 == 0:
         break
       multiplier *= 128
-    assert len(VBIs.encode(value)) == bytes, "[MQTT5-1.5.5-1] The encoded value MUST use the minimum number of bytes necessary"
+    assert value <= 268435455
+    # a longer encoding than necessary ends with a zero digit
+    assert bytes == 1 or digit != 0, "[MQTT5-1.5.5-1] The encoded value MUST use the minimum number of bytes necessary"
     return (value, bytes)
 
 def getPacket(aSocket):
   "receive the next packet"
+  if hasattr(aSocket, "getPacket"):
+    # a buffered socket, which frames the packets itself
+    return aSocket.getPacket()
   aSocket.settimeout(.3)
   buf = aSocket.recv(1) # get the first byte fixed header
   if len(buf) == 0:
@@ -295,7 +322,7 @@ def getPacket(aSocket):
       break
     multiplier *= 128
   # receive the remaining length if there is any
-  rest = bytes([])
+  rest = bytearray()
   if remlength > 0:
     while len(rest) < remlength:
       before = len(rest)
@@ -307,7 +334,19 @@ def getPacket(aSocket):
   return buf + rest
 
 
-class FixedHeaders(object):
+def packetLength(buffer, start=0, end=None):
+  "the length of the packet at start in the buffer, or None if its fixed header is incomplete"
+  return PacketFraming.packetLength(buffer, start, end, MalformedPacket)
+
+
+class PacketFramers(PacketFraming.PacketFramers):
+  "splits a stream of data into MQTT V5 packets, as PacketFraming.PacketFramers"
+  exception = MalformedPacket
+
+
+class FixedHeaders(SlottedObjects):
+
+  __slots__ = ["PacketType", "DUP", "QoS", "RETAIN", "remainingLength"]
 
   def __init__(self, aPacketType):
     self.PacketType = aPacketType
@@ -323,12 +362,6 @@ class FixedHeaders(object):
            self.RETAIN == fh.RETAIN # and \
            # self.remainingLength == fh.remainingLength
 
-  def __setattr__(self, name, value):
-    names = ["PacketType", "DUP", "QoS", "RETAIN", "remainingLength"]
-    if name not in names:
-      raise MQTTException(name + " Attribute name must be one of "+str(names))
-    object.__setattr__(self, name, value)
-
   def __str__(self):
     "return printable representation of our data"
     return Packets.classNames[self.PacketType]+'(fh.DUP='+str(self.DUP)+ \
@@ -382,7 +415,16 @@ def readInt32(buf):
 
 def writeUTF(data):
   # data could be a string, or bytes.  If string, encode into bytes with utf-8
-  return writeInt16(len(data)) + (data if type(data) == type(b"") else bytes(data, "utf-8"))
+  if type(data) != type(b""):
+    data = bytes(data, "utf-8")
+  return writeInt16(len(data)) + data
+
+# null, and the code points which must not be encoded in UTF-8 strings
+invalidUTF = re.compile("[\x00\uD800-\uDFFE]")
+
+utfCache = {} # validated strings, such as repeated topic names, by their encoding
+UTF_CACHE_ENTRIES = 1024
+UTF_CACHE_LENGTH = 256 # longest encoding to cache
 
 def readUTF(buffer, maxlen):
   if maxlen >= 2:
@@ -392,282 +434,388 @@ def readUTF(buffer, maxlen):
   maxlen -= 2
   if length > maxlen:
     raise MalformedPacket("Length delimited string too long")
-  buf = buffer[2:2+length].decode("utf-8")
-  logger.info("[MQTT5-4.7.3-2] topic names and filters must not include null")
-  zz = buf.find("\x00") # look for null in the UTF string
-  if zz != -1:
-    raise MalformedPacket("[MQTT5-1.5.4-2] Null found in UTF data "+buf)
-  for c in range (0xD800, 0xDFFF):
-    zz = buf.find(chr(c)) # look for D800-DFFF in the UTF string
-    if zz != -1:
-      raise MalformedPacket("[MQTT5-1.5.4-1] D800-DFFF found in UTF data "+buf)
-  if buf.find("\uFEFF") != -1:
-    logger.info("[MQTT5-1.5.4-3] U+FEFF in UTF string")
+  data = bytes(buffer[2:2+length])
+  buf = utfCache.get(data)
+  if buf == None:
+    buf = decodeUTF(data)
+  else:
+    statements.info("[MQTT5-4.7.3-2] topic names and filters must not include null")
   return buf, length+2
 
+def decodeUTF(data):
+  "decode a UTF-8 string and check it in one pass, or none at all if it is ASCII with no null"
+  buf = data.decode("utf-8")
+  statements.info("[MQTT5-4.7.3-2] topic names and filters must not include null")
+  if len(buf) == len(data): # one byte for each character, so ASCII
+    if "\x00" in buf:
+      raise MalformedPacket("[MQTT5-1.5.4-2] Null found in UTF data "+buf)
+  else:
+    if invalidUTF.search(buf):
+      if "\x00" in buf:
+        raise MalformedPacket("[MQTT5-1.5.4-2] Null found in UTF data "+buf)
+      raise MalformedPacket("[MQTT5-1.5.4-1] D800-DFFF found in UTF data "+buf)
+    if "\uFEFF" in buf:
+      statements.info("[MQTT5-1.5.4-3] U+FEFF in UTF string")
+      return buf # not cached, so that this is logged each time
+  if len(data) <= UTF_CACHE_LENGTH:
+    if len(utfCache) >= UTF_CACHE_ENTRIES:
+      utfCache.clear()
+    utfCache[data] = buf
+  return buf
+
 def writeBytes(buffer):
   return writeInt16(len(buffer)) + buffer
 
 def readBytes(buffer):
   length = readInt16(buffer)
-  return buffer[2:2+length], length+2
+  return bytes(buffer[2:2+length]), length+2
+
+
+propertyTypes = ["Byte", "Two Byte Integer", "Four Byte Integer", "Variable Byte Integer",
+   "Binary Data", "UTF-8 Encoded String", "UTF-8 String Pair"]
+
+propertyNames = {
+  "Payload Format Indicator" : 1,
+  "Message Expiry Interval" : 2,
+  "Content Type" : 3,
+  "Response Topic" : 8,
+  "Correlation Data" : 9,
+  "Subscription Identifier" : 11,
+  "Session Expiry Interval" : 17,
+  "Assigned Client Identifier" : 18,
+  "Server Keep Alive" : 19,
+  "Authentication Method" : 21,
+  "Authentication Data" : 22,
+  "Request Problem Information" : 23,
+  "Will Delay Interval" : 24,
+  "Request Response Information" : 25,
+  "Response Information" : 26,
+  "Server Reference" : 28,
+  "Reason String" : 31,
+  "Receive Maximum" : 33,
+  "Topic Alias Maximum" : 34,
+  "Topic Alias" : 35,
+  "Maximum QoS" : 36,
+  "Retain Available" : 37,
+  "User Property" : 38,
+  "Maximum Packet Size" : 39,
+  "Wildcard Subscription Available" : 40,
+  "Subscription Identifier Available" : 41,
+  "Shared Subscription Available" : 42
+}
+
+propertyDefinitions = {
+  # id:  type, packets
+  1  : (propertyTypes.index("Byte"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]), # payload format indicator
+  2  : (propertyTypes.index("Four Byte Integer"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
+  3  : (propertyTypes.index("UTF-8 Encoded String"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
+  8  : (propertyTypes.index("UTF-8 Encoded String"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
+  9  : (propertyTypes.index("Binary Data"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
+  11 : (propertyTypes.index("Variable Byte Integer"),
+       [PacketTypes.PUBLISH, PacketTypes.SUBSCRIBE]),
+  17 : (propertyTypes.index("Four Byte Integer"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK, PacketTypes.DISCONNECT]),
+  18 : (propertyTypes.index("UTF-8 Encoded String"), [PacketTypes.CONNACK]),
+  19 : (propertyTypes.index("Two Byte Integer"), [PacketTypes.CONNACK]),
+  21 : (propertyTypes.index("UTF-8 Encoded String"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK, PacketTypes.AUTH]),
+  22 : (propertyTypes.index("Binary Data"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK, PacketTypes.AUTH]),
+  23 : (propertyTypes.index("Byte"),
+       [PacketTypes.CONNECT]),
+  24 : (propertyTypes.index("Four Byte Integer"), [PacketTypes.WILLMESSAGE]),
+  25 : (propertyTypes.index("Byte"), [PacketTypes.CONNECT]),
+  26 : (propertyTypes.index("UTF-8 Encoded String"), [PacketTypes.CONNACK]),
+  28 : (propertyTypes.index("UTF-8 Encoded String"),
+       [PacketTypes.CONNACK, PacketTypes.DISCONNECT]),
+  31 : (propertyTypes.index("UTF-8 Encoded String"),
+       [PacketTypes.CONNACK, PacketTypes.PUBACK, PacketTypes.PUBREC,
+        PacketTypes.PUBREL, PacketTypes.PUBCOMP, PacketTypes.SUBACK,
+        PacketTypes.UNSUBACK, PacketTypes.DISCONNECT, PacketTypes.AUTH]),
+  33 : (propertyTypes.index("Two Byte Integer"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK]),
+  34 : (propertyTypes.index("Two Byte Integer"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK]),
+  35 : (propertyTypes.index("Two Byte Integer"), [PacketTypes.PUBLISH]),
+  36 : (propertyTypes.index("Byte"), [PacketTypes.CONNACK]),
+  37 : (propertyTypes.index("Byte"), [PacketTypes.CONNACK]),
+  38 : (propertyTypes.index("UTF-8 String Pair"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK,
+       PacketTypes.PUBLISH, PacketTypes.PUBACK,
+       PacketTypes.PUBREC, PacketTypes.PUBREL, PacketTypes.PUBCOMP,
+       PacketTypes.SUBSCRIBE, PacketTypes.SUBACK,
+       PacketTypes.UNSUBSCRIBE, PacketTypes.UNSUBACK,
+       PacketTypes.DISCONNECT, PacketTypes.AUTH, PacketTypes.WILLMESSAGE]),
+  39 : (propertyTypes.index("Four Byte Integer"),
+       [PacketTypes.CONNECT, PacketTypes.CONNACK]),
+  40 : (propertyTypes.index("Byte"), [PacketTypes.CONNACK]),
+  41 : (propertyTypes.index("Byte"), [PacketTypes.CONNACK]),
+  42 : (propertyTypes.index("Byte"), [PacketTypes.CONNACK]),
+}
+
+# lookup tables built from those above
+propertyIdents = {} # compressed name: identifier
+propertyCompressedNames = {} # identifier: compressed name
+propertyNamesByIdent = {} # identifier: name
+for name, identifier in propertyNames.items():
+  propertyIdents[name.replace(' ', '')] = identifier
+  propertyCompressedNames[identifier] = name.replace(' ', '')
+  propertyNamesByIdent[identifier] = name
+propertyIdentifiers = {identifier: VBIs.encode(identifier) for identifier in propertyDefinitions}
+multipleProperties = {11, 38} # Subscription Identifier and User Property
+
+def readUTFPair(buffer, propslen):
+  statements.info("[MQTT5-1.5.7-1] Both string pair strings must be properly formed")
+  value, valuelen = readUTF(buffer, propslen)
+  value1, valuelen1 = readUTF(buffer[valuelen:], propslen - valuelen)
+  return (value, value1), valuelen + valuelen1
+
+# functions to write and read a property value, by type
+propertyWriters = [lambda value: bytes([value]), writeInt16, writeInt32, VBIs.encode,
+   writeBytes, writeUTF, lambda value: writeUTF(value[0]) + writeUTF(value[1])]
+propertyReaders = [lambda buffer, propslen: (buffer[0], 1),
+   lambda buffer, propslen: (readInt16(buffer), 2),
+   lambda buffer, propslen: (readInt32(buffer), 4),
+   lambda buffer, propslen: VBIs.decode(buffer),
+   lambda buffer, propslen: readBytes(buffer),
+   readUTF, readUTFPair]
+
+# the string and string pair properties, whose readers log conformance statements
+stringProperties = {identifier for identifier, definition in propertyDefinitions.items()
+                    if propertyTypes[definition[0]].startswith("UTF-8")}
+
+def logStrings(values):
+  "log what reading the string properties among values would, for those decoded before"
+  for identifier, value in values.items():
+    if identifier in stringProperties:
+      if identifier in multipleProperties: # user properties, which are string pairs
+        strings = []
+        for pair in value:
+          statements.info("[MQTT5-1.5.7-1] Both string pair strings must be properly formed")
+          strings += pair
+      else:
+        strings = [value]
+      for string in strings:
+        statements.info("[MQTT5-4.7.3-2] topic names and filters must not include null")
+        if "\uFEFF" in string:
+          statements.info("[MQTT5-1.5.4-3] U+FEFF in UTF string")
+
+# the properties decoded from encodings seen before, such as those of a stream of publishes
+propertiesCache = {}
+PROPERTIES_CACHE_ENTRIES = 1024
+PROPERTIES_CACHE_LENGTH = 256 # longest encoding to cache
 
 
 class Properties(object):
+  """the properties of one packet, as attributes named like ContentType.
 
-  def __init__(self, packetType):
-    self.packetType = packetType
-    self.types = ["Byte", "Two Byte Integer", "Four Byte Integer", "Variable Byte Integer",
-       "Binary Data", "UTF-8 Encoded String", "UTF-8 String Pair"]
+  Only the properties which are set are stored, by identifier.  Properties can keep
+  the encoding they were unpacked from, which is packed again for those unchanged.
+  """
 
-    self.names = {
-      "Payload Format Indicator" : 1,
-      "Message Expiry Interval" : 2,
-      "Content Type" : 3,
-      "Response Topic" : 8,
-      "Correlation Data" : 9,
-      "Subscription Identifier" : 11,
-      "Session Expiry Interval" : 17,
-      "Assigned Client Identifier" : 18,
-      "Server Keep Alive" : 19,
-      "Authentication Method" : 21,
-      "Authentication Data" : 22,
-      "Request Problem Information" : 23,
-      "Will Delay Interval" : 24,
-      "Request Response Information" : 25,
-      "Response Information" : 26,
-      "Server Reference" : 28,
-      "Reason String" : 31,
-      "Receive Maximum" : 33,
-      "Topic Alias Maximum" : 34,
-      "Topic Alias" : 35,
-      "Maximum QoS" : 36,
-      "Retain Available" : 37,
-      "User Property" : 38,
-      "Maximum Packet Size" : 39,
-      "Wildcard Subscription Available" : 40,
-      "Subscription Identifier Available" : 41,
-      "Shared Subscription Available" : 42
-    }
+  __slots__ = ["packetType", "values", "encoded"]
 
-    self.properties = {
-    # id:  type, packets
-      1  : (self.types.index("Byte"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]), # payload format indicator
-      2  : (self.types.index("Four Byte Integer"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
-      3  : (self.types.index("UTF-8 Encoded String"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
-      8  : (self.types.index("UTF-8 Encoded String"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
-      9  : (self.types.index("Binary Data"), [PacketTypes.PUBLISH, PacketTypes.WILLMESSAGE]),
-      11 : (self.types.index("Variable Byte Integer"),
-           [PacketTypes.PUBLISH, PacketTypes.SUBSCRIBE]),
-      17 : (self.types.index("Four Byte Integer"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK, PacketTypes.DISCONNECT]),
-      18 : (self.types.index("UTF-8 Encoded String"), [PacketTypes.CONNACK]),
-      19 : (self.types.index("Two Byte Integer"), [PacketTypes.CONNACK]),
-      21 : (self.types.index("UTF-8 Encoded String"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK, PacketTypes.AUTH]),
-      22 : (self.types.index("Binary Data"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK, PacketTypes.AUTH]),
-      23 : (self.types.index("Byte"),
-           [PacketTypes.CONNECT]),
-      24 : (self.types.index("Four Byte Integer"), [PacketTypes.WILLMESSAGE]),
-      25 : (self.types.index("Byte"), [PacketTypes.CONNECT]),
-      26 : (self.types.index("UTF-8 Encoded String"), [PacketTypes.CONNACK]),
-      28 : (self.types.index("UTF-8 Encoded String"),
-           [PacketTypes.CONNACK, PacketTypes.DISCONNECT]),
-      31 : (self.types.index("UTF-8 Encoded String"),
-           [PacketTypes.CONNACK, PacketTypes.PUBACK, PacketTypes.PUBREC,
-            PacketTypes.PUBREL, PacketTypes.PUBCOMP, PacketTypes.SUBACK,
-            PacketTypes.UNSUBACK, PacketTypes.DISCONNECT, PacketTypes.AUTH]),
-      33 : (self.types.index("Two Byte Integer"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK]),
-      34 : (self.types.index("Two Byte Integer"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK]),
-      35 : (self.types.index("Two Byte Integer"), [PacketTypes.PUBLISH]),
-      36 : (self.types.index("Byte"), [PacketTypes.CONNACK]),
-      37 : (self.types.index("Byte"), [PacketTypes.CONNACK]),
-      38 : (self.types.index("UTF-8 String Pair"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK,
-           PacketTypes.PUBLISH, PacketTypes.PUBACK,
-           PacketTypes.PUBREC, PacketTypes.PUBREL, PacketTypes.PUBCOMP,
-           PacketTypes.SUBSCRIBE, PacketTypes.SUBACK,
-           PacketTypes.UNSUBSCRIBE, PacketTypes.UNSUBACK,
-           PacketTypes.DISCONNECT, PacketTypes.AUTH, PacketTypes.WILLMESSAGE]),
-      39 : (self.types.index("Four Byte Integer"),
-           [PacketTypes.CONNECT, PacketTypes.CONNACK]),
-      40 : (self.types.index("Byte"), [PacketTypes.CONNACK]),
-      41 : (self.types.index("Byte"), [PacketTypes.CONNACK]),
-      42 : (self.types.index("Byte"), [PacketTypes.CONNACK]),
-    }
+  # the tables, as they used to be set on each instance
+  types = propertyTypes
+  names = propertyNames
+  properties = propertyDefinitions
+
+  def __init__(self, packetType):
+    self.packetType = packetType
+    self.values = {} # identifier: value, or list of values if allowed more than once
+    self.encoded = None # identifier: encoded property, for those unchanged since unpacking
 
   def allowsMultiple(self, compressedName):
-    return self.getIdentFromName(compressedName) in [11, 38]
+    return self.getIdentFromName(compressedName) in multipleProperties
 
   def getIdentFromName(self, compressedName):
     # return the identifier corresponding to the property name
-    result = -1
-    for name in self.names.keys():
-      if compressedName == name.replace(' ', ''):
-         result = self.names[name]
-         break
-    return result
+    return propertyIdents.get(compressedName, -1)
 
   def __setattr__(self, name, value):
     name = name.replace(' ', '')
-    privateVars = ["packetType", "types", "names", "properties"]
-    if name in privateVars:
+    if name in Properties.__slots__:
       object.__setattr__(self, name, value)
     else:
       # the name could have spaces in, or not.  Remove spaces before assignment
-      if name not in [name.replace(' ', '') for name in self.names.keys()]:
+      identifier = propertyIdents.get(name)
+      if identifier == None:
         raise MQTTException("Property name must be one of "+str(self.names.keys()))
-      # check that this attribute applies to the packet type
-      if self.packetType not in self.properties[self.getIdentFromName(name)][1]:
-        raise MQTTException("Property %s does not apply to packet type %s"
-            % (name, Packets.Names[self.packetType]) )
-      if self.allowsMultiple(name):
-        if type(value) != type([]):
-          value = [value]
-        if hasattr(self, name):
-          value = object.__getattribute__(self, name) + value
-      object.__setattr__(self, name, value)
+      self.setValue(identifier, value)
+
+  def setValue(self, identifier, value):
+    # check that this attribute applies to the packet type
+    if self.packetType not in propertyDefinitions[identifier][1]:
+      raise MQTTException("Property %s does not apply to packet type %s"
+          % (propertyCompressedNames[identifier], Packets.Names[self.packetType]) )
+    if identifier in multipleProperties:
+      if type(value) != type([]):
+        value = [value]
+      if identifier in self.values:
+        value = self.values[identifier] + value
+    self.values[identifier] = value
+    if self.encoded:
+      self.encoded.pop(identifier, None)
+
+  def __getattr__(self, name):
+    # only called for the properties, as the other attributes are found first
+    identifier = propertyIdents.get(name)
+    if identifier != None:
+      try:
+        return self.values[identifier]
+      except KeyError:
+        pass
+    raise AttributeError(name)
+
+  def __delattr__(self, name):
+    name = name.replace(' ', '')
+    try:
+      del self.values[propertyIdents[name]]
+    except KeyError:
+      raise AttributeError(name)
+    if self.encoded:
+      self.encoded.pop(propertyIdents[name], None)
+
+  def __getstate__(self):
+    return self.packetType, self.values, self.encoded
+
+  def __setstate__(self, state):
+    if type(state) == type({}): # pickled when the properties were instance attributes
+      self.__init__(state["packetType"])
+      for name, value in state.items():
+        if name in propertyIdents:
+          self.values[propertyIdents[name]] = value
+    else:
+      self.packetType, values = state[:2]
+      self.values = dict(values) # so that a copy has its own properties
+      encoded = state[2] if len(state) > 2 else None
+      self.encoded = dict(encoded) if encoded else None
 
   def __str__(self):
     buffer = "["
     first = True
-    for name in self.names.keys():
-      compressedName = name.replace(' ', '')
-      if hasattr(self, compressedName):
-        if not first:
-          buffer += ", "
-        buffer += compressedName +" : "+str(getattr(self, compressedName))
-        first = False
+    for identifier in sorted(self.values):
+      if not first:
+        buffer += ", "
+      buffer += propertyCompressedNames[identifier] +" : "+str(self.values[identifier])
+      first = False
     buffer += "]"
     return buffer
 
   def json(self):
     data = {}
-    for name in self.names.keys():
-      compressedName = name.replace(' ', '')
-      if hasattr(self, compressedName):
-        data[compressedName] = getattr(self, compressedName)
-        if type(data[compressedName]) == type(b''): # can't json serialize bytes
-          data[compressedName] = str(data[compressedName])
+    for identifier in sorted(self.values):
+      compressedName = propertyCompressedNames[identifier]
+      data[compressedName] = self.values[identifier]
+      if type(data[compressedName]) == type(b''): # can't json serialize bytes
+        data[compressedName] = str(data[compressedName])
     return data
 
   def isEmpty(self):
-    rc = True
-    for name in self.names.keys():
-      compressedName = name.replace(' ', '')
-      if hasattr(self, compressedName):
-        rc = False
-        break
-    return rc
+    return len(self.values) == 0
 
   def clear(self):
-    for name in self.names.keys():
-      compressedName = name.replace(' ', '')
-      if hasattr(self, compressedName):
-        delattr(self, compressedName)
+    self.values.clear()
+    self.encoded = None
 
   def writeProperty(self, identifier, type, value):
-    buffer = b""
-    buffer += VBIs.encode(identifier) # identifier
-    if type == self.types.index("Byte"): # value
-      buffer += bytes([value])
-    elif type == self.types.index("Two Byte Integer"):
-      buffer += writeInt16(value)
-    elif type == self.types.index("Four Byte Integer"):
-      buffer += writeInt32(value)
-    elif type == self.types.index("Variable Byte Integer"):
-      buffer += VBIs.encode(value)
-    elif type == self.types.index("Binary Data"):
-      buffer += writeBytes(value)
-    elif type == self.types.index("UTF-8 Encoded String"):
-      buffer += writeUTF(value)
-    elif type == self.types.index("UTF-8 String Pair"):
-      buffer += writeUTF(value[0]) + writeUTF(value[1])
-    return buffer
+    return propertyIdentifiers[identifier] + propertyWriters[type](value)
+
+  def packValue(self, identifier):
+    "serialize one property by identifier, which must be set"
+    if self.encoded and identifier in self.encoded:
+      return self.encoded[identifier]
+    value = self.values[identifier]
+    identifierBytes = propertyIdentifiers[identifier]
+    write = propertyWriters[propertyDefinitions[identifier][0]]
+    if identifier in multipleProperties:
+      return b"".join([identifierBytes + write(v) for v in value])
+    return identifierBytes + write(value)
+
+  def packProperty(self, compressedName):
+    "serialize one property, which must be set"
+    return self.packValue(propertyIdents[compressedName])
 
   def pack(self):
     # serialize properties into buffer for sending over network
-    buffer = b""
-    for name in self.names.keys():
-      compressedName = name.replace(' ', '')
-      if hasattr(self, compressedName):
-        identifier = self.getIdentFromName(compressedName)
-        attr_type = self.properties[identifier][0]
-        if self.allowsMultiple(compressedName):
-          for prop in getattr(self, compressedName):
-            buffer += self.writeProperty(identifier, attr_type, prop)
-        else:
-          buffer += self.writeProperty(identifier, attr_type,
-                           getattr(self, compressedName))
-    if len(buffer) == 0:
-       logger.info("[MQTT5-2.2.2-1] If there are no properties, a property length of 0 must be included")
+    if len(self.values) == 0:
+      statements.info("[MQTT5-2.2.2-1] If there are no properties, a property length of 0 must be included")
+      return b"\x00"
+    buffer = b"".join([self.packValue(identifier) for identifier in sorted(self.values)])
     return VBIs.encode(len(buffer)) + buffer
 
+  def packSegments(self, compressedNames):
+    """serialize the properties other than those named, without the length, split
+       where each of the named properties would be.  Returns len(compressedNames)+1 segments"""
+    splits = sorted(propertyIdents[name] for name in compressedNames)
+    segments = [b""]
+    for identifier in sorted(set(self.values).union(splits)):
+      if identifier in splits:
+        segments.append(b"")
+      else:
+        segments[-1] += self.packValue(identifier)
+    return segments
+
   def readProperty(self, buffer, type, propslen):
-    if type == self.types.index("Byte"):
-      value = buffer[0]
-      valuelen = 1
-    elif type == self.types.index("Two Byte Integer"):
-      value = readInt16(buffer)
-      valuelen = 2
-    elif type == self.types.index("Four Byte Integer"):
-      value = readInt32(buffer)
-      valuelen = 4
-    elif type == self.types.index("Variable Byte Integer"):
-      value, valuelen = VBIs.decode(buffer)
-    elif type == self.types.index("Binary Data"):
-      value, valuelen = readBytes(buffer)
-    elif type == self.types.index("UTF-8 Encoded String"):
-      value, valuelen = readUTF(buffer, propslen)
-    elif type == self.types.index("UTF-8 String Pair"):
-      logger.info("[MQTT5-1.5.7-1] Both string pair strings must be properly formed")
-      value, valuelen = readUTF(buffer, propslen)
-      buffer = buffer[valuelen:] # strip the bytes used by the value
-      value1, valuelen1 = readUTF(buffer, propslen - valuelen)
-      value = (value, value1)
-      valuelen += valuelen1
-    return value, valuelen
+    return propertyReaders[type](buffer, propslen)
 
   def getNameFromIdent(self, identifier):
-    rc = None
-    for name in self.names:
-      if self.names[name] == identifier:
-        rc = name
-    return rc
+    return propertyNamesByIdent.get(identifier)
 
-  def unpack(self, buffer):
+  def unpack(self, buffer, cache=False):
+    """deserialize properties into attributes from buffer received from network.
+
+    With cache, the properties decoded from the same encoding before are reused, and
+    their encodings kept, so that they can be passed on without being encoded again.
+    """
     self.clear()
-    # deserialize properties into attributes from buffer received from network
+    buffer = memoryview(buffer) # so that slices of the buffer are not copies
     propslen, VBIlen = VBIs.decode(buffer)
-    buffer = buffer[VBIlen:] # strip the bytes used by the VBI
+    if cache:
+      key = None
+      if 0 < propslen <= PROPERTIES_CACHE_LENGTH:
+        key = (self.packetType, bytes(buffer[VBIlen:VBIlen + propslen]))
+        cached = propertiesCache.get(key)
+        if cached != None:
+          self.values, self.encoded = dict(cached[0]), dict(cached[1])
+          logStrings(self.values) # so that coverage doesn't depend on what is cached
+          for identifier in multipleProperties:
+            if identifier in self.values: # a list, which must not be shared
+              self.values[identifier] = self.values[identifier][:]
+          return self, propslen + VBIlen
+      encoded = {}
+    curlen = VBIlen
     propslenleft = propslen
     while propslenleft > 0: # properties length is 0 if there are none
-      identifier, VBIlen = VBIs.decode(buffer) # property identifier
-      buffer = buffer[VBIlen:] # strip the bytes used by the VBI
-      propslenleft -= VBIlen
-      attr_type = self.properties[identifier][0]
-      value, valuelen = self.readProperty(buffer, attr_type, propslenleft)
-      buffer = buffer[valuelen:] # strip the bytes used by the value
+      start = curlen
+      identifier, idlen = VBIs.decode(buffer[curlen:]) # property identifier
+      curlen += idlen
+      propslenleft -= idlen
+      value, valuelen = propertyReaders[propertyDefinitions[identifier][0]](buffer[curlen:], propslenleft)
+      curlen += valuelen
       propslenleft -= valuelen
-      propname = self.getNameFromIdent(identifier)
-      compressedName = propname.replace(' ', '')
-      if not self.allowsMultiple(compressedName) and hasattr(self, compressedName):
-        raise MQTTException("Property '%s' must not exist more than once" % property)
-      setattr(self, propname, value)
+      if identifier not in multipleProperties and identifier in self.values:
+        raise MQTTException("Property '%s' must not exist more than once" % propertyCompressedNames[identifier])
+      self.setValue(identifier, value)
+      if cache:
+        encoded[identifier] = encoded.get(identifier, b"") + bytes(buffer[start:curlen])
+    if cache:
+      self.encoded = encoded
+      if key != None:
+        if len(propertiesCache) >= PROPERTIES_CACHE_ENTRIES:
+          propertiesCache.clear()
+        propertiesCache[key] = (dict(self.values), encoded.copy())
     return self, propslen + VBIlen
 
 
 class Connects(Packets):
 
+  __slots__ = ["properties", "WillProperties", "ProtocolName", "ProtocolVersion",
+    "ClientIdentifier", "CleanStart", "KeepAliveTimer", "WillFlag", "WillQoS",
+    "WillRETAIN", "WillTopic", "WillMessage", "usernameFlag", "passwordFlag", "username",
+    "password"]
+
   def __init__(self, buffer = None):
-    object.__setattr__(self, "names",
-         ["fh", "properties", "WillProperties", "ProtocolName", "ProtocolVersion",
-          "ClientIdentifier", "CleanStart", "KeepAliveTimer",
-          "WillFlag", "WillQoS", "WillRETAIN", "WillTopic", "WillMessage",
-          "usernameFlag", "passwordFlag", "username", "password"])
 
     self.fh = FixedHeaders(PacketTypes.CONNECT)
 
@@ -716,6 +864,7 @@ class Connects(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.CONNECT
 
@@ -733,12 +882,12 @@ class Connects(Packets):
       self.ProtocolName, valuelen = readUTF(buffer[curlen:], packlen - curlen)
       curlen += valuelen
       assert self.ProtocolName == "MQTT", "[MQTT5-3.1.2-1-error] Wrong protocol name %s" % self.ProtocolName
-      logger.info("[MQTT5-3.1.2-1] Protocol name must be MQTT")
+      statements.info("[MQTT5-3.1.2-1] Protocol name must be MQTT")
 
       self.ProtocolVersion = buffer[curlen]
       curlen += 1
       assert self.ProtocolVersion == 5, "[MQTT5-3.1.2-2-error] Wrong protocol version %s" % self.ProtocolVersion
-      logger.info("[MQTT5-3.1.2-2] Protocol name must be 5")
+      statements.info("[MQTT5-3.1.2-2] Protocol name must be 5")
 
       connectFlags = buffer[curlen]
       assert (connectFlags & 0x01) == 0, "[MQTT5-3.1.2-3] reserved connect flag must be 0"
@@ -761,19 +910,19 @@ class Connects(Packets):
 
       curlen += self.properties.unpack(buffer[curlen:])[1]
 
-      logger.info("[MQTT5-3.1.3-3] Clientid must be present, and first field")
-      logger.info("[MQTT5-3.1.3-4] Clientid must be a UTF-8 encoded string")
+      statements.info("[MQTT5-3.1.3-3] Clientid must be present, and first field")
+      statements.info("[MQTT5-3.1.3-4] Clientid must be a UTF-8 encoded string")
       self.ClientIdentifier, valuelen = readUTF(buffer[curlen:], packlen - curlen)
       curlen += valuelen
 
       if self.WillFlag:
         curlen += self.WillProperties.unpack(buffer[curlen:])[1]
         self.WillTopic, valuelen = readUTF(buffer[curlen:], packlen - curlen)
-        logger.info("[MQTT5-3.1.3-11] will topic must be a UTF-8 encoded string")
+        statements.info("[MQTT5-3.1.3-11] will topic must be a UTF-8 encoded string")
         curlen += valuelen
         self.WillMessage, valuelen = readBytes(buffer[curlen:])
         curlen += valuelen
-        logger.info("[MQTT5-3.1.2-9] will topic and will message fields must be present")
+        statements.info("[MQTT5-3.1.2-9] will topic and will message fields must be present")
       else:
         self.WillTopic = self.WillMessage = None
 
@@ -781,22 +930,22 @@ class Connects(Packets):
         assert len(buffer) > curlen+2, "Buffer too short to read username length"
         self.username, valuelen = readUTF(buffer[curlen:], packlen - curlen)
         curlen += valuelen
-        logger.info("[MQTT5-3.1.2-17] username must be in payload if user name flag is 1")
-        logger.info("[MQTT5-3.1.3-12] username must be next and UTF-8 encoded string")
+        statements.info("[MQTT5-3.1.2-17] username must be in payload if user name flag is 1")
+        statements.info("[MQTT5-3.1.3-12] username must be next and UTF-8 encoded string")
       else:
-        logger.info("[MQTT5-3.1.2-16] username must not be in payload if user name flag is 0")
+        statements.info("[MQTT5-3.1.2-16] username must not be in payload if user name flag is 0")
         assert self.passwordFlag == False, "[MQTT5-3.1.2-22] password flag must be 0 if username flag is 0"
 
       if self.passwordFlag:
         assert len(buffer) > curlen+2, "Buffer too short to read password length"
         self.password, valuelen = readBytes(buffer[curlen:])
         curlen += valuelen
-        logger.info("[MQTT5-3.1.2-19] password must be in payload if password flag is 1")
+        statements.info("[MQTT5-3.1.2-19] password must be in payload if password flag is 1")
       else:
-        logger.info("[MQTT5-3.1.2-18] password must not be in payload if password flag is 0")
+        statements.info("[MQTT5-3.1.2-18] password must not be in payload if password flag is 0")
 
       if self.WillFlag and self.usernameFlag and self.passwordFlag:
-        logger.info("[MQTT5-3.1.3-1] clientid, will topic, will message, username and password all present")
+        statements.info("[MQTT5-3.1.3-1] clientid, will topic, will message, username and password all present")
 
       assert curlen == packlen, "Packet is wrong length curlen %d != packlen %d" % (curlen, packlen)
     except:
@@ -868,9 +1017,9 @@ class Connects(Packets):
 
 class Connacks(Packets):
 
+  __slots__ = ["sessionPresent", "reasonCode", "properties"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, ReasonCode="Success"):
-    object.__setattr__(self, "names",
-         ["fh", "sessionPresent", "reasonCode", "properties"])
     self.fh = FixedHeaders(PacketTypes.CONNACK)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -883,7 +1032,7 @@ class Connacks(Packets):
 
   def pack(self):
     flags = 0x01 if self.sessionPresent else 0x00
-    logger.info("[MQTT5-3.2.2-1] bits 7-1 of the connack flags are reserved and must be set to 0")
+    statements.info("[MQTT5-3.2.2-1] bits 7-1 of the connack flags are reserved and must be set to 0")
     buffer = bytes([flags])
     buffer += self.reasonCode.pack()
     buffer += self.properties.pack()
@@ -891,6 +1040,7 @@ class Connacks(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 4
     assert PacketType(buffer) == PacketTypes.CONNACK
     curlen = self.fh.unpack(buffer, maximumPacketSize)
@@ -924,10 +1074,10 @@ class Connacks(Packets):
 
 class Disconnects(Packets):
 
+  __slots__ = ["reasonCode", "properties"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False,
           reasonCode="Normal disconnection"):
-    object.__setattr__(self, "names",
-        ["fh", "DUP", "QoS", "RETAIN", "reasonCode", "properties"])
     self.fh = FixedHeaders(PacketTypes.DISCONNECT)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -948,6 +1098,7 @@ class Disconnects(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     self.properties.clear()
     self.reasonCode.set("Normal disconnection")
     assert len(buffer) >= 2
@@ -986,10 +1137,10 @@ class Disconnects(Packets):
 
 class Publishes(Packets):
 
+  __slots__ = ["topicName", "packetIdentifier", "properties", "data", "qos2state",
+    "receivedTime", "template"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, MsgId=1, TopicName="", Payload=b""):
-    object.__setattr__(self, "names",
-          ["fh", "DUP", "QoS", "RETAIN", "topicName", "packetIdentifier",
-           "properties", "data", "qos2state", "receivedTime"])
     self.fh = FixedHeaders(PacketTypes.PUBLISH)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1000,22 +1151,32 @@ class Publishes(Packets):
     self.properties = Properties(PacketTypes.PUBLISH)
     # payload
     self.data = Payload
+    # encoding shared with other publishes of the same message
+    self.template = None
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
+    return b"".join(self.packBuffers())
+
+  def packBuffers(self):
+    "pack into the fixed and variable headers, and the payload, which is not copied"
+    if self.template != None and self.template.fits(self):
+      return [self.template.packHeaders(self), self.data]
     buffer = writeUTF(self.topicName)
     if self.fh.QoS == 0:
-      logger.info("[MQTT5-2.2.1-2] no packet indentifier in publish if QoS is 0")
+      statements.info("[MQTT5-2.2.1-2] no packet indentifier in publish if QoS is 0")
     else:
-      logger.info("[MQTT5-2.2.1-4] packet indentifier must be in publish if QoS is 1 or 2")
+      statements.info("[MQTT5-2.2.1-4] packet indentifier must be in publish if QoS is 1 or 2")
       buffer +=  writeInt16(self.packetIdentifier)
     buffer += self.properties.pack()
-    buffer += self.data
-    buffer = self.fh.pack(len(buffer)) + buffer
-    return buffer
+    buffer = self.fh.pack(len(buffer) + len(self.data)) + buffer
+    return [buffer, self.data]
 
   def unpack(self, buffer, maximumPacketSize):
+    # the payload is a slice of the buffer, so a view of it if the buffer is a memoryview
+    packet = buffer
+    buffer = memoryview(buffer)
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.PUBLISH
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
@@ -1026,29 +1187,36 @@ class Publishes(Packets):
     try:
       self.topicName, valuelen = readUTF(buffer[fhlen:], packlen - curlen)
     except UnicodeDecodeError:
-      logger.info("[MQTT5-3.3.2-1] topic name in publish must be utf-8")
+      statements.info("[MQTT5-3.3.2-1] topic name in publish must be utf-8")
       raise
     curlen += valuelen
     if self.fh.QoS != 0:
       self.packetIdentifier = readInt16(buffer[curlen:])
-      logger.info("[MQTT5-2.2.1-3] packet indentifier must be in publish if QoS is 1 or 2")
+      statements.info("[MQTT5-2.2.1-3] packet indentifier must be in publish if QoS is 1 or 2")
       curlen += 2
       assert self.packetIdentifier > 0, "[MQTT5-2.3.1-1] packet indentifier must be > 0"
     else:
-      logger.info("[MQTT5-2.2.1-2] no packet indentifier in publish if QoS is 0")
+      statements.info("[MQTT5-2.2.1-2] no packet indentifier in publish if QoS is 0")
       self.packetIdentifier = 0
-    curlen += self.properties.unpack(buffer[curlen:])[1]
-    self.data = buffer[curlen:fhlen + self.fh.remainingLength]
+    # publishes often have the same properties as the last, which the broker passes on unchanged
+    curlen += self.properties.unpack(buffer[curlen:], cache=True)[1]
+    self.data = packet[curlen:fhlen + self.fh.remainingLength]
     if self.fh.QoS == 0:
       assert self.fh.DUP == False, "[MQTT5-2.1.2-4]"
     return fhlen + self.fh.remainingLength
 
+  def payload(self):
+    "the payload, as bytes rather than a view of the buffer it was unpacked from"
+    if type(self.data) == memoryview:
+      return bytes(self.data)
+    return self.data
+
   def __str__(self):
     rc = str(self.fh)
     if self.fh.QoS != 0:
       rc += ", PacketId="+str(self.packetIdentifier)
     rc += ", Properties: "+str(self.properties)
-    rc += ", TopicName="+str(self.topicName)+", Payload="+str(self.data)+")"
+    rc += ", TopicName="+str(self.topicName)+", Payload="+str(self.payload())+")"
     return rc
 
   def json(self):
@@ -1056,7 +1224,7 @@ class Publishes(Packets):
       "fh": self.fh.json(),
       "Properties": self.properties.json(),
       "TopicName": self.topicName,
-      "Payload": str(self.data),
+      "Payload": str(self.payload()),
     }
     if self.fh.QoS != 0:
       data["PacketId"] = self.packetIdentifier
@@ -1071,12 +1239,63 @@ class Publishes(Packets):
     return rc
 
 
+class PublishTemplates(object):
+  """
+  The parts of a publish which are the same for every client it is sent to: the topic
+  name, the properties other than the topic alias and subscription identifiers, and
+  the payload.  These are encoded once, so that a publish which shares them only has
+  its fixed header, packet identifier and those properties encoded.
+  """
+
+  perClientProperties = ["SubscriptionIdentifier", "TopicAlias"]
+
+  def __init__(self, topicName, properties, data):
+    self.topicName = topicName
+    self.properties = properties
+    self.data = data
+    self.encodedTopicName = None
+    self.segments = None # the encoded properties, split where the per client ones go
+    self.messageExpiryInterval = None # when the properties were encoded
+
+  def fits(self, publish):
+    "whether the publish shares this template's topic name, properties and payload"
+    if publish.properties is not self.properties or publish.data is not self.data:
+      return False
+    # the broker reduces the message expiry interval as the message waits to be sent
+    messageExpiryInterval = getattr(self.properties, "MessageExpiryInterval", None)
+    if self.segments == None or messageExpiryInterval != self.messageExpiryInterval:
+      self.encodedTopicName = writeUTF(self.topicName)
+      self.segments = self.properties.packSegments(self.perClientProperties)
+      self.messageExpiryInterval = messageExpiryInterval
+    return True
+
+  def packHeaders(self, publish):
+    "the fixed and variable headers of a publish which fits this template"
+    if publish.topicName == self.topicName:
+      buffer = self.encodedTopicName
+    else: # a topic alias is being used
+      buffer = writeUTF(publish.topicName)
+    if publish.fh.QoS == 0:
+      statements.info("[MQTT5-2.2.1-2] no packet indentifier in publish if QoS is 0")
+    else:
+      statements.info("[MQTT5-2.2.1-4] packet indentifier must be in publish if QoS is 1 or 2")
+      buffer += writeInt16(publish.packetIdentifier)
+    properties = self.segments[0]
+    for i in range(len(self.perClientProperties)):
+      if hasattr(self.properties, self.perClientProperties[i]):
+        properties += self.properties.packProperty(self.perClientProperties[i])
+      properties += self.segments[i + 1]
+    if len(properties) == 0:
+       statements.info("[MQTT5-2.2.2-1] If there are no properties, a property length of 0 must be included")
+    buffer += VBIs.encode(len(properties)) + properties
+    return publish.fh.pack(len(buffer) + len(self.data)) + buffer
+
+
 class Acks(Packets):
 
+  __slots__ = ["packetIdentifier", "reasonCode", "properties", "ackType", "ackName"]
+
   def __init__(self, ackType, buffer, DUP, QoS, RETAIN, packetId):
-    object.__setattr__(self, "names",
-        ["fh", "DUP", "QoS", "RETAIN", "packetIdentifier",
-         "reasonCode", "properties"])
     self.fh = FixedHeaders(ackType)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1085,8 +1304,8 @@ class Acks(Packets):
     self.packetIdentifier = packetId
     self.reasonCode = ReasonCodes(ackType)
     self.properties = Properties(ackType)
-    object.__setattr__(self, "ackType", ackType)
-    object.__setattr__(self, "ackName", Packets.Names[self.ackType])
+    self.ackType = ackType
+    self.ackName = Packets.Names[self.ackType]
     if buffer != None:
       self.unpack(buffer)
 
@@ -1100,6 +1319,7 @@ class Acks(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     self.properties.clear()
     self.reasonCode.set("Success")
     assert len(buffer) >= 2
@@ -1153,39 +1373,63 @@ class Acks(Packets):
 
 class Pubacks(Acks):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, PacketId=1):
     Acks.__init__(self, PacketTypes.PUBACK, buffer, DUP, QoS, RETAIN, PacketId)
 
 class Pubrecs(Acks):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, PacketId=1):
     Acks.__init__(self, PacketTypes.PUBREC, buffer, DUP, QoS, RETAIN, PacketId)
 
 class Pubrels(Acks):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=1, RETAIN=False, PacketId=1):
     Acks.__init__(self, PacketTypes.PUBREL, buffer, DUP, QoS, RETAIN, PacketId)
 
 class Pubcomps(Acks):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, PacketId=1):
     Acks.__init__(self, PacketTypes.PUBCOMP, buffer, DUP, QoS, RETAIN, PacketId)
 
-class SubscribeOptions(object):
+# Most acks have the success reason code and no properties, so are just a fixed header
+# and a packet identifier.  These are packed and unpacked without Acks objects.
+plainAcks = struct.Struct("!BBH") # first byte, remaining length 2, packet identifier
+plainAckFirstBytes = {PacketTypes.PUBACK: 0x40, PacketTypes.PUBREC: 0x50,
+                      PacketTypes.PUBREL: 0x62, PacketTypes.PUBCOMP: 0x70}
+plainAckTypes = {firstByte: ackType for ackType, firstByte in plainAckFirstBytes.items()}
+
+def packAck(ackType, packetIdentifier):
+  "a puback, pubrec, pubrel or pubcomp with the success reason code and no properties"
+  return plainAcks.pack(plainAckFirstBytes[ackType], 2, packetIdentifier)
+
+def unpackAck(buffer, maximumPacketSize=MAX_PACKET_SIZE):
+  """(ack type, packet identifier) of a well formed ack with the success reason code and
+  no properties, otherwise None, for unpackPacket to check and unpack.
+  """
+  if len(buffer) == 4 and buffer[1] == 2 and maximumPacketSize >= 4:
+    ackType = plainAckTypes.get(buffer[0])
+    if ackType != None:
+      return ackType, plainAcks.unpack(buffer)[2]
+  return None
+
+class SubscribeOptions(SlottedObjects):
+
+  __slots__ = ["QoS", "noLocal", "retainAsPublished", "retainHandling"]
 
   def __init__(self, QoS=0, noLocal=False, retainAsPublished=False, retainHandling=0):
-    object.__setattr__(self, "names",
-           ["QoS", "noLocal", "retainAsPublished", "retainHandling"])
     self.QoS = QoS # bits 0,1
     self.noLocal = noLocal # bit 2
     self.retainAsPublished = retainAsPublished # bit 3
     self.retainHandling = retainHandling # bits 4 and 5: 0, 1 or 2
 
-  def __setattr__(self, name, value):
-    if name not in self.names:
-      raise MQTTException(name + " Attribute name must be one of "+str(self.names))
-    object.__setattr__(self, name, value)
-
   def pack(self):
     assert self.QoS in [0, 1, 2]
     assert self.retainHandling in [0, 1, 2], "Retain handling should be 0, 1 or 2"
@@ -1222,10 +1466,9 @@ class SubscribeOptions(object):
 
 class Subscribes(Packets):
 
+  __slots__ = ["packetIdentifier", "properties", "data"]
+
   def __init__(self, buffer=None, DUP=False, QoS=1, RETAIN=False, MsgId=1, Data=[]):
-    object.__setattr__(self, "names",
-       ["fh", "DUP", "QoS", "RETAIN", "packetIdentifier",
-        "properties", "data"])
     self.fh = FixedHeaders(PacketTypes.SUBSCRIBE)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1247,12 +1490,13 @@ class Subscribes(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     self.properties.clear()
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.SUBSCRIBE
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
     assert len(buffer) >= fhlen + self.fh.remainingLength
-    logger.info("[MQTT5-2.2.1-3] packet indentifier must be in subscribe")
+    statements.info("[MQTT5-2.2.1-3] packet indentifier must be in subscribe")
     self.packetIdentifier = readInt16(buffer[fhlen:])
     assert self.packetIdentifier > 0, "[MQTT5-2.2.1-3] packet indentifier must be > 0"
     leftlen = self.fh.remainingLength - 2
@@ -1294,11 +1538,10 @@ class Subscribes(Packets):
 
 class UnsubSubacks(Packets):
 
+  __slots__ = ["packetIdentifier", "reasonCodes", "properties", "packetType"]
+
   def __init__(self, packetType, buffer, DUP, QoS, RETAIN, PacketId, reasonCodes):
-    object.__setattr__(self, "names",
-      ["fh", "DUP", "QoS", "RETAIN", "packetIdentifier",
-       "reasonCodes", "properties"])
-    object.__setattr__(self, "packetType", packetType)
+    self.packetType = packetType
     self.fh = FixedHeaders(self.packetType)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1321,6 +1564,7 @@ class UnsubSubacks(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 3
     assert PacketType(buffer) == self.packetType
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
@@ -1367,15 +1611,17 @@ class UnsubSubacks(Packets):
 
 class Subacks(UnsubSubacks):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, PacketId=1, reasonCodes=[]):
       UnsubSubacks.__init__(self, PacketTypes.SUBACK, buffer, DUP, QoS, RETAIN, PacketId, reasonCodes)
 
 
 class Unsubscribes(Packets):
 
+  __slots__ = ["packetIdentifier", "properties", "topicFilters"]
+
   def __init__(self, buffer=None, DUP=False, QoS=1, RETAIN=False, PacketId=1, TopicFilters=[]):
-    object.__setattr__(self, "names",
-       ["fh", "DUP", "QoS", "RETAIN", "packetIdentifier", "properties", "topicFilters"])
     self.fh = FixedHeaders(PacketTypes.UNSUBSCRIBE)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1397,11 +1643,12 @@ class Unsubscribes(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.UNSUBSCRIBE
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
     assert len(buffer) >= fhlen + self.fh.remainingLength
-    logger.info("[MQTT5-2.2.1-3] packet indentifier must be in unsubscribe")
+    statements.info("[MQTT5-2.2.1-3] packet indentifier must be in unsubscribe")
     self.packetIdentifier = readInt16(buffer[fhlen:])
     assert self.packetIdentifier > 0, "[MQTT5-2.2.1-3] packet indentifier must be > 0"
     leftlen = self.fh.remainingLength - 2
@@ -1415,7 +1662,7 @@ class Unsubscribes(Packets):
     assert self.fh.DUP == False, "[MQTT5-2.1.3-1]"
     assert self.fh.QoS == 1, "[MQTT5-2.1.3-1]"
     assert self.fh.RETAIN == False, "[MQTT5-2.1.3-1]"
-    logger.info("[MQTT5-3-10.1-1] fixed header bits are 0,0,1,0")
+    statements.info("[MQTT5-3-10.1-1] fixed header bits are 0,0,1,0")
     return fhlen + self.fh.remainingLength
 
   def __str__(self):
@@ -1440,6 +1687,8 @@ class Unsubscribes(Packets):
 
 class Unsubacks(UnsubSubacks):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False, PacketId=1, reasonCodes=[]):
       UnsubSubacks.__init__(self, PacketTypes.UNSUBACK, buffer, DUP, QoS, RETAIN,
           PacketId, reasonCodes)
@@ -1447,8 +1696,9 @@ class Unsubacks(UnsubSubacks):
 
 class Pingreqs(Packets):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False):
-    object.__setattr__(self, "names", ["fh", "DUP", "QoS", "RETAIN"])
     self.fh = FixedHeaders(PacketTypes.PINGREQ)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1457,6 +1707,7 @@ class Pingreqs(Packets):
       self.unpack(buffer)
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.PINGREQ
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
@@ -1478,8 +1729,9 @@ class Pingreqs(Packets):
 
 class Pingresps(Packets):
 
+  __slots__ = ()
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False):
-    object.__setattr__(self, "names", ["fh", "DUP", "QoS", "RETAIN"])
     self.fh = FixedHeaders(PacketTypes.PINGRESP)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1488,6 +1740,7 @@ class Pingresps(Packets):
       self.unpack(buffer)
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.PINGRESP
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
@@ -1506,13 +1759,15 @@ class Pingresps(Packets):
     }
     return data
 
+pingresp = bytes([PacketTypes.PINGRESP << 4, 0]) # as packed by Pingresps
+
 
 class Disconnects(Packets):
 
+  __slots__ = ["reasonCode", "properties"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False,
           reasonCode="Normal disconnection"):
-    object.__setattr__(self, "names",
-        ["fh", "DUP", "QoS", "RETAIN", "reasonCode", "properties"])
     self.fh = FixedHeaders(PacketTypes.DISCONNECT)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1533,6 +1788,7 @@ class Disconnects(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     self.properties.clear()
     self.reasonCode.set("Normal disconnection")
     assert len(buffer) >= 2
@@ -1571,10 +1827,10 @@ class Disconnects(Packets):
 
 class Auths(Packets):
 
+  __slots__ = ["reasonCode", "properties"]
+
   def __init__(self, buffer=None, DUP=False, QoS=0, RETAIN=False,
           reasonCode="Success"):
-    object.__setattr__(self, "names",
-        ["fh", "DUP", "QoS", "RETAIN", "reasonCode", "properties"])
     self.fh = FixedHeaders(PacketTypes.AUTH)
     self.fh.DUP = DUP
     self.fh.QoS = QoS
@@ -1592,6 +1848,7 @@ class Auths(Packets):
     return buffer
 
   def unpack(self, buffer, maximumPacketSize):
+    buffer = memoryview(buffer)
     assert len(buffer) >= 2
     assert PacketType(buffer) == PacketTypes.AUTH
     fhlen = self.fh.unpack(buffer, maximumPacketSize)
@@ -1628,9 +1885,32 @@ classes = [Connects, Connacks, Publishes, Pubacks, Pubrecs,
            Unsubacks, Pingreqs, Pingresps, Disconnects, Auths]
 
 def unpackPacket(buffer, maximumPacketSize=MAX_PACKET_SIZE):
+  """The fields of a packet are read from views of the buffer, without copying it.
+  If the buffer is a memoryview, the payload of a publish is one too, so must not be kept
+  for longer than the buffer's contents, except as bytes from Publishes.payload().
+  """
   if PacketType(buffer) != None:
     packet = classes[PacketType(buffer)-1]()
     packet.unpack(buffer, maximumPacketSize=maximumPacketSize)
   else:
     packet = None
   return packet
+
+def unpackPackets(buffer, maximumPacketSize=MAX_PACKET_SIZE):
+  """Generate the packets unpacked from a buffer holding any number of complete packets,
+  and perhaps the start of one more.  The generator returns the number of bytes used,
+  so that the rest can be kept until more data arrives:
+
+    consumed = yield from unpackPackets(buffer)
+
+  As with unpackPacket, the packets are read from views of the buffer, so it must not be
+  changed while they are in use.
+  """
+  buffer = memoryview(buffer)
+  start = 0
+  length = packetLength(buffer, start)
+  while length != None and start + length <= len(buffer):
+    yield unpackPacket(buffer[start:start + length], maximumPacketSize)
+    start += length
+    length = packetLength(buffer, start)
+  return start
@@ -1,4 +1,4 @@
-import unittest
+import unittest, logging
 
 import MQTTV5
 
@@ -62,6 +62,39 @@ class Test(unittest.TestCase):
         self.assertTrue(before == after,
             "For packet type %s" % (MQTTV5.Packets.Names[packetType]))
 
+    def testPropertyStorage(self):
+      import copy, pickle
+      p = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+      self.assertTrue(p.isEmpty())
+      self.assertEqual(p.pack(), b"\x00")
+      self.assertFalse(hasattr(p, "TopicAlias"))
+      p.TopicAlias = 3
+      p.ContentType = "text"
+      p.UserProperty = ("a", "b")
+      p.UserProperty = ("c", "d")
+      self.assertEqual(p.UserProperty, [("a", "b"), ("c", "d")])
+      self.assertEqual(str(p), "[ContentType : text, TopicAlias : 3, UserProperty : [('a', 'b'), ('c', 'd')]]")
+      with self.assertRaises(MQTTV5.MQTTException):
+        p.Rubbish = 1
+      with self.assertRaises(MQTTV5.MQTTException):
+        p.ServerKeepAlive = 1 # CONNACK only
+      self.assertEqual(p.getIdentFromName("TopicAlias"), 35)
+      self.assertEqual(p.getNameFromIdent(35), "Topic Alias")
+      q = copy.copy(p)
+      del q.TopicAlias
+      self.assertEqual(p.TopicAlias, 3)
+      self.assertFalse(hasattr(q, "TopicAlias"))
+      with self.assertRaises(AttributeError):
+        del q.TopicAlias
+      r = pickle.loads(pickle.dumps(p))
+      self.assertEqual(r.pack(), p.pack())
+      self.assertEqual(str(MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH).unpack(p.pack())[0]), str(p))
+      self.assertEqual(b"".join(p.packSegments(["TopicAlias"])), q.pack()[1:])
+      duplicated = p.pack() + MQTTV5.Properties.writeProperty(p, 35, 1, 4)
+      duplicated = bytes([len(duplicated) - 1]) + duplicated[1:]
+      with self.assertRaises(MQTTV5.MQTTException):
+        MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH).unpack(duplicated)
+
     def testBasicPackets(self):
       for packet in MQTTV5.classes:
         #print("BasicPacket", packet.__name__)
@@ -81,6 +114,205 @@ class Test(unittest.TestCase):
         after = str(MQTTV5.unpackPacket(p.pack()))
         self.assertEqual(before, after)
 
+    def testPacketFramers(self):
+      publish = MQTTV5.Publishes()
+      publish.topicName = "topic"
+      publish.data = b"x" * 200 # a two byte remaining length
+      publish = publish.pack()
+      stream = MQTTV5.Pingreqs().pack() + publish * 20
+      framer = MQTTV5.PacketFramers(size=16)
+      packets = []
+      for i in range(0, len(stream), 7): # packets split across feeds
+        framer.feed(stream[i:i+7])
+        packets += [bytes(p) for p in framer.packets()]
+      self.assertEqual(packets, [MQTTV5.Pingreqs().pack()] + [publish] * 20)
+      self.assertEqual(len(framer), 0)
+      framer.feed(publish[:2])
+      self.assertEqual(framer.packetLength(), None)
+      self.assertEqual(framer.nextPacket(), None)
+      framer.feed(publish[2:])
+      self.assertEqual(framer.packetLength(), len(publish))
+      self.assertEqual(framer.nextPacket(), publish)
+      framer.feed(b"\x30\xff\xff\xff\xff")
+      self.assertRaises(MQTTV5.MalformedPacket, framer.nextPacket)
+
+    def testUnpackPackets(self):
+      publish = MQTTV5.Publishes(QoS=1, MsgId=2, TopicName="topic", Payload=b"x" * 200)
+      packets = [MQTTV5.Pingreqs(), publish, MQTTV5.Pubacks(PacketId=2), publish]
+      lengths = [len(packet.pack()) for packet in packets]
+      stream = b"".join(packet.pack() for packet in packets)
+      for end in [0, 1, 2, 3, len(stream) - 1, len(stream)]:
+        unpacked = []
+        generator = MQTTV5.unpackPackets(bytearray(stream[:end]))
+        try:
+          while True:
+            unpacked.append(str(next(generator)))
+        except StopIteration as stop:
+          consumed = stop.value
+        complete = [i for i in range(len(packets)) if sum(lengths[:i + 1]) <= end]
+        self.assertEqual(unpacked, [str(packets[i]) for i in complete])
+        self.assertEqual(consumed, sum(lengths[i] for i in complete))
+      with self.assertRaises(MQTTV5.MalformedPacket):
+        list(MQTTV5.unpackPackets(b"\x30\xff\xff\xff\xff"))
+
+    def testPublishTemplates(self):
+      properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+      properties.UserProperty = ("a", "b")
+      properties.ContentType = "text"
+      properties.MessageExpiryInterval = 10
+      template = MQTTV5.PublishTemplates("topic", properties, b"payload")
+      for qos, retain, topicName, alias, subids in [(0, False, "topic", None, []),
+          (1, True, "", 3, [2]), (2, False, "topic", 4, [1, 300])]:
+        if hasattr(properties, "TopicAlias"):
+          del properties.TopicAlias
+        if hasattr(properties, "SubscriptionIdentifier"):
+          del properties.SubscriptionIdentifier
+        if alias:
+          properties.TopicAlias = alias
+        for subid in subids:
+          properties.SubscriptionIdentifier = subid
+        pub = MQTTV5.Publishes(QoS=qos, RETAIN=retain, MsgId=5, TopicName=topicName, Payload=b"payload")
+        pub.properties = properties
+        expected = pub.pack()
+        pub.data = template.data
+        pub.template = template
+        self.assertTrue(template.fits(pub))
+        self.assertEqual(b"".join(pub.packBuffers()), expected)
+      properties.MessageExpiryInterval = 5
+      self.assertEqual(pub.pack(), b"".join(pub.packBuffers()))
+      self.assertEqual(str(MQTTV5.unpackPacket(pub.pack())), str(pub))
+      pub.data = bytes(bytearray(b"payload")) # equal, but not the template's payload
+      self.assertFalse(template.fits(pub))
+
+    def testReadUTF(self):
+      for s in ["sensors/1/temperature", "", "capteurs/température", "温度/\U0001F321", "﻿bom"]:
+        data = MQTTV5.writeUTF(s)
+        self.assertEqual(MQTTV5.readUTF(data + b"rest", len(data) + 4), (s, len(data)))
+        self.assertEqual(MQTTV5.readUTF(data, len(data)), (s, len(data))) # cached, except with U+FEFF
+      for s in ["nul\x00", "nul\x00é"]:
+        with self.assertRaisesRegex(MQTTV5.MalformedPacket, r"\[MQTT5-1.5.4-2\] Null found in UTF data"):
+          MQTTV5.readUTF(MQTTV5.writeUTF(s), 20)
+      with self.assertRaises(UnicodeDecodeError): # an encoded surrogate is not valid UTF-8
+        MQTTV5.readUTF(b"\x00\x03\xed\xa0\x80", 5)
+      with self.assertRaises(MQTTV5.MalformedPacket):
+        MQTTV5.readUTF(MQTTV5.writeUTF("too long"), 5)
+
+    def testMemoryviews(self):
+      properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+      properties.CorrelationData = b"334"
+      properties.UserProperty = ("a", "b")
+      publish = MQTTV5.Publishes(QoS=1, MsgId=2, TopicName="topic", Payload=b"x" * 200)
+      publish.properties = properties
+      data = publish.pack()
+      viewed = MQTTV5.unpackPacket(memoryview(data))
+      self.assertEqual(type(viewed.data), memoryview)
+      self.assertEqual(type(MQTTV5.unpackPacket(data).data), bytes)
+      self.assertEqual(viewed, publish)
+      self.assertEqual(str(viewed), str(publish))
+      self.assertEqual(viewed.payload(), b"x" * 200)
+      self.assertEqual(type(viewed.properties.CorrelationData), bytes)
+      connect = MQTTV5.Connects()
+      connect.ClientIdentifier = "client"
+      connect.WillFlag = True
+      connect.WillTopic = "will"
+      connect.WillMessage = b"gone"
+      self.assertEqual(str(MQTTV5.unpackPacket(memoryview(connect.pack()))), str(connect))
+      for packet in [MQTTV5.Subscribes(Data=[("a/#", MQTTV5.SubscribeOptions(1))]), MQTTV5.Pubrels(),
+                     MQTTV5.Disconnects(), MQTTV5.Pingreqs()]:
+        self.assertEqual(str(MQTTV5.unpackPacket(memoryview(packet.pack()))), str(packet))
+      with self.assertRaises(AssertionError):
+        MQTTV5.VBIs.decode(b"\x80\x00") # not the shortest encoding
+      with self.assertRaises(AssertionError):
+        MQTTV5.VBIs.decode(b"\xff\xff\xff\xff\x01") # too large
+
+    def testPropertiesCache(self):
+      import copy
+      properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+      properties.MessageExpiryInterval = 10
+      properties.UserProperty = [("a", "b"), ("c", "d")]
+      properties.ContentType = "text"
+      publish = MQTTV5.Publishes(QoS=1, MsgId=2, TopicName="topic", Payload=b"payload")
+      publish.properties = properties
+      data = publish.pack()
+      first, second = MQTTV5.unpackPacket(data), MQTTV5.unpackPacket(data) # the second from the cache
+      self.assertEqual(second.properties.encoded, first.properties.encoded)
+      self.assertEqual(second.pack(), data)
+      self.assertEqual(str(second), str(publish))
+      second.properties.UserProperty = ("e", "f") # a copy of the cached list
+      self.assertEqual(first.properties.UserProperty, [("a", "b"), ("c", "d")])
+      self.assertEqual(MQTTV5.unpackPacket(data).properties.UserProperty, [("a", "b"), ("c", "d")])
+      self.assertEqual(MQTTV5.unpackPacket(second.pack()).properties.UserProperty, [("a", "b"), ("c", "d"), ("e", "f")])
+      second.properties.MessageExpiryInterval = 4 # no longer packed from the encoding
+      del second.properties.ContentType
+      self.assertEqual(MQTTV5.unpackPacket(second.pack()).properties.MessageExpiryInterval, 4)
+      self.assertFalse(hasattr(MQTTV5.unpackPacket(second.pack()).properties, "ContentType"))
+      copied = copy.copy(first.properties)
+      copied.MessageExpiryInterval = 3
+      self.assertEqual(first.pack(), data)
+      # the conformance statements logged are the same whether the properties are cached or not
+      class Handlers(logging.Handler):
+        def __init__(self):
+          logging.Handler.__init__(self)
+          self.statements = []
+        def emit(self, record):
+          self.statements.append(record.getMessage())
+      handler = Handlers()
+      logger = logging.getLogger("MQTT broker")
+      level = logger.level
+      logger.addHandler(handler)
+      logger.setLevel(logging.INFO)
+      try:
+        properties.ContentType = "\ufefftext" # which readUTF doesn't cache
+        data = properties.pack()
+        MQTTV5.propertiesCache.clear()
+        for i in range(2):
+          del handler.statements[:]
+          MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH).unpack(data, cache=True)
+          self.assertEqual(sorted(handler.statements), sorted(
+            ["[MQTT5-1.5.7-1] Both string pair strings must be properly formed"] * 2 +
+            ["[MQTT5-4.7.3-2] topic names and filters must not include null"] * 5 +
+            ["[MQTT5-1.5.4-3] U+FEFF in UTF string"]))
+      finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+      duplicated = properties.pack()[1:] + properties.packValue(2) # two message expiry intervals
+      for i in range(2): # not cached when invalid
+        with self.assertRaises(MQTTV5.MQTTException):
+          MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH).unpack(bytes([len(duplicated)]) + duplicated, cache=True)
+
+    def testPlainAcks(self):
+      for ack in [MQTTV5.Pubacks, MQTTV5.Pubrecs, MQTTV5.Pubrels, MQTTV5.Pubcomps]:
+        for packetIdentifier in [1, 300, MQTTV5.MAX_PACKETID]:
+          packet = ack(PacketId=packetIdentifier)
+          self.assertEqual(MQTTV5.packAck(packet.fh.PacketType, packetIdentifier), packet.pack())
+          self.assertEqual(MQTTV5.unpackAck(memoryview(packet.pack())), (packet.fh.PacketType, packetIdentifier))
+        packet.properties.ReasonString = "not plain"
+        self.assertEqual(MQTTV5.unpackAck(packet.pack()), None)
+      self.assertEqual(MQTTV5.pingresp, MQTTV5.Pingresps().pack())
+      for data in [b"\x41\x02\x00\x01", # reserved bits set
+                   b"\x40\x03\x00\x01\x00", b"\x40\x02\x00", MQTTV5.Pingreqs().pack()]:
+        self.assertEqual(MQTTV5.unpackAck(data), None)
+      self.assertEqual(MQTTV5.unpackAck(MQTTV5.packAck(MQTTV5.PacketTypes.PUBACK, 1), maximumPacketSize=3), None)
+
+    def testSlots(self):
+      import copy, pickle
+      for packet in MQTTV5.classes[1:]:
+        self.assertFalse(hasattr(packet(), "__dict__"), packet.__name__)
+      publish = MQTTV5.Publishes(QoS=1, MsgId=2, TopicName="topic", Payload=b"data")
+      with self.assertRaises(AttributeError):
+        publish.messageIdentifier = 2
+      with self.assertRaises(AttributeError):
+        publish.fh.Retain = True
+      publish.qos2state = "PUBREC"
+      for copied in [copy.copy(publish), pickle.loads(pickle.dumps(publish))]:
+        self.assertEqual(copied, publish)
+        self.assertEqual(copied.qos2state, "PUBREC")
+      # subscribe options persisted when the attributes were in a dictionary
+      options = MQTTV5.SubscribeOptions.__new__(MQTTV5.SubscribeOptions)
+      options.__setstate__({"names": ["QoS", "noLocal", "retainAsPublished", "retainHandling"],
+          "QoS": 2, "noLocal": True, "retainAsPublished": False, "retainHandling": 1})
+      self.assertEqual(options.pack(), MQTTV5.SubscribeOptions(2, True, False, 1).pack())
+
     def testReasonCodes(self):
       r = MQTTV5.ReasonCodes(MQTTV5.PacketTypes.DISCONNECT, "Normal disconnection")
       self.assertEqual(r.__getName__(MQTTV5.PacketTypes.DISCONNECT, 0),
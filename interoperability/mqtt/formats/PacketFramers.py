@@ -0,0 +1,121 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Framing of MQTT packets, which is the same for MQTT V5 and 3.1.1: a fixed header
+byte, a remaining length of one to four bytes, then that many bytes.
+"""
+
+
+def packetLength(buffer, start=0, end=None, exception=ValueError):
+  """the length of the packet at start in the buffer, or None if its fixed header is incomplete.
+
+  exception is raised if the remaining length is too long, as the codec's own.
+  """
+  if end == None:
+    end = len(buffer)
+  multiplier = 1
+  remlength = 0
+  for pos in range(start + 1, min(end, start + 5)):
+    digit = buffer[pos]
+    remlength += (digit & 127) * multiplier
+    if digit & 128 == 0:
+      return pos + 1 - start + remlength
+    multiplier *= 128
+  if end - start >= 5:
+    raise exception("[MQTT-1.5.5-1] the remaining length must be encoded in at most 4 bytes")
+  return None
+
+
+class PacketFramers:
+  """
+  Splits a stream of data into MQTT packets.
+
+  Data is read from a socket in large chunks, or fed from another source such as
+  websocket frames, into a reusable buffer.  Complete packets are returned as
+  memoryview slices of that buffer, which are only valid until the next fill or feed.
+  """
+
+  exception = ValueError # raised for a malformed remaining length
+
+  def __init__(self, size=4096):
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.start = 0 # of the data not yet returned
+    self.end = 0   # of the data in the buffer
+
+  def __len__(self):
+    return self.end - self.start
+
+  def reserve(self, size):
+    "make room for size more bytes at the end of the buffer"
+    length = self.end - self.start
+    if length == 0:
+      self.start = self.end = 0
+    if length + size > len(self.buffer):
+      # replace rather than resize the buffer, as packets returned may still refer to it
+      buffer = bytearray(max(2 * len(self.buffer), length + size))
+      buffer[:length] = self.view[self.start:self.end]
+      self.buffer = buffer
+      self.view = memoryview(buffer)
+    elif self.end + size > len(self.buffer):
+      self.buffer[:length] = bytes(self.view[self.start:self.end])
+    else:
+      return
+    self.start = 0
+    self.end = length
+
+  def fill(self, aSocket, size=1024):
+    "one read from the socket, of at least size bytes if available.  Returns 0 at end of file"
+    self.reserve(size)
+    count = aSocket.recv_into(self.view[self.end:])
+    self.end += count
+    return count
+
+  def feed(self, data):
+    "add data from another source"
+    self.reserve(len(data))
+    self.buffer[self.end:self.end + len(data)] = data
+    self.end += len(data)
+
+  def read(self, size):
+    "remove and return up to size bytes"
+    size = min(size, self.end - self.start)
+    data = bytes(self.view[self.start:self.start + size])
+    self.start += size
+    return data
+
+  def packetLength(self):
+    "the length of the next packet, or None if its fixed header is incomplete"
+    return packetLength(self.buffer, self.start, self.end, self.exception)
+
+  def nextPacket(self):
+    "remove and return the next complete packet, or None"
+    length = self.packetLength()
+    if length == None or self.start + length > self.end:
+      return None
+    packet = self.view[self.start:self.start + length]
+    self.start += length
+    return packet
+
+  def packets(self):
+    "generate the complete packets in the buffer"
+    packet = self.nextPacket()
+    while packet != None:
+      yield packet
+      packet = self.nextPacket()
@@ -0,0 +1,174 @@
+"""
+*******************************************************************
+  Copyright (c) 2013, 2018 IBM Corp.
+
+  All rights reserved. This program and the accompanying materials
+  are made available under the terms of the Eclipse Public License v1.0
+  and Eclipse Distribution License v1.0 which accompany this distribution.
+
+  The Eclipse Public License is available at
+     http://www.eclipse.org/legal/epl-v10.html
+  and the Eclipse Distribution License is available at
+    http://www.eclipse.org/org/documents/edl-v10.php.
+
+  Contributors:
+     Ian Craggs - initial implementation and/or documentation
+*******************************************************************
+"""
+
+"""
+Codec benchmarks: the time and memory to pack and unpack each kind of packet.  Run all
+of them with:
+
+  python3 -m mqtt.formats.benchmark
+
+or a selection of the codecs, writing the results as JSON to compare with later runs:
+
+  python3 -m mqtt.formats.benchmark --json results.json MQTTV5 MQTTSN
+"""
+
+import sys, time, json, platform, tracemalloc
+
+import mqtt.formats.MQTTV5 as MQTTV5
+import mqtt.formats.MQTTV311 as MQTTV3
+import mqtt.formats.MQTTSN as MQTTSN
+
+payloadSizes = [0, 100, 1024, 65536, 1048576]
+filterCount = 100 # topic filters in a subscribe
+seconds = 0.2 # to time each case for
+
+
+def timed(fn):
+  "return the average time in microseconds of one call of fn, called repeatedly for about seconds"
+  start = time.perf_counter()
+  fn()
+  once = time.perf_counter() - start
+  iterations = max(5, min(100000, int(seconds / max(once, 1e-7))))
+  start = time.perf_counter()
+  for i in range(iterations):
+    fn()
+  return (time.perf_counter() - start) * 1000000 / iterations
+
+
+def allocated(fn):
+  "return the peak memory in bytes allocated by one call of fn, and the number of blocks in what it returns"
+  tracemalloc.start()
+  try:
+    before = tracemalloc.take_snapshot()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    blocks = sum(stat.count_diff for stat in
+                 tracemalloc.take_snapshot().compare_to(before, "filename"))
+  finally:
+    tracemalloc.stop()
+  del result
+  return peak, blocks
+
+
+def V5cases():
+  "(packet type, payload size, packet) for MQTT V5"
+  cases = []
+  connect = MQTTV5.Connects()
+  connect.ClientIdentifier = "benchmark-client"
+  connect.KeepAliveTimer = 60
+  connect.properties.SessionExpiryInterval = 3600
+  cases.append(("CONNECT", 0, connect))
+  properties = MQTTV5.Properties(MQTTV5.PacketTypes.PUBLISH)
+  properties.MessageExpiryInterval = 60
+  properties.ContentType = "application/json"
+  properties.UserProperty = ("source", "sensor 1")
+  for size in payloadSizes:
+    publish = MQTTV5.Publishes(QoS=1, MsgId=1, TopicName="sensors/1/temperature", Payload=b"x" * size)
+    cases.append(("PUBLISH", size, publish))
+    publish = MQTTV5.Publishes(QoS=1, MsgId=1, TopicName="sensors/1/temperature", Payload=b"x" * size)
+    publish.properties = properties
+    cases.append(("PUBLISH with properties", size, publish))
+  cases.append(("SUBSCRIBE", 0, MQTTV5.Subscribes(MsgId=1,
+      Data=[("sensors/%d/+" % i, MQTTV5.SubscribeOptions(1)) for i in range(filterCount)])))
+  for ack in [MQTTV5.Pubacks, MQTTV5.Pubrecs, MQTTV5.Pubrels, MQTTV5.Pubcomps]:
+    cases.append((MQTTV5.Packets.Names[ack().fh.PacketType].upper(), 0, ack(PacketId=300)))
+  cases.append(("PINGRESP", 0, MQTTV5.Pingresps()))
+  return cases
+
+
+def V3cases():
+  "(packet type, payload size, packet) for MQTT 3.1.1"
+  cases = []
+  connect = MQTTV3.Connects()
+  connect.ClientIdentifier = "benchmark-client"
+  connect.KeepAliveTimer = 60
+  cases.append(("CONNECT", 0, connect))
+  for size in payloadSizes:
+    publish = MQTTV3.Publishes()
+    publish.fh.QoS = 1
+    publish.messageIdentifier = 1
+    publish.topicName = "sensors/1/temperature"
+    publish.data = b"x" * size
+    cases.append(("PUBLISH", size, publish))
+  cases.append(("SUBSCRIBE", 0, MQTTV3.Subscribes(MsgId=1,
+      Data=[("sensors/%d/+" % i, 1) for i in range(filterCount)])))
+  for ack in [MQTTV3.Pubacks, MQTTV3.Pubrecs, MQTTV3.Pubrels, MQTTV3.Pubcomps]:
+    packet = ack()
+    packet.messageIdentifier = 300
+    cases.append((MQTTV3.packetNames[packet.fh.MessageType].upper(), 0, packet))
+  cases.append(("PINGRESP", 0, MQTTV3.Pingresps()))
+  return cases
+
+
+def SNcases():
+  "(packet type, payload size, packet) for MQTT-SN, whose publishes are packed with a one byte length"
+  cases = []
+  connect = MQTTSN.Connects()
+  connect.ClientId = "benchmark-client"
+  cases.append(("CONNECT", 0, connect))
+  cases.append(("CONNACK", 0, MQTTSN.Connacks()))
+  for size in [size for size in payloadSizes if size < 256 - 7]:
+    publish = MQTTSN.Publishes()
+    publish.Flags.QoS = 1
+    publish.MsgId = 1
+    publish.Data = b"x" * size
+    cases.append(("PUBLISH", size, publish))
+  return cases
+
+codecs = {"MQTTV5": (V5cases, MQTTV5.unpackPacket),
+          "MQTTV311": (V3cases, MQTTV3.unpackPacket),
+          "MQTTSN": (SNcases, MQTTSN.unpackPacket)}
+
+
+def run(names):
+  "measure the codecs named, returning one result for each case"
+  results = []
+  print("%8s %24s %8s %10s %10s %10s %10s %11s %11s" % ("codec", "packet", "payload", "bytes",
+        "pack us", "unpack us", "pack MB/s", "pack peak", "unpack peak"))
+  for name in names:
+    cases, unpackPacket = codecs[name]
+    for packetType, size, packet in cases():
+      data = packet.pack()
+      pack = timed(packet.pack)
+      unpack = timed(lambda: unpackPacket(data))
+      packPeak, packBlocks = allocated(packet.pack)
+      unpackPeak, unpackBlocks = allocated(lambda: unpackPacket(data))
+      result = {"codec": name, "packet": packetType, "payload": size, "bytes": len(data),
+                "pack microseconds": pack, "unpack microseconds": unpack,
+                "pack peak bytes": packPeak, "unpack peak bytes": unpackPeak,
+                "pack blocks": packBlocks, "unpack blocks": unpackBlocks}
+      results.append(result)
+      print("%8s %24s %8d %10d %10.3f %10.3f %10.1f %11d %11d" % (name, packetType, size, len(data),
+            pack, unpack, len(data) / pack, packPeak, unpackPeak))
+  return results
+
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  filename = None
+  if "--json" in args:
+    index = args.index("--json")
+    filename = args[index + 1]
+    del args[index:index + 2]
+  results = run(args or list(codecs.keys()))
+  if filename != None:
+    with open(filename, "w") as output:
+      json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, output, indent=2)